@@ -0,0 +1,9 @@
+# manifest.py
+#
+# MicroPython manifest to freeze the ntpclient package into a firmware
+# build, on top of the board's own manifest:
+#
+#   make BOARD=ESP32_GENERIC FROZEN_MANIFEST=/path/to/manifest.py
+
+include("$(PORT_DIR)/boards/manifest.py")
+package("ntpclient")
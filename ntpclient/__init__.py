@@ -1,6 +1,7 @@
-from sys import platform
+# ntpclient
+#
+# Only the client engine is imported here, everything else is loaded
+# on first use. The board's clock backend is picked when the client is
+# created, see ntpclient_clock.
 
-if platform == 'esp32':
-    from .ntpclient_esp32 import *
-else:
-    raise Exception("unsupported platform '{}'".format(platform))
+from .ntpclient_core import ntpclient
@@ -0,0 +1,154 @@
+# ntpclient_allan.py
+#
+# Streaming Allan and modified Allan deviation of our oscillator,
+# estimated from the offsets the servers measure. Adding back what the
+# client slewed the clock by since the last offset gives the phase of
+# the free running oscillator against the servers. Its deviation over
+# an averaging time tau has two parts:
+#
+#   network noise     the jitter of the offsets, which shrinks with
+#                     longer tau (as 1/tau, or 1/tau^1.5 for the
+#                     modified deviation)
+#   oscillator wander temperature and aging, which grows with tau
+#
+# Where both meet, the Allan intercept, is the best poll interval: a
+# shorter one only measures more network noise, a longer one lets the
+# oscillator wander off between two updates.
+#
+# For every tau = _TAU0 * 2^m the offsets are split into windows of
+# about tau. Each window gives the average frequency over it (the
+# phase it advanced by over its length) and the average phase in it.
+# The differences of these between consecutive windows are averaged
+# exponentially over the last _AVG of them, so memory stays fixed and
+# the estimate follows changes. The modified deviation uses the window
+# averages of the phase, which tells white from flicker phase noise
+# apart where the Allan deviation can not.
+#
+# All deviations are fractional frequencies in ppm.
+
+import utime
+
+_TAU0 = 64              # shortest tau in seconds (MIN_POLL)
+_LEVELS = 8             # taus _TAU0 .. _TAU0 * 2^(_LEVELS - 1)
+_AVG = 16               # windows the variances are averaged over
+_MIN_N = 4              # windows a tau needs to count for the intercept
+
+# allandev -
+#   Allan and modified Allan deviation per tau. add() gets the offset
+#   of every update. levels() returns a list of (tau, adev, mdev, n)
+#   tuples, xpt() the intercept.
+class allandev:
+    def __init__(self):
+        self.last = None
+        self.ticks = 0
+        self.tau = [(_TAU0 << m) * 1000 for m in range(0, _LEVELS)]
+        # Current window: length in ms, phase advance in microseconds
+        # and the integral over the phase relative to its start (linear
+        # between the offsets, so unevenly spaced ones do not shift the
+        # mean while the oscillator runs off)
+        self.wlen = [0] * _LEVELS
+        self.wdx = [0] * _LEVELS
+        self.warea = [0.0] * _LEVELS
+        # Previous windows: frequency, length, phase advance and mean
+        # phase, and the frequency from the mean phases
+        self.py = [None] * _LEVELS
+        self.plen = [0] * _LEVELS
+        self.pdx = [0] * _LEVELS
+        self.pmean = [None] * _LEVELS
+        self.pu = [None] * _LEVELS
+        # Averaged variances and the number of windows in them
+        self.avar = [0.0] * _LEVELS
+        self.mvar = [0.0] * _LEVELS
+        self.n = [0] * _LEVELS
+
+    # add() -
+    #   offset is the offset measured at ticks_ms, slew what the client
+    #   slewed the clock by since the previous one (both in us).
+    def add(self, offset, slew, ticks):
+        if self.last is None:
+            self.last = offset
+            self.ticks = ticks
+            for m in range(0, _LEVELS):
+                self._restart(m)
+            return
+        dx = offset + slew - self.last
+        dt = utime.ticks_diff(ticks, self.ticks)
+        self.last = offset
+        self.ticks = ticks
+        for m in range(0, _LEVELS):
+            if dt <= 0:
+                self._reset(m)
+                continue
+            self.warea[m] += (2 * self.wdx[m] + dx) * dt / 2
+            self.wlen[m] += dt
+            self.wdx[m] += dx
+            tau = self.tau[m]
+            if self.wlen[m] > tau + (tau >> 1):
+                # A gap, or this tau is shorter than the poll interval
+                self._reset(m)
+            elif self.wlen[m] >= tau - (tau >> 2):
+                self._window(m)
+
+    # _window() -
+    #   Closes the window of level m and starts the next one.
+    def _window(self, m):
+        wlen = self.wlen[m] / 1000
+        y = self.wdx[m] / wlen
+        mean = self.warea[m] / self.wlen[m]
+        u = None
+        if self.pmean[m] is not None:
+            # The means are taken at the middle of their windows
+            u = (self.pdx[m] + mean - self.pmean[m]) * 2 \
+                / (self.plen[m] + wlen)
+        if u is not None and self.pu[m] is not None:
+            # The mean phase needs one window more, both start together
+            self.n[m] += 1
+            n = min(self.n[m], _AVG)
+            d = y - self.py[m]
+            self.avar[m] += (d * d / 2 - self.avar[m]) / n
+            d = u - self.pu[m]
+            self.mvar[m] += (d * d / 2 - self.mvar[m]) / n
+        self.py[m] = y
+        self.plen[m] = wlen
+        self.pdx[m] = self.wdx[m]
+        self.pmean[m] = mean
+        self.pu[m] = u
+        self._restart(m)
+
+    def _restart(self, m):
+        self.wlen[m] = 0
+        self.wdx[m] = 0
+        self.warea[m] = 0.0
+
+    # _reset() -
+    #   Drops the windows of level m that are not contiguous with the
+    #   next one, the averaged variances are kept.
+    def _reset(self, m):
+        self.py[m] = None
+        self.pmean[m] = None
+        self.pu[m] = None
+        self._restart(m)
+
+    def levels(self):
+        return [(self.tau[m] // 1000, self.avar[m] ** 0.5,
+                 self.mvar[m] ** 0.5, self.n[m]) for m in range(0, _LEVELS)]
+
+    # xpt() -
+    #   The tau in seconds with the lowest modified deviation, of those
+    #   with at least _MIN_N windows, or None if there are none. If the
+    #   deviation still falls at the longest such tau, the next longer
+    #   one is returned, which needs a longer poll interval to measure.
+    def xpt(self):
+        best = None
+        top = None
+        for m in range(0, _LEVELS):
+            if self.n[m] < _MIN_N:
+                continue
+            if best is None or self.mvar[m] < self.mvar[best]:
+                best = m
+            top = m
+        if best is None:
+            return None
+        if best == top and best < _LEVELS - 1:
+            best += 1
+        return self.tau[best] // 1000
@@ -1,126 +1,922 @@
 # ntpclient_base.py
 
-import sys
+# The clock filter, the selection and the statistics are imported when
+# the first client is created, so "import ntpclient" does not load
+# them.
+
 import usocket as socket
-import ustruct as struct
-from machine import RTC, Pin
+import uselect as select
 import uasyncio as asyncio
+import urandom as random
 import utime
 
+from .ntpclient_clock import default_clock
+
 # (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
 NTP_DELTA = 3155673600
 # (date(2000, 1, 1) - date(1970, 1, 1)).days * 24*60*60
 UNIX_DELTA = 946684800
+# NTP_DELTA split into 16 bit halves for small int arithmetic
+_NTP_DELTA_HI = NTP_DELTA >> 16
+_NTP_DELTA_LO = NTP_DELTA & 0xffff
 
 # Poll and adjust intervals
 MIN_POLL = 64           # never poll faster than every 32 seconds
 MAX_POLL = 1024         # default maximum poll interval
 ADJ_INTERVAL = 2        # interval in seconds to call adjtime()
 
-# time_add_us() -
-#   Adds a number of microseconds to a timestamp.
-#   Returns a timestamp.
+# Minimum round trip assumed for the root distance (RFC 5905 MINDISP)
+_MINDISP = 10000
+
+# Startup burst (iburst) configuration
+_BURST = 8              # number of samples to collect in a burst
+_BURST_TRIES = 10       # maximum number of requests sent in a burst
+_BURST_SPACING = 2      # seconds between burst requests
+_BURST_MAX_ERR = 10     # maximum standard error of the fitted frequency
+                        # in ppm for it to be used
+
+# Request matching configuration
+_PENDING = 4            # requests per server waiting for a reply
+_REPLY_MS = 500         # longest round trip a reply is taken for, the
+                        # delay of a later one is mostly queueing
+_XMT_RAND_BITS = 12     # random low bits of the transmit timestamp (the
+                        # ones below a microsecond)
+
+# Holdover and reconnect configuration
+_BACKOFF_MIN = 4        # seconds before the first retry of a failed poll
+_BACKOFF_MAX = 1024     # longest time between retries
+_HOLD_PHI = 15          # error growth in holdover in ppm if nothing
+                        # better is known (RFC 5905 PHI)
+
+# Broadcast mode configuration
+_BCAST_CAL = 4          # unicast samples to calibrate the one way delay
+_BCAST_RECAL = 16       # poll rounds between two calibrations
+_BCAST_WAIT = 130       # seconds to wait for a broadcast in a round
+                        # (two of ntpd's default 64 s broadcast interval)
+
+# Low latency receive (fast_rx) configuration
+_RX_GUARD_US = 2000     # open the receive window this long before the
+                        # earliest expected reply
+_RX_WINDOW_MS = 20      # maximum time to block the loop waiting for it
+_RX_RTT_AGE = 4         # shift for aging the minimum round trip upwards
+
+# Timestamps -
+#   Internally all timestamps are plain integers counting microseconds
+#   since the 2000-01-01 epoch. Adding and subtracting them is ordinary
+#   integer arithmetic and conversions from NTP fixed point are exact.
+
+# ntp_frac_to_us() -
+#   Converts a 32 bit NTP fraction, given as its upper and lower 16 bit
+#   halves, into microseconds.
 #
-#   Internally we use a struct tm based timestamp format, which is
-#   a tuple composed of (sec, usec) based on epoch 2000-01-01.
-def time_add_us(ts, us):
-    usec = ts[1] + us
-    if usec < 0:
-        usec = usec - 1000000
-    sec = ts[0] + int(usec / 1000000)
-    return (sec, usec % 1000000)
-
-# time_diff_us() -
-#   Subtracts ts2 from ts1.
-#   Returns the difference in microseconds.
-def time_diff_us(ts1, ts2):
-    return (ts1[0] - ts2[0]) * 1000000 + (ts1[1] - ts2[1])
+#   usec = frac * 10^6 / 2^32 = frac * 15625 / 2^26. Splitting the
+#   multiplication keeps every intermediate result below 2^30, so this
+#   stays in small int arithmetic on 32 bit ports and is exact (floor).
+def ntp_frac_to_us(hi, lo):
+    return (hi * 15625 + ((lo * 15625) >> 16)) >> 10
 
-# ntpclient -
-#   Class implementing the uasyncio based NTP client
-class ntpclient_base:
-    def __init__(self, host = 'pool.ntp.org', poll = MAX_POLL,
-                 max_startup_delta = 1, debug = False):
+# ntp_sec_2000() -
+#   Converts the 32 bit NTP seconds, given as upper and lower 16 bit
+#   halves, into seconds since 2000-01-01. The full 1900 based value
+#   does not fit into a small int, the 2000 based one does until 2034.
+def ntp_sec_2000(hi, lo):
+    return ((hi - _NTP_DELTA_HI) << 16) + (lo - _NTP_DELTA_LO)
+
+# _u16() -
+#   Reads a big endian 16 bit value from a buffer without allocating.
+def _u16(buf, ofs):
+    return (buf[ofs] << 8) | buf[ofs + 1]
+
+# ntp_to_us() -
+#   Converts the 64 bit NTP timestamp at offset ofs in buf into
+#   microseconds since 2000-01-01.
+def ntp_to_us(buf, ofs):
+    return (ntp_sec_2000(_u16(buf, ofs), _u16(buf, ofs + 2)) * 1000000
+            + ntp_frac_to_us(_u16(buf, ofs + 4), _u16(buf, ofs + 6)))
+
+# put_ntp() -
+#   Stores sec seconds since 2000-01-01 and usec microseconds as 64 bit
+#   NTP timestamp at offset ofs in buf and returns buf. Like the other
+#   conversions it stays within small ints and does not allocate. From
+#   2036-02-07 on the seconds wrap into the next NTP era, which is what
+#   the timestamp holds then; a clock set that far ahead by mistake must
+#   still be able to send its requests to be corrected.
+def put_ntp(buf, ofs, sec, usec):
+    hi = (sec >> 16) + _NTP_DELTA_HI
+    lo = (sec & 0xffff) + _NTP_DELTA_LO
+    if lo > 0xffff:
+        lo -= 0x10000
+        hi += 1
+    hi &= 0xffff
+    # frac = usec * 2^32 / 10^6 = (usec << 10) * 2^16 / 15625
+    fhi = (usec << 10) // 15625
+    flo = (((usec << 10) - fhi * 15625) << 16) // 15625
+    buf[ofs] = hi >> 8
+    buf[ofs + 1] = hi & 0xff
+    buf[ofs + 2] = lo >> 8
+    buf[ofs + 3] = lo & 0xff
+    buf[ofs + 4] = fhi >> 8
+    buf[ofs + 5] = fhi & 0xff
+    buf[ofs + 6] = flo >> 8
+    buf[ofs + 7] = flo & 0xff
+    return buf
+
+# ntp_short_to_us() -
+#   Converts a 16.16 NTP short format value (root delay and dispersion)
+#   given as its two 16 bit halves into microseconds.
+def ntp_short_to_us(hi, lo):
+    return hi * 1000000 + ((lo * 15625) >> 10)
+
+# fit_freq() -
+#   Least squares fit of the frequency error in ppm from a list of
+#   (ticks_ms, offset, delay) burst samples. Positive means our clock
+#   is slow. The quarter of the samples with the highest delay is
+#   dropped. Returns None if there are too few samples or the standard
+#   error of the fit is above _BURST_MAX_ERR.
+def fit_freq(samples):
+    samples = sorted(samples, key = lambda s: s[2])[:len(samples) * 3 // 4]
+    samples.sort(key = lambda s: s[0])
+    n = len(samples)
+    if n < _BURST // 2:
+        return None
+    t0 = samples[0][0]
+    o0 = samples[0][1]
+    ts = [utime.ticks_diff(s[0], t0) / 1000 for s in samples]
+    os = [s[1] - o0 for s in samples]
+    tm = sum(ts) / n
+    om = sum(os) / n
+    stt = 0.0
+    sto = 0.0
+    for i in range(0, n):
+        stt += (ts[i] - tm) * (ts[i] - tm)
+        sto += (ts[i] - tm) * (os[i] - om)
+    if stt == 0:
+        return None
+    freq = sto / stt
+    res = 0.0
+    for i in range(0, n):
+        r = os[i] - om - freq * (ts[i] - tm)
+        res += r * r
+    if (res / (n - 2) / stt) ** 0.5 > _BURST_MAX_ERR:
+        return None
+    return freq
+
+# readable -
+#   Awaitable that completes once the nonblocking socket sock has data,
+#   without reading it. This is what uasyncio's own streams wait on, for
+#   sockets that need recvfrom() to learn the sender's address.
+class readable:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __await__(self):
+        yield asyncio.core._io_queue.queue_read(self.sock)
+
+    __iter__ = __await__
+
+# ntppeer -
+#   One NTP server the client polls. Every peer has its own socket and
+#   receive buffer so that several of them can be polled concurrently.
+class ntppeer:
+    def __init__(self, host):
+        from .ntpclient_filter import clockfilter
         self.host = host
         self.sock = None
         self.addr = None
+        # Index into the addresses of host to use next and the number of
+        # them that failed since the last lookup
+        self.addr_idx = 0
+        self.addr_fails = 0
         self.rstr = None
         self.wstr = None
+        self.rbuf = bytearray(48)
+        # Requests waiting for a reply, see _send_request()
+        self.pending = []
+        self.filter = clockfilter()
+        # Minimum round trip in microseconds (0 = unknown) and the state
+        # of the low latency receive: rx_wait is set while the reply may
+        # be taken by _rx_spin(), which stores its length and arrival
+        # ticks in rx_n and rx_ticks. Only while rx_wait is set and
+        # nothing was read yet the socket is registered with the
+        # client's poller.
+        self.rtt_min = 0
+        self.rx_wait = False
+        self.rx_n = None
+        self.rx_ticks = 0
+        # Server information from the last reply, in microseconds, and
+        # its leap indicator
+        self.leap = 0
+        self.stratum = 0
+        self.precision = 0
+        self.rootdelay = 0
+        self.rootdisp = 0
+        # Broadcast mode (see ntpclient_bcast): one way delay in
+        # microseconds (0 = not calibrated), poll rounds since it was
+        # calibrated, highest adjustment independent offset of recent
+        # broadcasts and their samples not yet used by a poll round.
+        self.bdelay = 0
+        self.brounds = 0
+        self.boff_max = None
+        self.bsamples = []
+
+    def reset(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.addr = None
+        self.pending = []
+        self.addr_idx += 1
+        self.addr_fails += 1
+        self.rtt_min = 0
+        self.bdelay = 0
+        self.boff_max = None
+
+    # header() -
+    #   Takes the server information from the header of a reply or
+    #   broadcast in buf.
+    def header(self, buf):
+        self.leap = buf[0] >> 6
+        self.stratum = buf[1]
+        prec = buf[3] - 256 if buf[3] > 127 else buf[3]
+        self.precision = 1000000 >> -prec if prec < 0 else 1000000 << prec
+        self.rootdelay = ntp_short_to_us(_u16(buf, 4), _u16(buf, 6))
+        self.rootdisp = ntp_short_to_us(_u16(buf, 8), _u16(buf, 10))
+
+    # rootdist() -
+    #   Root distance of a filtered sample, the maximum error of the
+    #   server's time as seen by us.
+    def rootdist(self, delay, disp, jitter):
+        return max(_MINDISP, delay + self.rootdelay) // 2 + self.rootdisp \
+               + disp + jitter
+
+# ntpclient -
+#   Class implementing the uasyncio based NTP client
+class ntpclient_base:
+    def __init__(self, host = 'pool.ntp.org', poll = MAX_POLL,
+                 max_startup_delta = 1, iburst = False, fast_rx = True,
+                 dns = None, broadcast = None, clock = None, debug = False):
+        # host can be a single server or a list of servers. All of them
+        # are polled concurrently in every round. A name can be listed
+        # more than once to use several addresses of a pool.
+        if isinstance(host, str):
+            host = [host]
+        self.peers = [ntppeer(h) for h in host]
+        for i in range(0, len(host)):
+            self.peers[i].addr_idx = host[:i].count(host[i])
+        # Caching resolver, see ntpclient_dns. It is created on the
+        # first lookup.
+        self.dns = None
+        self.dns_server = dns
         self.req_poll = poll
         self.poll = MIN_POLL
         self.max_startup_delta = int(max_startup_delta * 1000000)
-        self.rtc = RTC()
+        # Clock backend, see ntpclient_clock
+        if clock is None:
+            clock = default_clock()
+        self.clock = clock
+        self.iburst = iburst
+        self.fast_rx = fast_rx
         self.debug = debug
+        self.sys_jitter = 0
+        self.sys_peer = None
+        self.sys_delay = 0
+        # What the system peer says about its own time source, for
+        # serving time (see ntpclient_server): our stratum, the root
+        # delay and dispersion in microseconds and the reference id.
+        self.sys_stratum = 16
+        self.sys_rootdelay = 0
+        self.sys_rootdisp = 0
+        self.sys_refid = b'INIT'
+        # Leap indicator most of the servers announce (1 inserts a
+        # second at the end of the month, 2 deletes one), and the leap
+        # the client armed, see ntpclient_core._leap_check(): 0 or the
+        # indicator, and the first second of the next month (seconds
+        # since 2000-01-01). leaps counts the leaps applied, leap_done
+        # is the time of the last one.
+        self.sys_leap = 0
+        self.leap = 0
+        self.leap_at = None
+        self.leaps = 0
+        self.leap_done = None
+        # utime.time() of the last successful poll round, None before
+        self.sync_time = None
+        # Holdover state: set while the servers do not answer, with the
+        # poll interval from before and the number of failed rounds.
+        self.holdover = False
+        self.hold_poll = MIN_POLL
+        self.fails = 0
+        # Counters and update history, see ntpclient_stats
+        from .ntpclient_stats import stats
+        self.stats = stats()
+        # Selection of the servers that agree, see ntpclient_select
+        from .ntpclient_select import select_offset
+        self._select_offset = select_offset
+        # Frequency error in ppm fitted from the last burst, if any
+        self.burst_freq = None
+        # Total phase correction in microseconds the client has applied
+        # to the clock (steps and slew, not counting the slew that only
+        # compensates the frequency error). The clock filters use this
+        # to keep older samples current.
+        self.adj_total = 0
+
+        # Preallocated request packet. The request never changes, so it
+        # is built once. Replies are read into the peer's rbuf, so a poll
+        # does not create any new buffers or slices that the GC would
+        # have to clean up in the middle of a timed round trip.
+        self._wbuf = bytearray(48)
+        self._wbuf[0] = 0b00011011
+        self._poller = select.poll()
+
+        # Time base for applications, see ticks_to_epoch()
+        self._tb_ticks = 0
+        self._tb_sec = 0
+        self._tb_usec = 0
+        self._tb_slew = 0
+        self._tb_ahead = 0
+        self._tb_freq = 0.0
+        self._tb_buf = [0, 0]
+        self._tb_update(0)
+        # Deadline scheduler, created on first use
+        self.sched = None
+        # NTP server for other devices, see serve()
+        self.server = None
+        # Broadcast/multicast listener, see ntpclient_bcast. It is only
+        # loaded when it is used.
+        self.bcast = None
+        if broadcast:
+            from .ntpclient_bcast import bcastlistener
+            self.bcast = bcastlistener(self, None if broadcast is True
+                                       else broadcast)
 
         asyncio.create_task(self._poll_task())
         asyncio.create_task(self._adj_task())
 
-    async def _poll_server(self):
+    # _tb_update() -
+    #   Re-anchors the time base to the clock. slew is the adjustment
+    #   that is handed to the clock backend right after this, which
+    #   slews it in at 1/64 of the elapsed time if it is an adjtime()
+    #   style one. Called every ADJ_INTERVAL and after the clock was set.
+    def _tb_update(self, slew):
+        self._tb_ticks, self._tb_sec, self._tb_usec = self.clock.anchor()
+        self._tb_slew = slew if self.clock.slews else 0
+
+    # adj_at() / adj_now() -
+    #   adj_total as of the ticks_us() value ticks (up to a few minutes
+    #   ago) or now. The clock is only adjusted now and then, with the
+    #   frequency correction for the next while slewed in ahead by
+    #   _tb_ahead. In between it runs off at the _tb_freq ppm being
+    #   corrected, which counts as an adjustment as well, so that
+    #   offsets measured at different times stay comparable.
+    def adj_at(self, ticks):
+        dt = utime.ticks_diff(ticks, self._tb_ticks)
+        return self.adj_total + self._tb_ahead \
+               - int(self._tb_freq * dt / 1000000)
+
+    def adj_now(self):
+        return self.adj_at(utime.ticks_us())
+
+    # _slew_left() -
+    #   What the clock still has to slew of the last adjustment, as the
+    #   clock backend reports it. Only for a backend that can not tell
+    #   it is worked out from the 1/64 slew rate since the time base was
+    #   anchored with the adjustment.
+    def _slew_left(self):
+        left = self.clock.remaining()
+        if left is not None:
+            return left
+        left = self._tb_slew
+        if left != 0:
+            done = utime.ticks_diff(utime.ticks_us(), self._tb_ticks) >> 6
+            if left > 0:
+                left -= min(done, left)
+            else:
+                left += min(done, -left)
+        return left
+
+    # _step() -
+    #   Steps the clock by delta microseconds. The time base and the
+    #   deadlines of the scheduler follow, the frequency part of the
+    #   last adjustment still in progress (see adj_at()) is carried
+    #   over.
+    def _step(self, delta):
+        ahead = self.adj_now() - self.adj_total
+        self.clock.set_time_us(self.clock.time_us() + delta)
+        self._tb_update(self._slew_left())
+        self._tb_ahead = ahead
+        if self.sched is not None:
+            self.sched.stepped()
+
+    # ticks_to_epoch() -
+    #   Converts a ticks_us() value taken up to a few minutes ago into
+    #   the time. Returns microseconds since 2000-01-01, or if out is a
+    #   list (or array) of two, stores seconds and microseconds in it
+    #   and returns out. Only the latter stays within small ints and so
+    #   does not allocate.
+    def ticks_to_epoch(self, ticks, out = None):
+        dt = utime.ticks_diff(ticks, self._tb_ticks)
+        slew = self._tb_slew
+        if dt > 0 and slew != 0:
+            if slew > 0:
+                dt += min(dt >> 6, slew)
+            else:
+                dt -= min(dt >> 6, -slew)
+        usec = self._tb_usec + dt
+        sec = self._tb_sec + usec // 1000000
+        usec %= 1000000
+        if out is None:
+            return sec * 1000000 + usec
+        out[0] = sec
+        out[1] = usec
+        return out
+
+    # now_us() -
+    #   The current time like ticks_to_epoch(), without touching the RTC.
+    def now_us(self, out = None):
+        return self.ticks_to_epoch(utime.ticks_us(), out)
+
+    # now_ntp() -
+    #   Stores the current time as 64 bit NTP timestamp at offset ofs in
+    #   buf and returns buf. Does not allocate.
+    def now_ntp(self, buf, ofs = 0):
+        tb = self.ticks_to_epoch(utime.ticks_us(), self._tb_buf)
+        return put_ntp(buf, ofs, tb[0], tb[1])
+
+    # sleep_until() / every() -
+    #   Precise scheduling on the time base, see ntpclient_sched. The
+    #   scheduler is only loaded when an application uses it.
+    def _scheduler(self):
+        if self.sched is None:
+            from .ntpclient_sched import scheduler
+            self.sched = scheduler(self)
+        return self.sched
+
+    # export_stats() -
+    #   Starts sending the stats record to dest every interval seconds,
+    #   see ntpclient_stats.exporter().
+    def export_stats(self, dest, interval = 60, ident = b''):
+        from .ntpclient_stats import exporter
+        return asyncio.create_task(exporter(self, dest, interval, ident))
+
+    # est_error() -
+    #   Estimated maximum error of the clock in microseconds, or None
+    #   before the first successful poll. In holdover the error grows
+    #   with the time since the last successful poll.
+    def est_error(self):
+        if self.sync_time is None:
+            return None
+        err = self.sys_jitter
+        if self.holdover:
+            err += int(self._hold_rate() * (utime.time() - self.sync_time))
+        return err
+
+    # _hold_rate() -
+    #   How fast the error grows without updates, in ppm. Ports with a
+    #   frequency stability estimate override this.
+    def _hold_rate(self):
+        return _HOLD_PHI
+
+    # _backoff_ms() -
+    #   Milliseconds to wait before the next poll round after fails
+    #   failed ones in a row. The interval doubles with every failure
+    #   up to _BACKOFF_MAX and only its lower half is fixed, the rest
+    #   is random. So a fleet of clients that lost the server at the
+    #   same time does not keep retrying in lockstep.
+    def _backoff_ms(self, fails):
+        b = min(_BACKOFF_MIN << min(fails, 10), _BACKOFF_MAX) * 500
+        return b + random.getrandbits(20) % (b + 1)
+
+    # _hold() -
+    #   Called after a failed poll round. The first failure after a
+    #   successful round enters holdover: the clock keeps being slewed
+    #   with the learned frequency, and the poll interval is kept so
+    #   it can be returned to once the servers answer again.
+    def _hold(self):
+        self.fails += 1
+        if not self.holdover and self.sync_time is not None:
+            self.holdover = True
+            self.hold_poll = self.poll
+            if self.debug:
+                print("ntpclient: entering holdover")
+
+    # _resume() -
+    #   Called after a successful poll round, ends holdover.
+    def _resume(self):
+        self.fails = 0
+        self.sync_time = utime.time()
+        if self.holdover:
+            self.holdover = False
+            self.poll = self.hold_poll
+            if self.debug:
+                print("ntpclient: holdover ended, poll", self.poll)
+
+    # serve() -
+    #   Starts answering NTP requests from other devices on port with
+    #   the time of this client, see ntpclient_server. The server is
+    #   only loaded when it is used. In broadcast mode on the same port
+    #   it shares the socket of the broadcast listener.
+    def serve(self, port = 123, **kwargs):
+        from .ntpclient_server import ntpserver
+        if self.bcast is not None and self.bcast.port == port:
+            self.server = ntpserver(self, port, sock = self.bcast.sock,
+                                    **kwargs)
+            self.bcast.server = self.server
+        else:
+            self.server = ntpserver(self, port, **kwargs)
+        return self.server
+
+    def sleep_until(self, ts):
+        return self._scheduler().sleep_until(ts)
+
+    def every(self, period, phase, cb):
+        return self._scheduler().every(period, phase, cb)
+
+    # _resolver() -
+    #   The client's caching resolver, see ntpclient_dns. It is only
+    #   loaded when a host name has to be looked up.
+    def _resolver(self):
+        if self.dns is None:
+            from .ntpclient_dns import resolver
+            self.dns = resolver(self.dns_server, self.debug)
+        return self.dns
+
+    # _peer_addr() -
+    #   Returns the address to connect peer to. All addresses of its host
+    #   are kept and taken in turn, every reset moves on to the next one.
+    #   Only after all of them failed is the host looked up again (which
+    #   gives other addresses for a pool). Addresses other peers of the
+    #   same host are connected to are skipped if possible.
+    async def _peer_addr(self, peer):
+        addrs = await self._resolver().resolve(peer.host)
+        if peer.addr_fails >= len(addrs):
+            self.dns.expire(peer.host)
+            peer.addr_fails = 0
+            addrs = await self.dns.resolve(peer.host)
+        used = [p.addr for p in self.peers
+                if p is not peer and p.host == peer.host]
+        for i in range(0, len(addrs)):
+            addr = (addrs[peer.addr_idx % len(addrs)], 123)
+            if addr not in used:
+                break
+            peer.addr_idx += 1
+        return addr
+
+    # _send_request() -
+    #   Sends a request to peer and records it in the peer's table of
+    #   pending requests. The transmit timestamp is our time with the
+    #   bits below the microsecond random, so it is unique and hard to
+    #   guess. The server returns it as the origin timestamp of its
+    #   reply, which is what _recv_reply() matches replies by.
+    async def _send_request(self, peer):
         # We try to stay with the same server as long as possible. Only
-        # lookup the address on startup or after errors.
-        if self.sock is None:
-            self.addr = socket.getaddrinfo(self.host, 123)[0][-1]
+        # pick an address on startup or after errors. The lookup happens
+        # before anything is timed and is cached, see ntpclient_dns.
+        if peer.sock is None:
+            peer.addr = await self._peer_addr(peer)
             if self.debug:
-                print("ntpclient: new server address:", self.addr)
+                print("ntpclient: new server address:", peer.addr)
 
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.connect(self.addr)
+            peer.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            peer.sock.setblocking(False)
+            peer.sock.connect(peer.addr)
 
-            self.rstr = asyncio.StreamReader(self.sock)
-            self.wstr = asyncio.StreamWriter(self.sock)
+            peer.rstr = asyncio.StreamReader(peer.sock)
+            peer.wstr = asyncio.StreamWriter(peer.sock)
+
+        # The oldest request gives way when the table is full
+        if len(peer.pending) >= _PENDING:
+            peer.pending.pop(0)
+            self.stats.timeouts += 1
+
+        # Anchor the clock to ticks_us() before anything time critical
+        # happens, the receive time is then derived from ticks alone.
+        # The table entry is complete but for the send time before that.
+        anchor = self.clock.anchor()
+        wbuf = self._wbuf
+        self.now_ntp(wbuf, 40)
+        r = random.getrandbits(_XMT_RAND_BITS)
+        wbuf[46] = (wbuf[46] & 0xf0) | (r >> 8)
+        wbuf[47] = r & 0xff
+        req = [_u16(wbuf, 40), _u16(wbuf, 42), _u16(wbuf, 44),
+               _u16(wbuf, 46), 0, anchor]
+        peer.pending.append(req)
 
         # Send the NTP v3 request to the server
-        wbuf = bytearray(48)
-        wbuf[0] = 0b00011011
-        start_ticks = utime.ticks_us()
-        self.wstr.write(wbuf)
-        await self.wstr.drain()
-
-        # Get the server reply
-        try:
-            rbuf = await asyncio.wait_for(self.rstr.read(48), 0.5)
-        except asyncio.TimeoutError:
-            raise Exception("timeout receiving from server")
+        self.stats.polls += 1
+        req[4] = utime.ticks_us()
+        peer.wstr.write(wbuf)
+        await peer.wstr.drain()
+
+    # _drain() -
+    #   Drops whatever is queued on the socket of peer. Nothing is
+    #   waiting for it, so it can not be timestamped.
+    def _drain(self, peer):
+        if peer.sock is None:
+            return
+        while True:
+            try:
+                n = peer.sock.readinto(peer.rbuf)
+            except OSError:
+                break
+            if n is None:
+                break
+            self.stats.stale += 1
+
+    # _match() -
+    #   Removes the pending request of peer the reply in rbuf answers
+    #   (n bytes long) from its table and returns it, or returns None.
+    #   A duplicate of a reply finds its request gone.
+    def _match(self, peer, n):
+        if n != 48:
+            return None
+        rbuf = peer.rbuf
+        for req in peer.pending:
+            if _u16(rbuf, 24) == req[0] and _u16(rbuf, 26) == req[1] \
+               and _u16(rbuf, 28) == req[2] and _u16(rbuf, 30) == req[3]:
+                peer.pending.remove(req)
+                return req
+        return None
+
+    # _recv_reply() -
+    #   Waits up to ms milliseconds for the reply to one of the pending
+    #   requests of peer. Anything that answers none of them (a reply
+    #   to a request the table gave up on, a duplicate or a spoofed
+    #   packet) is dropped, and so is a reply that took _REPLY_MS or
+    #   longer. fast is set when the last request was just sent.
+    #   Returns (delay, delta, t2) like _reply() or None on timeout.
+    async def _recv_reply(self, peer, ms, fast = False):
+        start = utime.ticks_ms()
 
+        # With fast_rx and a known round trip, sleep until just before
+        # the reply can arrive and then block the loop polling for it,
+        # so no other task can delay the receive timestamp.
+        peer.rx_n = None
+        if fast and self.fast_rx and peer.rtt_min > 0:
+            peer.rx_wait = True
+            self._poller.register(peer.sock, select.POLLIN)
+            try:
+                wait_ms = (peer.rtt_min - _RX_GUARD_US) // 1000
+                if wait_ms > 0:
+                    await asyncio.sleep_ms(wait_ms)
+                if peer.rx_n is None:
+                    self._rx_spin(peer)
+            finally:
+                peer.rx_wait = False
+                if peer.rx_n is None:
+                    self._poller.unregister(peer.sock)
+
+        while True:
+            if peer.rx_n is not None:
+                n = peer.rx_n
+                recv_ticks = peer.rx_ticks
+                peer.rx_n = None
+            else:
+                # Get the server reply the regular way
+                remain = ms - utime.ticks_diff(utime.ticks_ms(), start)
+                if remain <= 0:
+                    return None
+                try:
+                    n = await asyncio.wait_for_ms(
+                            peer.rstr.readinto(peer.rbuf), remain)
+                except asyncio.TimeoutError:
+                    return None
+                recv_ticks = utime.ticks_us()
+                if n is None:
+                    continue
+            req = self._match(peer, n)
+            if req is not None \
+               and utime.ticks_diff(recv_ticks, req[4]) < _REPLY_MS * 1000:
+                return self._reply(peer, req, recv_ticks)
+            self.stats.stale += 1
+            if self.debug:
+                print("ntpclient: {}: dropped unexpected reply".format(
+                      peer.host))
+
+    # _reply() -
+    #   Evaluates the reply in the peer's receive buffer to the pending
+    #   request req, received at ticks_us() recv_ticks. Returns the
+    #   measurement as (delay, delta, t2) tuple, all in microseconds.
+    def _reply(self, peer, req, recv_ticks):
         # Record the microseconds it took for this NTP round trip
-        roundtrip_us = utime.ticks_diff(utime.ticks_us(), start_ticks)
-
-        # Record the current time as a (sec, usec) tuple
-        now = self.rtc.datetime()
-        dtnow = (now[0], now[1], now[2], now[4], now[5], now[6], 0, 0)
-        if sys.platform == 'esp32':
-            tnow = (utime.mktime(dtnow), now[7])
-        elif sys.platform == 'esp8266':
-            tnow = (utime.mktime(dtnow), now[7] * 1000)
+        roundtrip_us = utime.ticks_diff(recv_ticks, req[4])
+
+        # The receive time from the anchor
+        anchor = req[5]
+        tnow = anchor[1] * 1000000 + anchor[2] \
+               + utime.ticks_diff(recv_ticks, anchor[0])
+
+        # Track the minimum round trip, slowly aging it upwards so the
+        # receive window follows route changes.
+        if peer.rtt_min == 0 or roundtrip_us < peer.rtt_min:
+            peer.rtt_min = roundtrip_us
         else:
-            raise RuntimeError("unsupported platform '{}'".format(sys.platform))
+            peer.rtt_min += (roundtrip_us - peer.rtt_min) >> _RX_RTT_AGE
 
-        # Get the server's receive and send timestamps in (sec, frac)
-        # tuple format (epoch = 1900)
-        d1 = struct.unpack("!II", rbuf[32:40])
-        d2 = struct.unpack("!II", rbuf[40:48])
+        # Reject anything that isn't a server reply with usable time.
+        # Stratum 0 is a kiss-o'-death, leap indicator 3 means the
+        # server itself is not synchronized.
+        rbuf = peer.rbuf
+        if (rbuf[0] & 0x07) != 4 or (rbuf[0] >> 6) == 3 \
+           or not 0 < rbuf[1] < 16:
+            raise Exception("unusable reply from server")
+        self.stats.replies += 1
+        peer.header(rbuf)
 
-        # Extract the four relevant timestamp tuples from the reply
-        # t0 = client side transmit time (we actually sent 1900-01-01)
+        # Extract the server's receive (t1) and transmit (t2) timestamps
+        # straight from the receive buffer.
+        #
+        # t0 = client side transmit time (the origin timestamp, only
+        #      used to match the reply, the anchor is more precise)
         # t1 = server side receive time
         # t2 = server side transmit time
-        # t3 = client side receive time (based on that sent time ^^^^)
-        #t0 = (0,0)
-        t1 = (d1[0] - NTP_DELTA, int(d1[1] / 4294.967))
-        t2 = (d2[0] - NTP_DELTA, int(d2[1] / 4294.967))
-        #t3 = (0, roundtrip_us)
+        # t3 = client side receive time
+        t1 = ntp_to_us(rbuf, 32)
+        t2 = ntp_to_us(rbuf, 40)
 
         # Calculate the delay (round trip minus time spent on the server)
-        delay = (roundtrip_us - time_diff_us(t2, t1))
+        delay = roundtrip_us - (t2 - t1)
+
+        # Return the result of this measurement as (delay, delta, t2)
+        # tuple, all in microseconds.
+        return (delay, tnow - t2, t2)
+
+    # _rx_spin() -
+    #   Blocks for up to _RX_WINDOW_MS until a reply for peer arrives.
+    #   Replies for other peers waiting in their own window are read and
+    #   timestamped as well, so polling several servers concurrently
+    #   does not delay them. Only the sockets of those peers are
+    #   registered, and each leaves the poller once it got its datagram,
+    #   so a datagram nobody waits for can not keep ipoll() returning
+    #   right away.
+    def _rx_spin(self, peer):
+        start = utime.ticks_ms()
+        remain = _RX_WINDOW_MS
+        while remain > 0:
+            for ev in self._poller.ipoll(remain):
+                t = utime.ticks_us()
+                for p in self.peers:
+                    if p.sock is ev[0]:
+                        p.rx_ticks = t
+                        p.rx_n = p.sock.readinto(p.rbuf)
+                        if p.rx_n is not None:
+                            self._poller.unregister(p.sock)
+                        break
+            if peer.rx_n is not None:
+                return
+            remain = _RX_WINDOW_MS - utime.ticks_diff(utime.ticks_ms(),
+                                                      start)
+
+    def _reset_peer(self, peer):
+        self.stats.resets += 1
+        peer.reset()
+
+    async def _poll_peer(self, peer, tries, want = 1):
+        # Poll the server until it answered want times, sending at most
+        # tries requests, and shift the samples into the server's clock
+        # filter. A server that does not answer at all gets its
+        # connection reset. Returns the list of (ticks_ms, offset,
+        # delay) samples, with the offset in the filter's adjustment
+        # independent form.
+        #
+        # Requests are pipelined: the next one goes out _BURST_SPACING
+        # seconds after the last, whether that was answered or not, and
+        # until then a reply to any request still pending is taken. A
+        # burst so takes no longer than its spacing, without waiting
+        # out timeouts in between. The last request only gets
+        # _REPLY_MS.
+        samples = []
+        self._drain(peer)
+        peer.pending = []
+        for i in range(0, tries):
+            try:
+                await self._send_request(peer)
+            except Exception as ex:
+                print("ntpclient: {0}: {1}".format(peer.host, ex))
+                if i < tries - 1:
+                    await asyncio.sleep(_BURST_SPACING)
+                continue
+            window = _BURST_SPACING * 1000 if i < tries - 1 else _REPLY_MS
+            start = utime.ticks_ms()
+            fast = True
+            while len(samples) < want:
+                remain = window - utime.ticks_diff(utime.ticks_ms(), start)
+                try:
+                    current = await self._recv_reply(peer, remain, fast)
+                except Exception as ex:
+                    print("ntpclient: {0}: {1}".format(peer.host, ex))
+                    continue
+                finally:
+                    fast = False
+                if current is None:
+                    break
+                peer.addr_fails = 0
+                offset = current[0] // 2 - current[1]
+                adj = self.adj_now()
+                peer.filter.add(offset, current[0], peer.precision, adj)
+                samples.append((utime.ticks_ms(), offset + adj, current[0]))
+            if len(samples) >= want:
+                break
+        # Whatever is still pending has timed out
+        self.stats.timeouts += len(peer.pending)
+        if peer.pending:
+            print("ntpclient: {}: {} requests timed out".format(
+                  peer.host, len(peer.pending)))
+        peer.pending = []
+        if not samples:
+            self._reset_peer(peer)
+        elif self.bcast is not None:
+            # Every unicast exchange calibrates the broadcast delay
+            peer.bdelay = max(min([s[2] for s in samples]) // 2, 1)
+            peer.brounds = 0
+        return samples
+
+    def _poll_peer_burst(self, peer, tries):
+        # In broadcast mode a server with a calibrated delay is not
+        # polled, the round uses its broadcasts since the last one.
+        # Every _BCAST_RECAL rounds, after a reset and in holdover it
+        # gets polled again, which renews the calibration.
+        if self.bcast is not None and peer.bdelay != 0 \
+           and peer.brounds < _BCAST_RECAL and not self.holdover:
+            peer.brounds += 1
+            return self.bcast.samples(peer, _BCAST_WAIT)
+        # New connections (at startup and after a reset) start with a
+        # quick burst of requests when iburst is enabled. That fills the
+        # clock filter right away and gives a first frequency estimate.
+        if self.iburst and not self.holdover and peer.sock is None:
+            return self._poll_peer(peer, _BURST_TRIES, _BURST)
+        if self.bcast is not None and not self.holdover:
+            return self._poll_peer(peer, tries + _BCAST_CAL - 1, _BCAST_CAL)
+        return self._poll_peer(peer, tries)
+
+    async def _poll_round(self, tries = 3):
+        # Poll all servers concurrently, so a round takes no longer than
+        # polling a single one. Then select the offset of our clock from
+        # the filtered samples of the servers that agree on the time.
+        # The offset is positive when our clock is behind. In holdover
+        # every server only gets a single probe per round.
+        if self.holdover:
+            tries = 1
+        res = await asyncio.gather(*[self._poll_peer_burst(p, tries)
+                                     for p in self.peers])
+        cands = []
+        cands_delay = []
+        peers = []
+        for i in range(0, len(res)):
+            if not res[i]:
+                continue
+            peer = self.peers[i]
+            f = peer.filter.select(self.adj_now())
+            cands.append((f[0], peer.rootdist(f[1], f[2], f[3]), f[3]))
+            cands_delay.append(f[1])
+            peers.append(peer)
+        if not cands:
+            self.stats.errors += 1
+            self._hold()
+            raise Exception("{0}/{0} packets lost".format(tries))
+
+        sel = self._select_offset(cands)
+        if sel is None:
+            self.stats.errors += 1
+            self._hold()
+            raise Exception("no majority of servers agrees on the time")
+
+        # Estimate the frequency error from the servers that survived
+        # and sent a burst.
+        self.burst_freq = None
+        freqs = [fit_freq(res[self.peers.index(peers[i])])
+                 for i in sel[2]]
+        freqs = [f for f in freqs if f is not None]
+        if freqs:
+            self.burst_freq = sum(freqs) / len(freqs)
+        if self.debug and len(sel[2]) < len(cands):
+            print("ntpclient: servers not used this round:",
+                  [peers[i].host for i in range(0, len(peers))
+                   if i not in sel[2]])
+
+        peer = peers[sel[2][0]]
+        self.sys_peer = peer.host
+        self.sys_delay = cands_delay[sel[2][0]]
+        self.sys_stratum = peer.stratum + 1
+        self.sys_rootdelay = peer.rootdelay + self.sys_delay
+        self.sys_rootdisp = peer.rootdisp
+        self.sys_refid = bytes(int(b) for b in peer.addr[0].split('.'))
+        leaps = [peers[i].leap for i in sel[2]]
+        self.sys_leap = 0
+        for li in (1, 2):
+            if leaps.count(li) * 2 > len(leaps):
+                self.sys_leap = li
+        self._resume()
 
-        # Return the result of this measurement as (delay, delta, ts2)
-        # tuple. Delay and delta are in microseconds, ts2 is (sec, usec).
-        return (delay, time_diff_us(tnow, t2), t2)
+        # The system jitter combines the disagreement between the
+        # servers with the filter jitter of the best one.
+        peer_jitter = cands[sel[2][0]][2]
+        self.sys_jitter = int((sel[1] * sel[1]
+                               + peer_jitter * peer_jitter) ** 0.5)
+        return sel[0]
 
     async def _poll_task(self):
-        # Needs to be implemented per platform
+        # Implemented by the engine, see ntpclient_core
         pass
 
     async def _adj_task(self):
-        # Needs to be implemented per platform
+        # Implemented by the engine, see ntpclient_core
         pass
@@ -0,0 +1,141 @@
+# ntpclient_bcast.py
+#
+# Broadcast and multicast client mode. Instead of every device polling
+# the server, the server sends its time to the whole segment every
+# minute or so (ntpd's broadcast and manycast/multicast modes):
+#
+#   client = ntpclient.ntpclient(host = '192.168.1.1', broadcast = True)
+#   client = ntpclient.ntpclient(host = '192.168.1.1',
+#                                broadcast = '224.0.1.1')
+#
+# A broadcast only carries the server's transmit timestamp, the one way
+# delay from the server has to be known to turn it into an offset. It
+# is calibrated with regular unicast exchanges with the same server
+# (half of the lowest round trip), which ntpclient_base repeats every
+# _BCAST_RECAL poll rounds. Broadcasts are only taken from the
+# addresses of the configured servers, everything else on the port is
+# ignored.
+#
+# Received broadcasts go into the server's clock filter like unicast
+# samples, with the delay raised by how much later than the earliest
+# recent one the broadcast arrived. So the filter still prefers the
+# samples that were queued the least.
+#
+# The listener owns port 123. When the board also serves time (see
+# ntpclient_server) the server answers on the listener's socket, and
+# the listener hands it the client requests (mode 3) it receives.
+
+import usocket as socket
+import uasyncio as asyncio
+import utime
+
+from .ntpclient_base import readable, ntp_to_us
+
+_BCAST_LEN = 48
+_BCAST_AGE = 4          # shift for aging the earliest arrival upwards
+_BCAST_KEEP = 8         # broadcasts kept per server between two rounds
+
+# bcastlistener -
+#   Receives the broadcasts of client's servers on port. group is a
+#   multicast group address to join, or None for plain broadcasts. The
+#   counters are the broadcasts used and the packets ignored. server is
+#   the ntpserver sharing the socket, if any.
+class bcastlistener:
+    def __init__(self, client, group = None, port = 123):
+        self.client = client
+        self.port = port
+        self.server = None
+        self.received = 0
+        self.ignored = 0
+        self._ev = asyncio.Event()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', port))
+        if group is not None:
+            mreq = bytes(int(b) for b in group.split('.')) + bytes(4)
+            self.sock.setsockopt(socket.IPPROTO_IP,
+                                 socket.IP_ADD_MEMBERSHIP, mreq)
+        self.sock.setblocking(False)
+        self._task = asyncio.create_task(self._listen())
+
+    def close(self):
+        self._task.cancel()
+        self.sock.close()
+
+    # samples() -
+    #   Returns the (ticks_ms, offset, delay) samples of the broadcasts
+    #   peer sent since the last call, in the form _poll_peer() returns
+    #   them. Waits up to timeout seconds for one if there are none
+    #   yet, an empty list means the server went quiet.
+    async def samples(self, peer, timeout):
+        start = utime.ticks_ms()
+        while not peer.bsamples:
+            remain = timeout * 1000 - utime.ticks_diff(utime.ticks_ms(),
+                                                       start)
+            if remain <= 0:
+                break
+            self._ev.clear()
+            try:
+                await asyncio.wait_for_ms(self._ev.wait(), remain)
+            except asyncio.TimeoutError:
+                break
+        res = peer.bsamples
+        peer.bsamples = []
+        return res
+
+    # _sample() -
+    #   Turns broadcast pkt from peer that arrived at ticks_us() t into
+    #   a sample in peer's clock filter.
+    def _sample(self, peer, pkt, t):
+        c = self.client
+        peer.header(pkt)
+        # Our offset is positive when our clock is behind: the server's
+        # transmit time plus the one way delay minus our receive time.
+        offset = peer.bdelay - (c.ticks_to_epoch(t) - ntp_to_us(pkt, 40))
+        # Track the earliest arrival relative to the server (the
+        # highest offset), aging it downwards so it follows the drift
+        # that adj_total does not cover and route changes.
+        adj = c.adj_now()
+        off = offset + adj
+        if peer.boff_max is None or off > peer.boff_max:
+            peer.boff_max = off
+        else:
+            peer.boff_max -= (peer.boff_max - off) >> _BCAST_AGE
+        delay = 2 * peer.bdelay + (peer.boff_max - off)
+
+        peer.filter.add(offset, delay, peer.precision, adj)
+        bs = peer.bsamples
+        if len(bs) >= _BCAST_KEEP:
+            del bs[0]
+        bs.append((utime.ticks_ms(), off, delay))
+        self.received += 1
+        self._ev.set()
+
+    async def _listen(self):
+        sock = self.sock
+        while True:
+            await readable(sock)
+            while True:
+                try:
+                    pkt, addr = sock.recvfrom(_BCAST_LEN)
+                except OSError:
+                    break
+                t = utime.ticks_us()
+                if self.server is not None and len(pkt) > 0 \
+                   and (pkt[0] & 0x07) == 3:
+                    self.server.recv(pkt, addr)
+                    continue
+                peer = None
+                for p in self.client.peers:
+                    if p.addr is not None and p.addr[0] == addr[0]:
+                        peer = p
+                        break
+                # Only broadcasts (mode 5) with usable time from a
+                # calibrated server of ours
+                if peer is None or peer.bdelay == 0 \
+                   or len(pkt) < _BCAST_LEN or (pkt[0] & 0x07) != 5 \
+                   or (pkt[0] >> 6) == 3 or not 0 < pkt[1] < 16:
+                    self.ignored += 1
+                    continue
+                self._sample(peer, pkt, t)
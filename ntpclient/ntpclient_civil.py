@@ -0,0 +1,293 @@
+# ntpclient_civil.py
+#
+# Civil (wall clock) time: local time with time zone and daylight
+# saving from the client's UTC time base. The rules come as tables of
+# precomputed transitions, so the board only looks them up and never
+# evaluates a rule:
+#
+#   zone    list of (utc, offset, dst) tuples: from utc on (seconds
+#           since 2000-01-01) local time is offset minutes ahead of UTC,
+#           dst minutes of which are daylight saving time
+#   leaps   list of (utc, tai) tuples: from utc on TAI is tai seconds
+#           ahead of UTC
+#
+# Both can be loaded from a small binary file, see civil_pack() and
+# ntpclient_sim.tzfile, which builds one from the host's zoneinfo:
+#
+#   0       4s  magic b'NTPz'
+#   4       B   format version
+#   5       x   reserved
+#   6       H   number n of zone transitions
+#   8       H   number m of leap seconds
+#   10      2x  reserved
+#   12      n*8 zone transitions: i utc, h offset, h dst
+#   12+8n   m*8 leap seconds: i utc, i tai
+#
+# update() converts a time. The first time, or after a jump, that is a
+# full calendar computation. A time one second after the last one only
+# advances the fields that change, until the next zone transition.
+# While the client has a leap second announced (see
+# ntpclient_core._leap_task()) the inserted second reads 23:59:60.
+#
+#   civil = ntpclient_civil.civil(client, path = 'berlin.tz')
+#   tm = civil.update(client.now_us())
+#   print(civil.text_date(), civil.text_time())
+
+import array
+import ustruct as struct
+
+CIVIL_VERSION = 1
+
+_MAGIC = b'NTPz'
+_HEAD = '<4sBxHH2x'
+_HEAD_LEN = 12
+_ZONE = '<ihh'
+_LEAP = '<ii'
+_ENTRY_LEN = 8
+_NEVER = 0x7fffffff
+
+# Leap seconds since 2000. TAI - UTC was 32 s before the first.
+LEAPS = ((189388800, 33), (284083200, 34), (394416000, 35),
+         (489024000, 36), (536544000, 37))
+_TAI_2000 = 32
+
+_MDAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_D2 = ['{:02d}'.format(i) for i in range(0, 61)]
+
+# 2000-01-01 was a Saturday (localtime() weekday 5), and 2000-03-01,
+# day 60, starts a 400 year cycle of years counted from March.
+_WDAY_2000 = 5
+_MARCH_2000 = 60
+
+def _mlen(y, m):
+    if m == 2 and y % 4 == 0 and (y % 100 != 0 or y % 400 == 0):
+        return 29
+    return _MDAYS[m - 1]
+
+# civil_from_days() -
+#   Returns (year, month, day) of the day days after 2000-01-01.
+#   Counting years from March puts the leap day at the end, which
+#   keeps this to a few divisions (after H. Hinnant's algorithm).
+def civil_from_days(days):
+    z = days - _MARCH_2000
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + 3 if mp < 10 else mp - 9
+    return (2000 + era * 400 + yoe + (1 if m <= 2 else 0), m, d)
+
+# days_from_civil() -
+#   The inverse, days since 2000-01-01 of year, month and day.
+def days_from_civil(y, m, d):
+    if m <= 2:
+        y -= 1
+    era = (y - 2000) // 400
+    yoe = y - 2000 - era * 400
+    doy = (153 * (m - 3 if m > 2 else m + 9) + 2) // 5 + d - 1
+    return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy \
+           + _MARCH_2000
+
+# civil_pack() -
+#   Returns the binary table file for zone and leaps as bytes.
+def civil_pack(zone, leaps = LEAPS):
+    buf = bytearray(_HEAD_LEN + (len(zone) + len(leaps)) * _ENTRY_LEN)
+    struct.pack_into(_HEAD, buf, 0, _MAGIC, CIVIL_VERSION, len(zone),
+                     len(leaps))
+    ofs = _HEAD_LEN
+    for z in zone:
+        struct.pack_into(_ZONE, buf, ofs, z[0], z[1], z[2])
+        ofs += _ENTRY_LEN
+    for l in leaps:
+        struct.pack_into(_LEAP, buf, ofs, l[0], l[1])
+        ofs += _ENTRY_LEN
+    return bytes(buf)
+
+# civil_unpack() -
+#   Parses a table file. Returns (zone, leaps) or raises ValueError.
+def civil_unpack(buf):
+    if len(buf) < _HEAD_LEN or buf[:4] != _MAGIC:
+        raise ValueError("not a civil time table")
+    head = struct.unpack_from(_HEAD, buf)
+    if head[1] > CIVIL_VERSION:
+        raise ValueError("civil time table version {} - expected {}".format(
+                         head[1], CIVIL_VERSION))
+    n, m = head[2], head[3]
+    if len(buf) < _HEAD_LEN + (n + m) * _ENTRY_LEN:
+        raise ValueError("civil time table truncated")
+    ofs = _HEAD_LEN
+    zone = []
+    for i in range(0, n):
+        zone.append(struct.unpack_from(_ZONE, buf, ofs))
+        ofs += _ENTRY_LEN
+    leaps = []
+    for i in range(0, m):
+        leaps.append(struct.unpack_from(_LEAP, buf, ofs))
+        ofs += _ENTRY_LEN
+    return zone, leaps
+
+# _find() -
+#   Index of the last entry of the sorted array a that is <= v, -1 if
+#   there is none.
+def _find(a, v):
+    lo = 0
+    hi = len(a)
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if a[mid] <= v:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo - 1
+
+# civil -
+#   Wall clock of client (which may be None when only converting given
+#   times). Without a zone it shows UTC. update() returns a list like
+#   utime.localtime() returns a tuple, (year, month, mday, hour, minute,
+#   second, weekday, yearday). It is updated in place, so copy it to
+#   keep it. utcoff and dst are the offset from UTC in seconds and
+#   whether daylight saving time is in effect.
+class civil:
+    def __init__(self, client = None, zone = None, leaps = LEAPS,
+                 path = None):
+        self.client = client
+        if path is not None:
+            with open(path, 'rb') as fd:
+                zone, file_leaps = civil_unpack(fd.read())
+            if file_leaps:
+                leaps = file_leaps
+        zone = zone or ()
+        self.zt = array.array('i', [z[0] for z in zone])
+        self.zoff = array.array('h', [z[1] for z in zone])
+        self.zdst = array.array('h', [z[2] for z in zone])
+        self.lt = array.array('i', [l[0] for l in leaps])
+        self.ltai = array.array('h', [l[1] for l in leaps])
+        self.tm = [2000, 1, 1, 0, 0, 0, _WDAY_2000, 1]
+        self.utcoff = 0
+        self.dst = False
+        # UTC second of the fields in tm, and the next zone transition
+        # up to which tick() may advance them
+        self.last = None
+        self.limit = _NEVER
+        self._mdays = 31
+        self._date = None
+        self._time = None
+
+    # utc_offset() -
+    #   Offset of local time from UTC in seconds at utc (seconds since
+    #   2000-01-01).
+    def utc_offset(self, utc):
+        i = _find(self.zt, utc)
+        return self.zoff[i] * 60 if i >= 0 else 0
+
+    # tai_offset() -
+    #   TAI - UTC in seconds at utc.
+    def tai_offset(self, utc):
+        i = _find(self.lt, utc)
+        return self.ltai[i] if i >= 0 else _TAI_2000
+
+    # update() -
+    #   Converts ts (microseconds since 2000-01-01 like client.now_us())
+    #   to local time and returns the fields.
+    def update(self, ts):
+        sec = ts // 1000000
+        # The clock runs through an inserted second as the first second
+        # of the next day and is only stepped back at its end, a
+        # deleted second is stepped over at its start.
+        leap60 = False
+        c = self.client
+        if c is not None and c.leap_at is not None:
+            if c.leap == 1 and sec >= c.leap_at:
+                leap60 = sec == c.leap_at
+                sec -= 1
+            elif c.leap == 2 and sec >= c.leap_at - 1:
+                sec += 1
+        if self.last is not None and sec == self.last + 1 \
+           and sec < self.limit:
+            self.last = sec
+            self._tick()
+        elif sec != self.last or self.tm[5] == 60 and not leap60:
+            self._full(sec)
+        if leap60:
+            self.tm[5] = 60
+            self._time = None
+        return self.tm
+
+    # _tick() -
+    #   Advances the fields by one second, a 60th second included.
+    def _tick(self):
+        tm = self.tm
+        self._time = None
+        if tm[5] < 59:
+            tm[5] += 1
+            return
+        tm[5] = 0
+        if tm[4] < 59:
+            tm[4] += 1
+            return
+        tm[4] = 0
+        if tm[3] < 23:
+            tm[3] += 1
+            return
+        tm[3] = 0
+        self._date = None
+        tm[6] = (tm[6] + 1) % 7
+        tm[7] += 1
+        if tm[2] < self._mdays:
+            tm[2] += 1
+            return
+        tm[2] = 1
+        if tm[1] < 12:
+            tm[1] += 1
+        else:
+            tm[1] = 1
+            tm[0] += 1
+            tm[7] = 1
+        self._mdays = _mlen(tm[0], tm[1])
+
+    # _full() -
+    #   Computes all fields for the UTC second sec.
+    def _full(self, sec):
+        i = _find(self.zt, sec)
+        off = 0
+        self.dst = False
+        if i >= 0:
+            off = self.zoff[i] * 60
+            self.dst = self.zdst[i] != 0
+        self.utcoff = off
+        self.limit = self.zt[i + 1] if i + 1 < len(self.zt) else _NEVER
+        self.last = sec
+        local = sec + off
+        days = local // 86400
+        s = local - days * 86400
+        y, m, d = civil_from_days(days)
+        tm = self.tm
+        tm[0] = y
+        tm[1] = m
+        tm[2] = d
+        tm[3] = s // 3600
+        tm[4] = s // 60 % 60
+        tm[5] = s % 60
+        tm[6] = (days + _WDAY_2000) % 7
+        tm[7] = days - days_from_civil(y, 1, 1) + 1
+        self._mdays = _mlen(y, m)
+        self._date = None
+        self._time = None
+
+    # text_date() / text_time() -
+    #   The fields of the last update() as 'YYYY-MM-DD' and 'HH:MM:SS'.
+    #   The strings are only built again when their fields changed.
+    def text_date(self):
+        if self._date is None:
+            tm = self.tm
+            self._date = '{:04d}-{}-{}'.format(tm[0], _D2[tm[1]],
+                                               _D2[tm[2]])
+        return self._date
+
+    def text_time(self):
+        if self._time is None:
+            tm = self.tm
+            self._time = _D2[tm[3]] + ':' + _D2[tm[4]] + ':' + _D2[tm[5]]
+        return self._time
@@ -0,0 +1,132 @@
+# ntpclient_clock.py
+#
+# Clock backends. The engine (see ntpclient_core) only reads, sets and
+# slews the clock through one of these, so a board with another way of
+# adjusting its clock just needs another backend:
+#
+#   anchor()        reads the clock and ticks_us() back to back, see
+#                   rtc_anchor()
+#   time_us()       the clock in microseconds since 2000-01-01
+#   set_time_us(ts) steps the clock to ts
+#   slew(us)        corrects the clock by us, replacing what is left of
+#                   the previous correction
+#   remaining()     what is left of the previous correction in us, or
+#                   None if the clock can not tell, the engine then
+#                   estimates it from the slew rate
+#   slews           True if the correction is slewed in at 1/64 of the
+#                   elapsed time like adjtime() does, the client's time
+#                   base then interpolates it
+#
+#   client = ntpclient.ntpclient(clock = ntpclient_clock.calclock())
+#
+# Without a clock kwarg the backend of the board is used, see
+# default_clock().
+
+import utime
+
+# rtc.calibrate() units on the ESP8266
+_CAL_UNIT = 100         # microseconds per unit
+_CAL_MAX = 200          # maximum units per call
+
+# rtc_time_us() -
+#   Returns the current time of rtc in microseconds since 2000-01-01.
+#   subsec is the unit of the subseconds field of rtc.datetime() in
+#   microseconds.
+def rtc_time_us(rtc, subsec = 1):
+    r = rtc.datetime()
+    return (utime.mktime((r[0], r[1], r[2], r[4], r[5], r[6], 0, 0))
+            * 1000000 + r[7] * subsec)
+
+# rtc_anchor() -
+#   Reads rtc and ticks_us() back to back and returns them as a
+#   (ticks_us, sec, usec) tuple, seconds since 2000-01-01. The time at a
+#   later tick count t is then sec and usec + ticks_diff(t, ticks_us),
+#   without another calendar conversion. ticks_us() wraps after 2^30 us,
+#   so an anchor is only good for a few minutes.
+def rtc_anchor(rtc, subsec = 1):
+    r = rtc.datetime()
+    t = utime.ticks_us()
+    return (t, utime.mktime((r[0], r[1], r[2], r[4], r[5], r[6], 0, 0)),
+            r[7] * subsec)
+
+# _rtc_tuple() -
+#   The rtc.datetime() tuple for ts microseconds since 2000-01-01.
+def _rtc_tuple(ts, subsec):
+    tm = utime.localtime(ts // 1000000)
+    return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5],
+            ts % 1000000 // subsec)
+
+# adjclock -
+#   ESP32: microsecond RTC, slewed by utime.adjtime() (see
+#   esp32_adjtime.diff).
+class adjclock:
+    slews = True
+
+    def __init__(self):
+        from machine import RTC
+        self.rtc = RTC()
+
+    def anchor(self):
+        return rtc_anchor(self.rtc)
+
+    def time_us(self):
+        return rtc_time_us(self.rtc)
+
+    def set_time_us(self, ts):
+        self.rtc.init(_rtc_tuple(ts, 1))
+
+    def slew(self, us):
+        if us != 0:
+            utime.adjtime((0, us))
+
+    # remaining() -
+    #   adjtime() without an argument returns what is left to slew.
+    def remaining(self):
+        r = utime.adjtime()
+        return r[0] * 1000000 + r[1]
+
+# calclock -
+#   ESP8266: millisecond RTC, corrected by rtc.calibrate() in units of
+#   100 microseconds per call of at most _CAL_MAX units. What does not
+#   fit is left for the engine, which passes it back with the next
+#   correction like it does with what adjtime() has left. Slewing the ESP8266 RTC this
+#   way was never very reliable.
+class calclock:
+    slews = False
+
+    def __init__(self):
+        from machine import RTC
+        self.rtc = RTC()
+        self.todo = 0
+
+    def anchor(self):
+        return rtc_anchor(self.rtc, 1000)
+
+    def time_us(self):
+        return rtc_time_us(self.rtc, 1000)
+
+    def set_time_us(self, ts):
+        self.rtc.datetime(_rtc_tuple(ts, 1000))
+        self.todo = 0
+
+    def slew(self, us):
+        self.todo = us
+        cal = max(-_CAL_MAX, min(_CAL_MAX, int(self.todo / _CAL_UNIT)))
+        self.rtc.calibrate(cal)
+        self.todo -= cal * _CAL_UNIT
+
+    # remaining() -
+    #   What did not fit into the last calibration.
+    def remaining(self):
+        return self.todo
+
+# default_clock() -
+#   The backend for the board we are running on.
+def default_clock():
+    from sys import platform
+    if platform == 'esp32':
+        return adjclock()
+    if platform == 'esp8266':
+        return calclock()
+    raise RuntimeError("no clock backend for platform '{}', "
+                       "pass one as clock".format(platform))
@@ -0,0 +1,463 @@
+# ntpclient_core.py
+#
+# The client engine shared by all ports. It hands the offsets the
+# servers (or the PPS input) measure to the discipline engine and the
+# corrections that one computes to the clock backend, which is the only
+# part that differs between boards (see ntpclient_clock).
+#
+# Only what every client needs is imported here. The discipline engine,
+# the drift file code and the optional features are loaded when they
+# are used, which keeps the heap after "import ntpclient" small.
+
+import uasyncio as asyncio
+import utime
+
+from .ntpclient_base import ntpclient_base, MIN_POLL, ADJ_INTERVAL
+
+# Poll increment/decrement water marks
+_POLL_INC_AT = 50       # increase interval when the delta per second
+                        # falls below this number of microseconds
+_POLL_DEC_AT = 200      # decrease interval when the delta per second
+                        # grows above this number
+_POLL_PGATE = 4         # deltas within this many times the jitter are
+                        # considered measurement noise
+
+# Slew scheduling
+_SLEW_ERR_MIN = 100     # error in microseconds the clock may run off
+                        # between two adjustments at least
+_SLEW_ERR_DIV = 4       # by default the system jitter over this
+_ADJ_MAX = 256          # longest time between two adjustments (well
+                        # within the ticks_us() range of the time base)
+
+# State file configuration
+_STATE_SAVE_MIN = 3600  # minimum seconds between two saves (flash wear)
+_STATE_FREQ_DIFF = 0.1  # frequency change in ppm worth saving
+_HOLD_RATE_MIN = 0.1    # minimum error growth in holdover in ppm
+
+# ntpclient -
+#   Class implementing the uasyncio based NTP client. The discipline
+#   engine (see ntpclient_discipline) defaults to the PLL/FLL one.
+class ntpclient(ntpclient_base):
+    def __init__(self, drift_file = None, discipline = None, pps = None,
+                 pps_delay = 0, allan = True, slew_err = None, **base_args):
+        self.drift_file = drift_file
+        if discipline is None:
+            from .ntpclient_discipline import pllfll
+            discipline = pllfll()
+        self.disc = discipline
+        self.last_update = None
+        # Last adjustment handed to the clock backend and the sum of
+        # them since the last poll round
+        self.adj_last = 0
+        self.slew_sum = 0
+        # Slew scheduling, see _adj_task(): the error allowed between
+        # two adjustments (None follows the system jitter), the number
+        # of times the task woke up and the event that wakes it early
+        # after an update.
+        self.slew_err = slew_err
+        self.adj_wakeups = 0
+        self._adj_wake = asyncio.Event()
+        # Allan deviation of the oscillator, see ntpclient_allan. With
+        # it the poll interval follows the Allan intercept.
+        self.allan = None
+        if allan:
+            from .ntpclient_allan import allandev
+            self.allan = allandev()
+        # (freq, poll, sys_peer, utime.time()) of the last save. The
+        # time is the disciplined clock, ticks_ms() differences wrap
+        # after a few days of uptime.
+        self.saved = None
+
+        ntpclient_base.__init__(self, **base_args)
+
+        # PPS input, see ntpclient_pps. It is only loaded when it is used.
+        self.pps = None
+        if pps is not None:
+            from .ntpclient_pps import ppssource
+            self.pps = ppssource(self, pps, pps_delay)
+
+    def drift_save(self, force = False):
+        # This is called after every update. To spare the flash the
+        # state is only written when something changed and at most
+        # every _STATE_SAVE_MIN seconds, unless forced. A clock that was
+        # stepped back since the last save does not hold the next one
+        # off.
+        if self.drift_file is None:
+            return
+
+        freq, num = self.disc.save()
+        now = utime.time()
+        if not force and self.saved is not None:
+            if self.saved[1] == self.poll and self.saved[2] == self.sys_peer \
+               and abs(freq - self.saved[0]) < _STATE_FREQ_DIFF:
+                return
+            if 0 <= now - self.saved[3] < _STATE_SAVE_MIN:
+                return
+
+        import os
+        from .ntpclient_state import state_pack
+        try:
+            tmp = self.drift_file + '.tmp'
+            with open(tmp, 'wb') as fd:
+                fd.write(state_pack(freq, num, self.poll, self.sys_peer))
+            os.rename(tmp, self.drift_file)
+        except Exception as ex:
+            print("ntpclient: drift_save():", ex)
+            return
+        self.saved = (freq, self.poll, self.sys_peer, now)
+        if self.debug:
+            print("ntpclient: saved {}".format(self.drift_file))
+
+    def drift_load(self):
+        # Restores the frequency and, if the saved server is still one
+        # of ours, the poll interval. Text drift files of earlier
+        # versions are converted to the binary format once.
+        if self.drift_file is None:
+            return
+
+        from .ntpclient_state import state_unpack, state_parse_text
+        try:
+            with open(self.drift_file, 'rb') as fd:
+                buf = fd.read()
+            state = state_unpack(buf)
+            if state is None:
+                state = state_parse_text(buf, ADJ_INTERVAL)
+                if state is None:
+                    raise ValueError("unknown drift file format")
+                freq, num = state
+                poll = MIN_POLL
+                host = None
+                migrate = True
+            else:
+                freq, num, poll, host = state
+                migrate = False
+            del buf, state
+            if num > 0:
+                self.disc.load(freq, num)
+        except Exception as ex:
+            print("ntpclient: drift_load():", ex)
+            return
+
+        if host is not None and host in [p.host for p in self.peers]:
+            self.poll = min(max(poll, MIN_POLL), self.req_poll)
+            self.sys_peer = host
+        self.saved = (freq, self.poll, self.sys_peer, utime.time())
+        if migrate:
+            self.drift_save(force = True)
+        if self.debug:
+            print("ntpclient: loaded drift data {} ppm ({}) poll {}".format(
+                  freq, num, self.poll))
+
+    def _hold(self):
+        if not self.holdover and self.sync_time is not None:
+            self.disc.hold()
+        ntpclient_base._hold(self)
+
+    # est_error() -
+    #   Includes the offset that is still being slewed out.
+    def est_error(self):
+        err = ntpclient_base.est_error(self)
+        if err is not None:
+            err += int(abs(self.disc.phase))
+        return err
+
+    # _hold_rate() -
+    #   In holdover the clock runs with the last frequency, its error
+    #   grows with the wander of the frequency plus the floor of what
+    #   the discipline resolves.
+    def _hold_rate(self):
+        return self.disc.wander + _HOLD_RATE_MIN
+
+    # _slew_taken() -
+    #   Returns the slew the clock took since the last call. What the
+    #   last adjustment still has to slew counts for the next call.
+    def _slew_taken(self):
+        left = self._slew_left()
+        taken = self.slew_sum - left
+        self.slew_sum = left
+        return taken
+
+    # _poll_target() -
+    #   The poll interval to move towards: the Allan intercept, which
+    #   also becomes the discipline's PLL/FLL crossover, or None while
+    #   it is not known.
+    def _poll_target(self):
+        if self.allan is None:
+            return None
+        xpt = self.allan.xpt()
+        if xpt is not None and hasattr(self.disc, 'allan_xpt'):
+            self.disc.allan_xpt = max(xpt, MIN_POLL)
+        return xpt
+
+    # _update() -
+    #   Hands the offset delta of a source that delivers one every poll
+    #   seconds to the discipline engine, together with the time that
+    #   passed since the last one. Returns that time and whether the
+    #   state is worth saving.
+    def _update(self, delta, poll):
+        now = utime.ticks_ms()
+        mu = utime.ticks_diff(now, self.last_update) // 1000
+        self.last_update = now
+        if mu <= 0:
+            mu = 1
+        force = self.disc.update(delta, mu, poll)
+        self._adj_wake.set()
+        return mu, force
+
+    # _pps_sys() -
+    #   While the PPS disciplines the clock it is our reference, like a
+    #   stratum 0 reference clock in ntpd.
+    def _pps_sys(self):
+        self.sys_stratum = 1
+        self.sys_refid = b'PPS\0'
+        self.sys_rootdelay = 0
+        self.sys_rootdisp = 0
+        self.sys_jitter = self.pps.jitter
+
+    # _pps_update() -
+    #   Called by the PPS source with the offset of its last poll
+    #   seconds of edges.
+    def _pps_update(self, delta, poll):
+        mu, force = self._update(delta, poll)
+        self._pps_sys()
+        self.sync_time = utime.time()
+        self.drift_save(force)
+        self.stats.record(0, delta, self.sys_jitter, self.adj_last, poll)
+        if self.debug:
+            print("ntpclient: pps delta:", delta, "jitter:", self.sys_jitter,
+                  "freq:", self.disc.freq)
+
+    async def _poll_task(self):
+        # Try loading an existing drift file
+        self.drift_load()
+
+        # Try to get a first server reading
+        while True:
+            try:
+                offset = await self._poll_round(tries = 1)
+            except Exception as ex:
+                print('ntpclient: _poll_task():', str(ex))
+                await asyncio.sleep_ms(self._backoff_ms(self.fails))
+                continue
+            break
+
+        # If our clock is more than max_startup_delta off from the
+        # server's time (either way), we hard set it. Otherwise we let
+        # the slew algorithm deal with it.
+        if abs(offset) > self.max_startup_delta:
+            ts_now = self.clock.time_us() + offset
+            if self.debug:
+                print("ntpclient: clock delta too large, setting it to",
+                      utime.localtime(ts_now // 1000000))
+            self._step(offset)
+            # The step counts as an adjustment, that keeps the samples
+            # in the clock filters valid.
+            self.adj_total += offset
+            self.slew_sum += offset
+            offset = 0
+            self.stats.steps += 1
+
+        # With a startup burst we already have a frequency estimate to
+        # start slewing with.
+        if self.debug and self.burst_freq is not None:
+            print("ntpclient: burst frequency estimate:",
+                  self.burst_freq, "ppm")
+        self.disc.start(offset, self.burst_freq, self.poll)
+        self.last_update = utime.ticks_ms()
+
+        # Main client loop
+        while True:
+            # We calculate the next polling interval to sit on a 300ms
+            # boundary in the hope that this might be a quiet asyncio
+            # time so nothing interferes with the time critical server
+            # communication. In holdover the next try backs off.
+            if self.holdover:
+                wait_ms = self._backoff_ms(self.fails)
+            else:
+                usec = self.now_us(self._tb_buf)[1]
+                wait_ms = (self.poll - 8) * 1000 + (1300000 - usec) // 1000
+            await asyncio.sleep_ms(wait_ms)
+            del wait_ms
+
+            # Poll all servers (each up to 3 times, or with a burst
+            # after a reset) to get the current delta between the
+            # servers' and our clock.
+            try:
+                delta = await self._poll_round()
+            except Exception as ex:
+                print("ntpclient: {0} - holdover, retry {1}".format(
+                      ex, self.fails))
+                continue
+            if self.allan is not None:
+                self.allan.add(delta, self._slew_taken(), utime.ticks_ms())
+            self._leap_check()
+
+            # With a PPS present the network only numbers its seconds,
+            # the PPS source hands its offsets to the discipline itself.
+            if self.pps is not None:
+                self.pps.check(delta)
+                if self.pps.active():
+                    self._pps_sys()
+                    if self.poll < self.req_poll:
+                        self.poll <<= 1
+                    continue
+
+            # Hand the delta to the discipline engine together with the
+            # time that passed since the last one.
+            mu, force = self._update(delta, self.poll)
+
+            # Adjust the poll interval when the measured delta per
+            # second is below or above a certain threshold. This means
+            # we poll less if we think we are close to the server and
+            # more often while homing in. A delta that is within the
+            # jitter of the measurements is noise, so it allows a longer
+            # interval and never causes a shorter one. Once the Allan
+            # intercept is known the interval moves towards it instead,
+            # only a delta above the threshold still shortens it.
+            delta_per_sec = delta // mu
+            in_noise = abs(delta) <= _POLL_PGATE * self.sys_jitter
+            target = self._poll_target()
+            if target is not None:
+                if self.poll > MIN_POLL and (self.poll > target or
+                        not in_noise and abs(delta_per_sec) > _POLL_DEC_AT):
+                    self.poll >>= 1
+                elif self.poll < min(target, self.req_poll) \
+                     and self.disc.settled():
+                    self.poll <<= 1
+            elif self.poll < self.req_poll and self.disc.settled():
+                if in_noise or abs(delta_per_sec) < _POLL_INC_AT:
+                    self.poll <<= 1
+            elif self.poll > MIN_POLL:
+                if not in_noise and abs(delta_per_sec) > _POLL_DEC_AT:
+                    self.poll >>= 1
+            self.drift_save(force)
+            self.stats.record(self.sys_delay, delta, self.sys_jitter,
+                              self.adj_last, self.poll)
+            if self.debug:
+                print("ntpclient: state at", utime.localtime())
+                print("ntpclient: delta:", delta,
+                      "per_sec:", delta_per_sec,
+                      "jitter:", self.sys_jitter)
+                print("ntpclient: freq:", self.disc.freq,
+                      "phase:", self.disc.phase,
+                      "new poll:", self.poll)
+                print("----")
+
+            # Cleanup
+            del delta, mu, delta_per_sec, force
+
+    # _leap_check() -
+    #   Arms the leap second the servers announce for the end of the
+    #   current month (UTC), or disarms it if they withdrew it. A round
+    #   that began before the leap may still carry its announcement,
+    #   which is ignored for a day after a leap.
+    def _leap_check(self):
+        li = self.sys_leap
+        if li == self.leap:
+            return
+        now = self.now_us() // 1000000
+        if li != 0 and self.leap_done is not None \
+           and now - self.leap_done < 86400:
+            return
+        self.leap = li
+        self.leap_at = None
+        if li == 0:
+            if self.debug:
+                print("ntpclient: leap second withdrawn")
+            return
+        tm = utime.localtime(now)
+        if tm[1] == 12:
+            at = utime.mktime((tm[0] + 1, 1, 1, 0, 0, 0, 0, 0))
+        else:
+            at = utime.mktime((tm[0], tm[1] + 1, 1, 0, 0, 0, 0, 0))
+        self.leap_at = at
+        if self.debug:
+            print("ntpclient: leap second", "inserted" if li == 1
+                  else "deleted", "before", utime.localtime(at))
+        asyncio.create_task(self._leap_task(li, at))
+
+    # _leap_task() -
+    #   Applies the leap second li armed for at like a kernel does: the
+    #   clock runs through an inserted second as at and is stepped back
+    #   at its end, a deleted second is stepped over at its start. The
+    #   servers' time steps the same way, so the offsets do not see it
+    #   and it does not count as an adjustment. ntpclient_civil shows
+    #   the inserted second as 23:59:60.
+    async def _leap_task(self, li, at):
+        if li == 1:
+            await self.sleep_until((at + 1) * 1000000)
+        else:
+            await self.sleep_until((at - 1) * 1000000)
+        if self.leap != li or self.leap_at != at:
+            return
+        self._step(-1000000 if li == 1 else 1000000)
+        self.leap = 0
+        self.leap_at = None
+        self.leaps += 1
+        self.leap_done = at
+        if self.debug:
+            print("ntpclient: leap second applied")
+
+    # _adj_wait_ms() -
+    #   Milliseconds until the next adjustment. Every adjustment is
+    #   slewed in within a small part of the interval, in between the
+    #   clock runs off at the rate the discipline corrects. Centered
+    #   (see _adj_task()) that is an error of half of rate times the
+    #   interval either way, which is kept within slew_err. Engines that
+    #   need a fixed interval get ADJ_INTERVAL.
+    def _adj_wait_ms(self):
+        rate = self.disc.rate()
+        if rate is None:
+            return ADJ_INTERVAL * 1000
+        err = self.slew_err
+        if err is None:
+            err = max(self.sys_jitter / _SLEW_ERR_DIV, _SLEW_ERR_MIN)
+        wait = min(self.poll >> 2, _ADJ_MAX) * 1000
+        if rate * wait > 2000 * err:
+            wait = max(int(2000 * err / rate), ADJ_INTERVAL * 1000)
+        return wait
+
+    async def _adj_task(self):
+        # This task asks the discipline engine how much to slew for the
+        # time that passed since the last adjustment and hands that to
+        # the clock backend. The frequency part for half of the next
+        # interval is slewed in advance, so in between the clock runs
+        # from ahead to behind by the same amount instead of only
+        # falling behind. What the clock has not slewed of the last
+        # adjustment yet is handed on with the new one, which replaces
+        # it. The next adjustment is due when the clock ran off by as
+        # much as allowed, or right after an update of the discipline.
+        # Only the phase correction part counts towards adj_total, the
+        # frequency correction just compensates our oscillator.
+        last = utime.ticks_ms()
+        ahead = 0
+        wait_ms = ADJ_INTERVAL * 1000
+        while True:
+            if self.disc.rate() is None:
+                await asyncio.sleep_ms(wait_ms)
+            else:
+                try:
+                    await asyncio.wait_for_ms(self._adj_wake.wait(), wait_ms)
+                except asyncio.TimeoutError:
+                    pass
+            self._adj_wake.clear()
+            self.adj_wakeups += 1
+            now = utime.ticks_ms()
+            elapsed = utime.ticks_diff(now, last)
+            last = now
+
+            left = self._slew_left()
+            wait_ms = self._adj_wait_ms()
+            delta = self.disc.tick(elapsed / 1000) - ahead
+            ahead = 0
+            if self.disc.rate() is not None:
+                ahead = int(self.disc.freq * wait_ms / 2000)
+            delta += ahead
+            self.adj_last = delta
+            self._tb_update(delta + left)
+            self._tb_ahead = ahead
+            self._tb_freq = self.disc.freq if ahead != 0 else 0.0
+            self.clock.slew(delta + left)
+            self.slew_sum += delta
+            self.adj_total += self.disc.phase_adj
+            del now, elapsed, left, delta
@@ -0,0 +1,269 @@
+# ntpclient_discipline.py
+#
+# Clock discipline engines. An engine turns the offsets measured by the
+# poll task into the amount the adjust task slews the clock by. All
+# engines have the same interface:
+#
+#   freq          current frequency correction in ppm (positive means
+#                 our clock is slow and gets sped up)
+#   phase         phase offset in microseconds still to be slewed out
+#   phase_adj     phase correction part of the last tick() result
+#   wander        frequency stability in ppm, the RMS of the frequency
+#                 changes of recent updates
+#   load(freq, num)
+#                 restore a saved frequency with a confidence of num
+#   save()        return (freq, num) for the drift file
+#   start(offset, freq, poll)
+#                 first offset after startup (0 after a hard set) and
+#                 the frequency estimate of a startup burst or None
+#   update(offset, mu, poll)
+#                 new offset measured mu seconds after the last one,
+#                 returns True if the state is worth saving
+#   tick(interval)
+#                 microseconds to slew for the interval seconds that
+#                 passed since the last tick()
+#   rate()        microseconds per second the engine currently slews
+#                 by, or None if tick() must be called every
+#                 ADJ_INTERVAL
+#   hold()        the servers stopped answering, keep slewing with the
+#                 current frequency only until the next update
+#   settled()     True once the frequency is known well enough to
+#                 consider longer poll intervals
+
+from .ntpclient_base import ADJ_INTERVAL
+
+# pllfll configuration
+_PLL = 1                # phase time constant in poll intervals
+_FLL_GAIN = 0.25        # weight of the frequency locked loop
+_ALLAN_XPT = 512        # poll interval from which on the FLL is used
+_MAX_FREQ = 500         # frequency correction limit in ppm
+_SETTLE = 16            # updates before the loop counts as settled
+_FREQ_SPAN = 256        # seconds to measure an unknown frequency over
+_START_TC = 8           # phase time constant until the first update
+_MAX_SLEW = 15625       # adjtime() slews at most 1/64 (us per second)
+_MAX_NUM = 100          # confidence cap for the drift file
+_WANDER_AVG = 8         # updates the wander is averaged over
+
+# _wander() -
+#   Updates the exponential RMS average of the frequency changes like
+#   ntpd's clock stability.
+def _wander(wander, dfreq):
+    w2 = wander * wander
+    return (w2 + (dfreq * dfreq - w2) / _WANDER_AVG) ** 0.5
+
+# pllfll -
+#   Hybrid phase/frequency locked loop modeled after ntpd's. The phase
+#   offset is slewed out exponentially with a time constant of _PLL
+#   poll intervals. The PLL corrects the frequency in proportion to the
+#   offset and the update interval, at long poll intervals the FLL adds
+#   a correction based on how much the offset grew since the last update.
+#   Without a known frequency the first update measures it directly.
+class pllfll:
+    def __init__(self):
+        self.freq = 0.0
+        self.freq_known = False
+        self.starting = True
+        self.phase = 0.0
+        self.phase_adj = 0
+        self.wander = 0.0
+        self.tc = _START_TC
+        self.allan_xpt = _ALLAN_XPT
+        self.count = 0
+        self._freq_acc = 0.0
+        self._fsum = 0.0
+        self._fmu = 0
+
+    def load(self, freq, num):
+        self.freq = float(freq)
+        self.freq_known = True
+        self.count = num
+
+    def save(self):
+        return (self.freq, min(self.count, _MAX_NUM))
+
+    def start(self, offset, freq, poll):
+        if freq is not None and not self.freq_known:
+            self.freq = freq
+            self.freq_known = True
+        self.phase = float(offset)
+        self.tc = _START_TC
+        self.starting = True
+
+    def update(self, offset, mu, poll):
+        self.tc = _PLL * poll
+        freq = self.freq
+        # Only regular loop updates say something about the stability
+        track = self.freq_known and not self.starting
+        if not self.freq_known:
+            # Without an estimate the frequency is measured directly
+            # from how much the offset grew beyond what was left to
+            # slew, over at least _FREQ_SPAN seconds so that jitter
+            # does not dominate.
+            self._fsum += offset - self.phase
+            self._fmu += mu
+            if self._fmu >= _FREQ_SPAN:
+                self.freq += self._fsum / self._fmu
+                self.freq_known = True
+            self.starting = False
+        elif self.starting:
+            # The first offset still contains what is left of the
+            # startup phase error, which must not be mistaken for a
+            # frequency error.
+            self.starting = False
+        else:
+            if poll >= self.allan_xpt:
+                self.freq += (offset - self.phase) / max(poll, mu) \
+                             * _FLL_GAIN
+            self.freq += offset * min(mu, self.allan_xpt) \
+                         / ((4 * self.tc) * (4 * self.tc))
+        if self.freq > _MAX_FREQ:
+            self.freq = float(_MAX_FREQ)
+        elif self.freq < -_MAX_FREQ:
+            self.freq = float(-_MAX_FREQ)
+        if track:
+            self.wander = _wander(self.wander, self.freq - freq)
+        self.phase = float(offset)
+        self.count += 1
+        return False
+
+    def tick(self, interval):
+        self._freq_acc += self.freq * interval
+        f = int(self._freq_acc)
+        self._freq_acc -= f
+        adj = int(self.phase * interval / self.tc)
+        lim = int(_MAX_SLEW * interval) - abs(f)
+        if adj > lim:
+            adj = lim
+        elif adj < -lim:
+            adj = -lim
+        self.phase_adj = adj
+        self.phase -= adj
+        return f + adj
+
+    def rate(self):
+        return abs(self.freq) + abs(self.phase) / self.tc
+
+    def hold(self):
+        # The phase is as old as the last answer, the clock only keeps
+        # the frequency until a new offset was measured.
+        self.phase = 0.0
+
+    def settled(self):
+        return self.freq_known and self.count >= _SETTLE
+
+# average configuration
+_DRIFT_NUM_MAX = 200    # Aggregate when we have this many samples
+_DRIFT_NUM_AVG = 100    # Aggregate down to this many and save drift file
+_DRIFT_NUM_BURST = 10   # Weight of the startup burst frequency estimate
+_DRIFT_HOLD_AVG = 8     # updates the holdover drift is averaged over
+
+# average -
+#   The original ntpclient discipline. The drift per ADJ_INTERVAL is an
+#   integer running average of the measured drift, aggregated from
+#   _DRIFT_NUM_MAX down to _DRIFT_NUM_AVG samples. Half of each offset
+#   is slewed out until the next update. The integer drift resolves
+#   only 1/ADJ_INTERVAL ppm, in steady state the phase part makes up
+#   for that. In holdover there is no phase, so the clock is slewed
+#   with a float average of the drift samples instead.
+class average:
+    def __init__(self):
+        self.freq = 0.0
+        self.phase = 0
+        self.phase_adj = 0
+        self.wander = 0.0
+        self.last_delta = None
+        self.drift_sum = 0
+        self.drift_num = 0
+        self.adj_delta = 0
+        self.adj_drift = 0
+        self.adj_sum = 0
+        self.adj_num = 0
+        self._hold_drift = None
+        self._hold_acc = 0.0
+        self._drift_avg = None
+
+    def load(self, freq, num):
+        self.drift_sum = int(freq * ADJ_INTERVAL) * num
+        self.drift_num = num
+        self.freq = freq
+
+    def save(self):
+        return (self.freq, self.drift_num)
+
+    def start(self, offset, freq, poll):
+        if freq is None:
+            self.last_delta = None
+            return
+        if self.drift_num == 0:
+            self.drift_sum = int(freq * ADJ_INTERVAL) * _DRIFT_NUM_BURST
+            self.drift_num = _DRIFT_NUM_BURST
+        self.adj_drift = self.drift_sum // self.drift_num
+        self.freq = self.adj_drift / ADJ_INTERVAL
+        self.adj_delta = self.adj_drift + offset * ADJ_INTERVAL // (poll - 8)
+        self.last_delta = offset
+        self.adj_sum = 0
+        self.adj_num = 0
+
+    def update(self, offset, mu, poll):
+        self._hold_drift = None
+        if self.last_delta is None or self.adj_num == 0:
+            # This was the first actual average delta we got from this
+            # server. Remember it and start over.
+            self.last_delta = offset
+            return False
+
+        save = False
+        corr = offset - self.last_delta
+        self.last_delta = offset
+        drift = (self.adj_sum + corr) // self.adj_num
+        exact = (self.adj_sum + corr) / self.adj_num
+        if self._drift_avg is None:
+            self._drift_avg = exact
+        else:
+            self._drift_avg += (exact - self._drift_avg) / _DRIFT_HOLD_AVG
+        self.drift_sum += drift
+        self.drift_num += 1
+        if self.drift_num >= _DRIFT_NUM_MAX:
+            # When we have 200 samples we aggregate the data down to
+            # 100 samples in order to give an actual change in the
+            # drift a chance to change our average.
+            self.drift_sum = (self.drift_sum // self.drift_num) \
+                             * _DRIFT_NUM_AVG
+            self.drift_num = _DRIFT_NUM_AVG
+            save = True
+
+        self.adj_drift = self.drift_sum // self.drift_num
+        freq = self.freq
+        self.freq = self.adj_drift / ADJ_INTERVAL
+        self.wander = _wander(self.wander, self.freq - freq)
+        self.adj_delta = self.adj_drift + offset // self.adj_num // 2
+        self.phase = offset // 2
+        self.adj_sum = 0
+        self.adj_num = 0
+        return save
+
+    def tick(self, interval):
+        if self._hold_drift is not None:
+            self._hold_acc += self._hold_drift
+            self.adj_delta = int(self._hold_acc)
+            self._hold_acc -= self.adj_delta
+        self.adj_sum += self.adj_delta
+        self.adj_num += 1
+        self.phase_adj = self.adj_delta - self.adj_drift
+        return self.adj_delta
+
+    def rate(self):
+        # adj_delta is per ADJ_INTERVAL
+        return None
+
+    def hold(self):
+        # Like pllfll the phase of the last answer is dropped
+        self.phase = 0
+        if self._drift_avg is not None:
+            self._hold_drift = self._drift_avg
+            self._hold_acc = 0.0
+        else:
+            self.adj_delta = self.adj_drift
+
+    def settled(self):
+        return self.drift_num > 25
@@ -0,0 +1,208 @@
+# ntpclient_dns.py
+#
+# Non-blocking host name lookups. socket.getaddrinfo() blocks the whole
+# uasyncio loop until the resolver answers, which stalls _adj_task()
+# and every application task on a slow or unreachable DNS server. The
+# resolver here sends the A record query itself over UDP and awaits the
+# reply, and keeps all returned addresses for as long as their TTL says,
+# so a pool name is only looked up again after it expired or all of its
+# addresses failed.
+
+import urandom as random
+import usocket as socket
+import ustruct as struct
+import uasyncio as asyncio
+import utime
+
+_DNS_PORT = 53
+_TIMEOUT_MS = 1500      # time to wait for an answer per query
+_TRIES = 2              # queries sent before giving up
+_MIN_TTL = 60           # cache answers for at least this many seconds
+_MAX_TTL = 86400        # and at most this long
+_RETRY_TTL = 30         # keep serving a stale entry this long after a
+                        # failed lookup before trying again
+_BUF_LEN = 512          # maximum DNS message over UDP
+
+# is_ip() -
+#   True if host is a dotted quad IPv4 address, which needs no lookup.
+def is_ip(host):
+    parts = host.split('.')
+    if len(parts) != 4:
+        return False
+    for p in parts:
+        if not p.isdigit() or int(p) > 255:
+            return False
+    return True
+
+# dns_server() -
+#   Returns the DNS server the network interface got configured with,
+#   or None if it can not be found out.
+def dns_server():
+    try:
+        import network
+    except ImportError:
+        return None
+    try:
+        return network.ipconfig('dns')
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        return network.WLAN(network.STA_IF).ifconfig()[3]
+    except (AttributeError, OSError):
+        return None
+
+# dns_query() -
+#   Builds the query for the A records of host with the id qid.
+def dns_query(qid, host):
+    q = bytearray(struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0))
+    for label in host.split('.'):
+        if label:
+            q.append(len(label))
+            q.extend(label.encode())
+    q.extend(b'\0\0\1\0\1')
+    return q
+
+def _skip_name(buf, ofs):
+    while True:
+        n = buf[ofs]
+        if n == 0:
+            return ofs + 1
+        if n & 0xc0 == 0xc0:
+            return ofs + 2
+        ofs += n + 1
+
+# dns_parse() -
+#   Parses the answer to query qid. Returns ([address, ...], ttl) with
+#   the addresses in the order the server sent them and the smallest
+#   TTL of them. Raises OSError if the server reported an error or the
+#   answer does not belong to the query.
+def dns_parse(buf, n, qid):
+    if n < 12:
+        raise OSError("short DNS answer")
+    rid, flags, qd, an = struct.unpack_from('!HHHH', buf, 0)
+    if rid != qid or not flags & 0x8000:
+        raise OSError("unexpected DNS answer")
+    if flags & 0x000f:
+        raise OSError("DNS error {}".format(flags & 0x000f))
+    ofs = 12
+    for i in range(0, qd):
+        ofs = _skip_name(buf, ofs) + 4
+    addrs = []
+    ttl = _MAX_TTL
+    for i in range(0, an):
+        ofs = _skip_name(buf, ofs)
+        if ofs + 10 > n:
+            break
+        rtype, rclass, rttl, rlen = struct.unpack_from('!HHIH', buf, ofs)
+        ofs += 10
+        # CNAME records are skipped, the server sends the A records of
+        # the canonical name along with them.
+        if rtype == 1 and rclass == 1 and rlen == 4 and ofs + 4 <= n:
+            addrs.append('{}.{}.{}.{}'.format(buf[ofs], buf[ofs + 1],
+                                              buf[ofs + 2], buf[ofs + 3]))
+            ttl = min(ttl, rttl)
+        ofs += rlen
+    return addrs, ttl
+
+# resolver -
+#   Caching resolver. server is the DNS server's address, None asks the
+#   network interface for it and False always uses the blocking
+#   socket.getaddrinfo() (still cached for _MIN_TTL).
+class resolver:
+    def __init__(self, server = None, debug = False):
+        self.server = server
+        self.debug = debug
+        self.cache = {}         # host: ([address, ...] or the exception
+                                #        of a failed lookup, expires
+                                #        ticks_ms)
+        self.queries = 0
+        self._busy = {}         # host: Event of the lookup in progress
+        self._buf = None
+
+    # expire() -
+    #   Drops the cached addresses of host, so the next resolve() looks
+    #   it up again.
+    def expire(self, host):
+        if host in self.cache:
+            del self.cache[host]
+
+    # resolve() -
+    #   Returns the list of addresses of host. Cached entries are used
+    #   until their TTL runs out. If a lookup fails, an expired entry is
+    #   used for another _RETRY_TTL seconds. Without one, the error is
+    #   raised again for _RETRY_TTL seconds without a new lookup.
+    async def resolve(self, host):
+        if is_ip(host):
+            return [host]
+        while host in self._busy:
+            await self._busy[host].wait()
+        entry = self.cache.get(host)
+        if entry is not None \
+           and utime.ticks_diff(entry[1], utime.ticks_ms()) > 0:
+            if isinstance(entry[0], Exception):
+                raise entry[0]
+            return entry[0]
+        if entry is not None and isinstance(entry[0], Exception):
+            entry = None
+
+        ev = asyncio.Event()
+        self._busy[host] = ev
+        try:
+            addrs, ttl = await self._lookup(host)
+            ttl = max(_MIN_TTL, min(ttl, _MAX_TTL))
+        except Exception as ex:
+            if entry is None:
+                self.cache[host] = (ex, utime.ticks_add(utime.ticks_ms(),
+                                                        _RETRY_TTL * 1000))
+                raise
+            if self.debug:
+                print("ntpclient: lookup of {} failed: {} - using "
+                      "cached addresses".format(host, ex))
+            addrs, ttl = entry[0], _RETRY_TTL
+        finally:
+            del self._busy[host]
+            ev.set()
+        self.cache[host] = (addrs, utime.ticks_add(utime.ticks_ms(),
+                                                   ttl * 1000))
+        if self.debug:
+            print("ntpclient: {} is {} (ttl {})".format(host, addrs, ttl))
+        return addrs
+
+    async def _lookup(self, host):
+        self.queries += 1
+        server = self.server
+        if server is None:
+            server = dns_server()
+        if not server:
+            # No server to ask ourselves, fall back to the blocking call
+            addrs = []
+            for ai in socket.getaddrinfo(host, 123):
+                if ai[-1][0] not in addrs:
+                    addrs.append(ai[-1][0])
+            return addrs, _MIN_TTL
+
+        if self._buf is None:
+            self._buf = bytearray(_BUF_LEN)
+        qid = random.getrandbits(16)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((server, _DNS_PORT))
+            rstr = asyncio.StreamReader(sock)
+            wstr = asyncio.StreamWriter(sock)
+            for i in range(0, _TRIES):
+                wstr.write(dns_query(qid, host))
+                await wstr.drain()
+                try:
+                    n = await asyncio.wait_for_ms(rstr.readinto(self._buf),
+                                                  _TIMEOUT_MS)
+                except asyncio.TimeoutError:
+                    continue
+                if n < 2 or (self._buf[0] << 8 | self._buf[1]) != qid:
+                    continue
+                addrs, ttl = dns_parse(self._buf, n, qid)
+                if not addrs:
+                    raise OSError("no address for {}".format(host))
+                return addrs, ttl
+        finally:
+            sock.close()
+        raise OSError("DNS timeout for {}".format(host))
@@ -0,0 +1,88 @@
+# ntpclient_filter.py
+#
+# Per server clock filter in the style of RFC 5905 section 10. The
+# last NSTAGE samples are kept and the one with the lowest round trip
+# delay, which suffered the least queueing, is used (with older
+# samples penalized for the dispersion they collected since).
+
+import utime
+
+NSTAGE = 8              # size of the shift register
+_PHI = 15               # frequency tolerance in ppm (us of dispersion/s)
+_SEL_PHI = 3            # aging in ppm when picking the best sample
+
+# clockfilter -
+#   Shift register of (offset, delay, dispersion, ticks_ms) samples.
+#
+#   Our own clock keeps getting slewed while samples sit in the
+#   register, which makes older offsets stale. Samples are therefore
+#   stored relative to the total amount the client has adjusted the
+#   clock so far (adj) and converted back when they are used.
+class clockfilter:
+    def __init__(self):
+        self.offset = [0] * NSTAGE
+        self.delay = [0] * NSTAGE
+        self.disp = [0] * NSTAGE
+        self.ticks = [0] * NSTAGE
+        self.count = 0
+        self.next = 0
+
+    def clear(self):
+        self.count = 0
+        self.next = 0
+
+    # add() -
+    #   Shifts in a new sample. disp is the dispersion the sample has
+    #   on arrival (server precision and root dispersion growth).
+    def add(self, offset, delay, disp, adj):
+        i = self.next
+        self.offset[i] = offset + adj
+        self.delay[i] = delay
+        self.disp[i] = disp
+        self.ticks[i] = utime.ticks_ms()
+        self.next = (i + 1) % NSTAGE
+        if self.count < NSTAGE:
+            self.count += 1
+
+    # select() -
+    #   Returns (offset, delay, dispersion, jitter) in microseconds for
+    #   the best sample, or None if the register is empty. The best
+    #   sample is the one with the lowest half delay plus its dispersion
+    #   aged at _SEL_PHI, so an older sample only wins when it had
+    #   notably less queueing delay. The offsets are kept relative to
+    #   the adjustments, which include the frequency correction, so a
+    #   sample only goes stale with what is left of the frequency error.
+    #   That is far below the _PHI tolerance once the clock is locked,
+    #   which would let the newest sample win nearly every time at long
+    #   poll intervals. The dispersion of the register is still aged at
+    #   _PHI and summed with weights halving for each step away from the
+    #   best sample, jitter is the RMS of the other samples' offsets
+    #   from the best one.
+    def select(self, adj):
+        n = self.count
+        if n == 0:
+            return None
+        now = utime.ticks_ms()
+        dist = [0] * n
+        key = [0] * n
+        for i in range(0, n):
+            age_ms = utime.ticks_diff(now, self.ticks[i])
+            dist[i] = self.disp[i] + age_ms * _PHI // 1000
+            key[i] = self.delay[i] // 2 + self.disp[i] \
+                     + age_ms * _SEL_PHI // 1000
+        order = sorted(range(0, n), key = lambda i: key[i])
+        best = order[0]
+        best_off = self.offset[best]
+
+        disp = 0
+        jitter = 0
+        for k in range(0, n):
+            i = order[k]
+            disp += dist[i] >> (k + 1)
+            if k > 0:
+                d = self.offset[i] - best_off
+                jitter += d * d
+        if n > 1:
+            jitter = int((jitter / (n - 1)) ** 0.5)
+
+        return (best_off - adj, self.delay[best], disp, jitter)
@@ -0,0 +1,171 @@
+# ntpclient_pps.py
+#
+# Pulse per second input, for instance from a GPS receiver:
+#
+#   client = ntpclient.ntpclient(host = 'pool.ntp.org',
+#                                pps = Pin(34, Pin.IN))
+#
+# The PPS edge marks the start of a second far more precisely than the
+# network can, but it does not say which second. The network source
+# numbers them: once the client is synchronized, an edge is taken to
+# belong to the second our clock is closest to, which is unambiguous
+# as long as the clock is within half a second.
+#
+# The interrupt handler only stores ticks_us() into a preallocated ring
+# and sets a ThreadSafeFlag, so it does not allocate and can run as a
+# hard interrupt. When the ring is full it drops the edge and counts an
+# overrun instead of overwriting edges not taken yet. A task takes the
+# edges from the ring, converts them with the client's time base and
+# hands the median offset of every _PPS_POLL edges to the client, which
+# disciplines the clock with them instead of the network offsets while
+# the PPS is present.
+
+import array
+from machine import Pin
+import uasyncio as asyncio
+import utime
+
+_RING = 8               # edges buffered between two task runs (2^n,
+                        # one slot stays free to tell full from empty)
+_PPS_POLL = 16          # edges per update, the update interval in s
+_PPS_TOL = 1000         # allowed deviation of an edge interval from
+                        # one second in us (500 ppm plus jitter)
+_PPS_GATE = 128000      # network offset above which the PPS is not
+                        # trusted to number the seconds (like ntpd)
+
+# ppssource -
+#   Timestamps the trigger edges of pin and feeds them to client. delay
+#   is how many microseconds the edge comes after the start of the
+#   second (receiver and cable delay). The counters are the edges seen,
+#   the ones that were used and the ones dropped for a wrong interval
+#   (glitches or a gap), while the client was not synchronized or after
+#   an overrun, and the overruns, edges lost because the ring was full.
+class ppssource:
+    def __init__(self, client, pin, delay = 0, trigger = Pin.IRQ_RISING):
+        self.client = client
+        self.delay = delay
+        self.edges = 0
+        self.used = 0
+        self.dropped = 0
+        self.overruns = 0
+        # Jitter of the offsets of the last update and ticks_ms of it
+        self.jitter = 0
+        self.last = None
+        # Set by the client while the network disagrees with our clock
+        # by more than _PPS_GATE
+        self.vetoed = False
+
+        self._ring = array.array('i', [0] * _RING)
+        self._head = 0
+        self._tail = 0
+        self._seen = 0
+        self._prev = None
+        self._offs = array.array('i', [0] * _PPS_POLL)
+        self._n = 0
+        self._base = 0
+        self._out = [0, 0]
+        self._flag = asyncio.ThreadSafeFlag()
+        self._task = asyncio.create_task(self._process())
+
+        self.pin = pin
+        try:
+            pin.irq(self._irq, trigger, hard = True)
+        except TypeError:
+            # Ports without hard interrupts for pins
+            pin.irq(self._irq, trigger)
+
+    def close(self):
+        self.pin.irq(None)
+        self._task.cancel()
+
+    # active() -
+    #   True while the PPS disciplines the clock, that is it delivered
+    #   an update within the last two update intervals.
+    def active(self):
+        return self.last is not None and not self.vetoed \
+               and utime.ticks_diff(utime.ticks_ms(), self.last) \
+                   < 2000 * _PPS_POLL
+
+    # check() -
+    #   Called with every network offset, which has to stay within
+    #   _PPS_GATE for the PPS seconds numbering to be trusted.
+    def check(self, offset):
+        self.vetoed = abs(offset) > _PPS_GATE
+        if self.vetoed:
+            self._n = 0
+
+    def _irq(self, pin):
+        i = self._head
+        j = (i + 1) & (_RING - 1)
+        if j == self._tail:
+            self.overruns += 1
+        else:
+            self._ring[i] = utime.ticks_us()
+            self._head = j
+        self._flag.set()
+
+    # _process() -
+    #   Takes the edges from the ring. The overrun counter is checked
+    #   before each edge: an overrun happens while the ring is full, so
+    #   every edge taken before the counter changed came before the lost
+    #   ones. The edges still in the ring may be on either side of the
+    #   gap, they are discarded and the next edge starts a new interval.
+    async def _process(self):
+        ring = self._ring
+        while True:
+            await self._flag.wait()
+            while self._tail != self._head:
+                if self.overruns != self._seen:
+                    self._seen = self.overruns
+                    n = (self._head - self._tail) & (_RING - 1)
+                    self._tail = self._head
+                    self._prev = None
+                    self.edges += n
+                    self.dropped += n
+                    break
+                t = ring[self._tail]
+                self._tail = (self._tail + 1) & (_RING - 1)
+                self._edge(t)
+
+    # _edge() -
+    #   Processes the edge at ticks_us() value t.
+    def _edge(self, t):
+        self.edges += 1
+        c = self.client
+        prev = self._prev
+        self._prev = t
+        if prev is None \
+           or abs(utime.ticks_diff(t, prev) - 1000000) > _PPS_TOL \
+           or self.vetoed or c.last_update is None:
+            self.dropped += 1
+            return
+
+        # Offset to the nearest second boundary (plus delay), positive
+        # when our clock is behind. Kept adjustment independent like the
+        # clock filters, the clock gets slewed while edges accumulate.
+        # adj_total holds the startup step, which can be decades, so the
+        # offsets are stored relative to its value at the start of the
+        # update to fit the array.
+        usec = c.ticks_to_epoch(t, self._out)[1] - self.delay
+        if usec >= 500000:
+            usec -= 1000000
+        elif usec < -500000:
+            usec += 1000000
+        if self._n == 0:
+            self._base = c.adj_total
+        self._offs[self._n] = c.adj_at(t) - self._base - usec
+        self._n += 1
+        self.used += 1
+        if self._n < _PPS_POLL:
+            return
+
+        # The median is robust against the odd late interrupt, the
+        # jitter is estimated from the interquartile range (3/4 of it
+        # is the standard deviation of normally distributed offsets).
+        self._n = 0
+        offs = sorted(self._offs)
+        med = offs[_PPS_POLL // 2]
+        q = offs[_PPS_POLL * 3 // 4] - offs[_PPS_POLL // 4]
+        self.jitter = max(q * 3 // 4, 1)
+        self.last = utime.ticks_ms()
+        c._pps_update(med + self._base - c.adj_now(), _PPS_POLL)
@@ -0,0 +1,184 @@
+# ntpclient_sched.py
+#
+# Precise scheduling on the client's time base. A uasyncio sleep wakes
+# up late by however long other tasks keep the loop busy, so waiting
+# for an exact time is done in two steps: sleep until shortly before
+# it, then spin with utime.sleep_us() for the rest. How long before
+# (the handoff) is learned from how late the sleeps actually wake up,
+# which keeps the time the loop is blocked as short as possible.
+#
+# All times are microseconds since 2000-01-01 like client.now_us().
+
+import uasyncio as asyncio
+import utime
+
+_SPIN_MIN_US = 300      # minimum spin before a deadline
+_SPIN_MAX_US = 20000    # maximum spin, longer wakeup latencies are
+                        # accepted as late deadlines instead
+_LAT_INIT_US = 2000     # initial wakeup latency estimate
+_MAX_SLEEP_MS = 60000   # longest single sleep, so the time base is
+                        # consulted again well before ticks_us() wraps
+_STEP_GRACE_US = 10000  # an edge that passed this recently when the
+                        # clock got stepped is still called
+
+# job -
+#   One periodic job of the scheduler. The statistics are about the
+#   error of the time the callback got called, in microseconds.
+class job:
+    def __init__(self, sched, period, phase, cb):
+        self.sched = sched
+        self.period = period
+        self.phase = phase
+        self.cb = cb
+        self.next = None
+        self.called = None              # ticks_us() of the last call
+        self.n = 0
+        self.err_sum = 0
+        self.err_sq = 0
+        self.err_max = 0
+
+    def cancel(self):
+        self.sched.cancel(self)
+
+    def record(self, err):
+        self.n += 1
+        self.err_sum += err
+        self.err_sq += err * err
+        if abs(err) > self.err_max:
+            self.err_max = abs(err)
+
+    # stats() -
+    #   Returns (edges, mean error, jitter, maximum absolute error). The
+    #   jitter is the standard deviation of the error.
+    def stats(self):
+        if self.n == 0:
+            return (0, 0, 0, 0)
+        mean = self.err_sum / self.n
+        var = self.err_sq / self.n - mean * mean
+        return (self.n, mean, max(var, 0) ** 0.5, self.err_max)
+
+# scheduler -
+#   Deadline scheduler shared by all users of a client. Periodic jobs
+#   run from a single task, so jobs with edges close to each other do
+#   not compete for the loop: the callbacks are called one after the
+#   other at the end of the same spin. Callbacks should be short, if a
+#   callback returns an awaitable (like a coroutine doing slow display
+#   output) that is run as a separate task.
+class scheduler:
+    def __init__(self, client):
+        self.client = client
+        self.lat_mean = _LAT_INIT_US
+        self.lat_dev = _LAT_INIT_US // 4
+        self.jobs = []
+        self.waits = 0
+        self.spin_us = 0
+        self._task = None
+
+    # handoff() -
+    #   Microseconds before a deadline to stop sleeping and start to
+    #   spin. Like a TCP retransmit timeout it is the mean wakeup
+    #   latency plus four times its mean deviation.
+    def handoff(self):
+        h = self.lat_mean + 4 * self.lat_dev + _SPIN_MIN_US
+        if h > _SPIN_MAX_US:
+            return _SPIN_MAX_US
+        return h
+
+    def _learn(self, late):
+        err = late - self.lat_mean
+        self.lat_mean += err >> 3
+        self.lat_dev += (abs(err) - self.lat_dev) >> 2
+
+    # sleep_until() -
+    #   Waits until the time ts. Returns how late that was in
+    #   microseconds.
+    async def sleep_until(self, ts):
+        while True:
+            t = utime.ticks_us()
+            remain = ts - self.client.ticks_to_epoch(t)
+            if remain <= 0:
+                self.waits += 1
+                return -remain
+            sleep_ms = (remain - self.handoff()) // 1000
+            if sleep_ms <= 0:
+                break
+            if sleep_ms > _MAX_SLEEP_MS:
+                sleep_ms = _MAX_SLEEP_MS
+            await asyncio.sleep_ms(sleep_ms)
+            self._learn(utime.ticks_diff(utime.ticks_us(), t)
+                        - sleep_ms * 1000)
+
+        target = utime.ticks_add(t, remain)
+        remain = utime.ticks_diff(target, utime.ticks_us())
+        if remain > 0:
+            self.spin_us += remain
+            utime.sleep_us(remain)
+        self.waits += 1
+        return utime.ticks_diff(utime.ticks_us(), target)
+
+    # every() -
+    #   Calls cb(ts) at every time ts that is phase microseconds past a
+    #   multiple of period microseconds. Returns the job.
+    def every(self, period, phase, cb):
+        j = job(self, period, phase, cb)
+        self.jobs.append(j)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return j
+
+    def cancel(self, j):
+        if j in self.jobs:
+            self.jobs.remove(j)
+
+    # stepped() -
+    #   Called by the client after it stepped the clock. Every job moves
+    #   to its first edge in the new time. An edge that is just past,
+    #   like the first second after a leap second, is called right away
+    #   unless the job was just called for the same moment in the old
+    #   time. The task waiting for the old deadline is restarted.
+    def stepped(self):
+        now = self.client.now_us()
+        t = utime.ticks_us()
+        for j in self.jobs:
+            d = (now - j.phase) % j.period
+            if d < _STEP_GRACE_US and (j.called is None or
+               utime.ticks_diff(t, j.called) >= _STEP_GRACE_US):
+                j.next = now - d
+            else:
+                j.next = now - d + j.period
+        if self._task is not None:
+            self._task.cancel()
+            self._task = asyncio.create_task(self._run())
+
+    # stats() -
+    #   Returns (wakeup latency mean, its deviation, current handoff,
+    #   average spin per deadline), all in microseconds.
+    def stats(self):
+        return (self.lat_mean, self.lat_dev, self.handoff(),
+                self.spin_us // max(self.waits, 1))
+
+    async def _run(self):
+        while self.jobs:
+            now = self.client.now_us()
+            nxt = None
+            for j in self.jobs:
+                if j.next is None or j.next < now - j.period:
+                    # New job or one that fell behind, skip to its next
+                    # edge instead of catching up.
+                    j.next = now - (now - j.phase) % j.period + j.period
+                if nxt is None or j.next < nxt:
+                    nxt = j.next
+
+            late = await self.sleep_until(nxt)
+            start = utime.ticks_us()
+            for j in self.jobs[:]:
+                if j.next is None or j.next > nxt:
+                    continue
+                ts = j.next
+                j.next += j.period
+                j.called = utime.ticks_us()
+                j.record(late + utime.ticks_diff(j.called, start))
+                res = j.cb(ts)
+                if res is not None:
+                    asyncio.create_task(res)
+        self._task = None
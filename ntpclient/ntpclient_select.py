@@ -0,0 +1,100 @@
+# ntpclient_select.py
+#
+# Server selection in the style of RFC 5905 section 11.2: intersection
+# to find the truechimers, clustering to prune outliers and combining
+# the survivors into a single offset.
+
+# Minimum number of survivors the clustering leaves in place
+NMIN = 3
+
+# select_offset() -
+#   Takes a list of (offset, rootdist, jitter) tuples, one per server
+#   that answered in this round, all in microseconds. Returns a tuple
+#   (offset, jitter, survivors) with the combined offset, the system
+#   jitter and the indexes of the servers that survived, or None if no
+#   majority of servers agrees on the time.
+def select_offset(cands):
+    n = len(cands)
+    if n == 0:
+        return None
+
+    # Intersection: find the smallest interval that contains points
+    # from the correctness intervals (offset +/- rootdist) of at least
+    # n - allow servers, allowing for as few falsetickers as possible.
+    edges = []
+    for c in cands:
+        edges.append((c[0] - c[1], -1))
+        edges.append((c[0], 0))
+        edges.append((c[0] + c[1], 1))
+    edges.sort()
+
+    for allow in range(0, (n + 1) // 2):
+        found = 0
+        chime = 0
+        low = None
+        for e in edges:
+            chime -= e[1]
+            if chime >= n - allow:
+                low = e[0]
+                break
+            if e[1] == 0:
+                found += 1
+        chime = 0
+        high = None
+        for e in reversed(edges):
+            chime += e[1]
+            if chime >= n - allow:
+                high = e[0]
+                break
+            if e[1] == 0:
+                found += 1
+        if found <= allow and low is not None and high is not None \
+           and low <= high:
+            break
+    else:
+        return None
+
+    # Servers whose offset lies outside of the intersection interval
+    # are falsetickers.
+    survivors = [i for i in range(0, n) if low <= cands[i][0] <= high]
+    if not survivors:
+        return None
+    survivors.sort(key = lambda i: cands[i][1])
+
+    # Clustering: as long as there are more than NMIN survivors, drop
+    # the one contributing the most selection jitter, unless that is
+    # already smaller than the best server's own jitter.
+    while len(survivors) > NMIN:
+        max_sel = -1
+        max_i = None
+        for i in survivors:
+            s = 0
+            for j in survivors:
+                d = cands[i][0] - cands[j][0]
+                s += d * d
+            s = (s / (len(survivors) - 1)) ** 0.5
+            if s > max_sel:
+                max_sel = s
+                max_i = i
+        min_jitter = min(cands[i][2] for i in survivors)
+        if max_sel <= min_jitter:
+            break
+        survivors.remove(max_i)
+
+    # Combine: average the survivors' offsets weighted by the inverse
+    # of their root distance. The system jitter is the RMS difference
+    # of the survivors to the best one (the system peer).
+    x = 0.0
+    y = 0.0
+    for i in survivors:
+        w = 1.0 / max(cands[i][1], 1)
+        x += cands[i][0] * w
+        y += w
+    sys_off = cands[survivors[0]][0]
+    s = 0
+    for i in survivors:
+        d = cands[i][0] - sys_off
+        s += d * d
+    jitter = int((s / len(survivors)) ** 0.5)
+
+    return (int(x / y), jitter, survivors)
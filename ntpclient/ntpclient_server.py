@@ -0,0 +1,219 @@
+# ntpclient_server.py
+#
+# SNTP server, so that a board disciplined by ntpclient can serve time
+# to other devices on its network segment:
+#
+#   client = ntpclient.ntpclient(host = 'pool.ntp.org')
+#   client.serve()
+#
+# Replies are built in a preallocated template. Everything that does
+# not change per request (stratum, reference id, root delay and
+# dispersion, reference timestamp) is refreshed from the client at most
+# once a second. Per request only the version, poll and the three
+# timestamps are patched in, straight from the client's time base, so
+# serving a request does not allocate beyond what recvfrom() returns.
+#
+# Every client address gets a token bucket of _RATE_BURST requests,
+# refilled one every _RATE_MIN_MS. A client that runs out gets one
+# kiss-o'-death RATE reply, after that requests it has no token for
+# are dropped until its bucket is full again. Up to _RATE_CLIENTS
+# addresses are tracked. Overall the server answers at most _MAX_RATE
+# requests per second and drops the rest.
+#
+# In broadcast mode the broadcast listener already has port 123. Two
+# sockets bound to one port with SO_REUSEADDR would each get some of
+# the datagrams, so the server then uses the listener's socket, which
+# hands it the requests (see ntpclient_bcast).
+
+import usocket as socket
+import uasyncio as asyncio
+import utime
+
+from .ntpclient_base import put_ntp, readable
+
+_REQ_LEN = 48
+_PRECISION = -18        # log2 seconds, ticks_us() based time base
+_REFRESH_MS = 1000      # refresh the reply template this often
+_RATE_BURST = 8         # requests a client may send back to back
+_RATE_MIN_MS = 2000     # time for a client to earn another request
+_RATE_CLIENTS = 64      # client addresses tracked for rate limiting
+_MAX_RATE = 500         # replies per second
+_MAX_BURST_MS = 100     # replies above _MAX_RATE in a burst, in ms
+
+# _short() -
+#   Stores microseconds as 32 bit NTP short format (16.16 seconds) at
+#   offset ofs in buf.
+def _short(buf, ofs, us):
+    sec = min(us // 1000000, 0xffff)
+    frac = ((us % 1000000) << 10) // 15625
+    buf[ofs] = sec >> 8
+    buf[ofs + 1] = sec & 0xff
+    buf[ofs + 2] = frac >> 8
+    buf[ofs + 3] = frac & 0xff
+
+# ntpserver -
+#   Answers NTP client requests on port with the time of client. With
+#   sock given it answers on that socket and its owner passes the
+#   requests to recv(). The counters are the requests received, replies
+#   and kiss-o'-death replies sent, requests dropped by the rate limit
+#   and requests that were not NTP client requests.
+class ntpserver:
+    def __init__(self, client, port = 123, rate_burst = _RATE_BURST,
+                 rate_min_ms = _RATE_MIN_MS, max_rate = _MAX_RATE,
+                 sock = None):
+        self.client = client
+        self.rate_burst = rate_burst
+        self.rate_min_ms = rate_min_ms
+        self.max_rate = max_rate
+        self.requests = 0
+        self.replies = 0
+        self.kods = 0
+        self.drops = 0
+        self.bad = 0
+
+        # Client address: [credit ms, ticks_ms of the last request,
+        # kiss-o'-death sent]
+        self.clients = {}
+        self._credit = _MAX_BURST_MS * max_rate
+        self._credit_ms = utime.ticks_ms()
+
+        self._reply = bytearray(48)
+        self._kod = bytearray(48)
+        self._kod[12:16] = b'RATE'
+        self._refresh_ms = utime.ticks_add(utime.ticks_ms(), -_REFRESH_MS)
+
+        self.shared = sock is not None
+        if self.shared:
+            self.sock = sock
+            self._task = None
+            return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', port))
+        self.sock.setblocking(False)
+        self._task = asyncio.create_task(self._serve())
+
+    def close(self):
+        if self.shared:
+            self.client.bcast.server = None
+            return
+        self._task.cancel()
+        self.sock.close()
+
+    # recv() -
+    #   Answers request req from addr that was just received. The
+    #   receive timestamp goes into the template right away, before any
+    #   checks.
+    def recv(self, req, addr):
+        self.client.now_ntp(self._reply, 32)
+        self._handle(req, addr)
+
+    # _refresh() -
+    #   Copies the client's current state into the reply template.
+    #   Leap indicator 3 (not synchronized) until the client got its
+    #   first good poll round, then the leap second the client armed.
+    def _refresh(self):
+        c = self.client
+        tpl = self._reply
+        err = c.est_error()
+        tpl[0] = (c.leap << 6) | 4 if err is not None else 0xc4
+        tpl[1] = c.sys_stratum if err is not None else 16
+        tpl[3] = _PRECISION & 0xff
+        _short(tpl, 4, c.sys_rootdelay)
+        _short(tpl, 8, c.sys_rootdisp + (err or 0))
+        tpl[12:16] = c.sys_refid
+        if c.sync_time is not None:
+            put_ntp(tpl, 16, c.sync_time, 0)
+
+    # _limit() -
+    #   Charges a request from ip to its token bucket. Returns 0 to
+    #   answer it, 1 for a kiss-o'-death and 2 to drop it.
+    def _limit(self, ip, now):
+        cost = self.rate_min_ms
+        ent = self.clients.get(ip)
+        if ent is None:
+            credit = cost * self.rate_burst
+            if len(self.clients) >= _RATE_CLIENTS:
+                # Forget the client that was quiet the longest. With
+                # the table full the newcomer only gets one request and
+                # no kiss-o'-death, otherwise more clients than the
+                # table holds (or spoofed addresses) would always find
+                # a full bucket.
+                oldest = None
+                for k in self.clients:
+                    if oldest is None or utime.ticks_diff(
+                            self.clients[oldest][1], self.clients[k][1]) > 0:
+                        oldest = k
+                del self.clients[oldest]
+                credit = cost
+            ent = [credit, now, credit == cost]
+            self.clients[ip] = ent
+        else:
+            ent[0] += utime.ticks_diff(now, ent[1])
+            ent[1] = now
+            if ent[0] >= cost * self.rate_burst:
+                # Back to a full bucket, another kiss-o'-death may be
+                # sent if the client starts to overdo it again.
+                ent[0] = cost * self.rate_burst
+                ent[2] = False
+        if ent[0] >= cost:
+            ent[0] -= cost
+            return 0
+        if ent[2]:
+            return 2
+        ent[2] = True
+        return 1
+
+    def _handle(self, req, addr):
+        self.requests += 1
+        if len(req) < _REQ_LEN or (req[0] & 0x07) != 3:
+            self.bad += 1
+            return
+
+        now = utime.ticks_ms()
+        # Overall rate limit, this protects the board itself
+        self._credit = min(self._credit
+                           + min(utime.ticks_diff(now, self._credit_ms),
+                                 _MAX_BURST_MS) * self.max_rate,
+                           _MAX_BURST_MS * self.max_rate)
+        self._credit_ms = now
+        if self._credit < 1000:
+            self.drops += 1
+            return
+        self._credit -= 1000
+
+        res = self._limit(addr[0], now)
+        if res == 2:
+            self.drops += 1
+            return
+        if res == 1:
+            pkt = self._kod
+            pkt[0] = 0xc4 | (req[0] & 0x38)
+            self.kods += 1
+        else:
+            if utime.ticks_diff(now, self._refresh_ms) >= _REFRESH_MS:
+                self._refresh()
+                self._refresh_ms = now
+            pkt = self._reply
+            pkt[0] = (pkt[0] & 0xc7) | (req[0] & 0x38)
+            self.replies += 1
+        pkt[2] = req[2]
+        for i in range(0, 8):
+            pkt[24 + i] = req[40 + i]
+        if pkt is self._reply:
+            self.client.now_ntp(pkt, 40)
+        try:
+            self.sock.sendto(pkt, addr)
+        except OSError:
+            pass
+
+    async def _serve(self):
+        sock = self.sock
+        while True:
+            await readable(sock)
+            while True:
+                try:
+                    req, addr = sock.recvfrom(_REQ_LEN)
+                except OSError:
+                    break
+                self.recv(req, addr)
@@ -0,0 +1,72 @@
+# ntpclient_state.py
+#
+# Binary state file that survives reboots. It used to be a text file
+# that was run through exec(), which compiles Python source on every
+# boot. The binary record is read with one struct.unpack() instead.
+#
+# Layout (little endian):
+#
+#   0       4s  magic b'NTPs'
+#   4       B   format version
+#   5       B   poll interval as log2 of the seconds
+#   6       H   confidence of the frequency (number of updates)
+#   8       f   frequency correction in ppm
+#   12      B   length n of the server name
+#   13      ns  host name of the last system peer
+#   13+n    I   CRC32 of all of the above
+
+import ubinascii as binascii
+import ustruct as struct
+
+STATE_VERSION = 1
+
+_MAGIC = b'NTPs'
+_HEAD = '<4sBBHfB'
+_HEAD_LEN = 13
+_MAX_HOST = 64
+
+# state_pack() -
+#   Returns the state record for the given values as bytes.
+def state_pack(freq, num, poll, host):
+    host = (host or '').encode()[:_MAX_HOST]
+    log2 = 0
+    while (1 << (log2 + 1)) <= poll:
+        log2 += 1
+    buf = struct.pack(_HEAD, _MAGIC, STATE_VERSION, log2,
+                      min(num, 0xffff), freq, len(host)) + host
+    return buf + struct.pack('<I', binascii.crc32(buf) & 0xffffffff)
+
+# state_unpack() -
+#   Parses a state record. Returns a tuple (freq, num, poll, host) or
+#   None if buf does not start with the magic. Raises ValueError on a
+#   damaged record or one of a newer format.
+def state_unpack(buf):
+    if len(buf) < _HEAD_LEN or buf[:4] != _MAGIC:
+        return None
+    magic, version, log2, num, freq, n = struct.unpack_from(_HEAD, buf)
+    if version > STATE_VERSION:
+        raise ValueError("state file version {} - expected {}".format(
+                         version, STATE_VERSION))
+    end = _HEAD_LEN + n
+    if len(buf) < end + 4:
+        raise ValueError("state file truncated")
+    crc = struct.unpack_from('<I', buf, end)[0]
+    if binascii.crc32(buf[:end]) & 0xffffffff != crc:
+        raise ValueError("state file CRC mismatch")
+    host = str(buf[_HEAD_LEN:end], 'utf-8') or None
+    return (freq, num, 1 << log2, host)
+
+# state_parse_text() -
+#   Parses the text drift file of the first version ("name = value"
+#   lines with the sum of drift per ADJ_INTERVAL samples) without
+#   exec(). Returns (freq, num) or None.
+def state_parse_text(buf, adj_interval):
+    info = {}
+    for line in str(buf, 'utf-8').split('\n'):
+        kv = line.split('=')
+        if len(kv) == 2:
+            info[kv[0].strip()] = float(kv[1])
+    if 'drift_sum' in info and info['drift_num'] > 0:
+        num = int(info['drift_num'])
+        return (info['drift_sum'] / num / adj_interval, num)
+    return None
@@ -0,0 +1,177 @@
+# ntpclient_stats.py
+#
+# Statistics of the client: event counters and ring buffers with the
+# history of the last updates. Recording is a few array stores, so it
+# is always on. snapshot() returns everything for use on the board,
+# exporter() streams a compact binary record to a collector instead
+# (see ntpclient_sim.collector for the receiving side).
+#
+# Binary record (little endian):
+#
+#   0       4s  magic b'NTPt'
+#   4       B   format version
+#   5       B   ring length n
+#   6       B   number of valid ring entries
+#   7       B   ring position (index of the next entry to be written)
+#   8       B   length m of the ident
+#   9       3x  reserved
+#   12      7I  counters in COUNTERS order
+#   40      ms  ident (for example the device name)
+#   40+m    n*i one ring per RINGS entry, raw in ring order
+
+import array
+import uasyncio as asyncio
+import usocket as socket
+import ustruct as struct
+
+STATS_VERSION = 1
+
+# polls:     requests sent
+# replies:   usable replies received
+# timeouts:  requests that got no reply in time
+# stale:     replies dropped because they answered no pending request
+#            (late, duplicated or spoofed)
+# resets:    server connections reset after a server stopped answering
+# steps:     hard sets of the RTC
+# errors:    poll rounds that produced no offset
+COUNTERS = ('polls', 'replies', 'timeouts', 'resets', 'steps', 'errors',
+            'stale')
+
+# delay:     round trip delay of the system peer in us
+# offset:    offset the discipline got in us
+# jitter:    system jitter in us
+# adj:       last slew handed to the clock in us
+# poll:      poll interval in s
+RINGS = ('delay', 'offset', 'jitter', 'adj', 'poll')
+
+_MAGIC = b'NTPt'
+_HEAD = '<4sBBBBB3x7I'
+_HEAD_LEN = 40
+_HIST = 32              # default ring length (updates)
+_INT_MAX = 0x7fffffff
+
+def _clamp(v):
+    if v > _INT_MAX:
+        return _INT_MAX
+    if v < -_INT_MAX:
+        return -_INT_MAX
+    return v
+
+# stats -
+#   Counters are plain attributes the client increments, the rings are
+#   filled with record() once per update.
+class stats:
+    def __init__(self, n = _HIST):
+        self.n = n
+        self.pos = 0
+        self.count = 0
+        self.polls = 0
+        self.replies = 0
+        self.timeouts = 0
+        self.resets = 0
+        self.steps = 0
+        self.errors = 0
+        self.stale = 0
+        self.rings = [array.array('i', [0] * n) for name in RINGS]
+
+    def record(self, delay, offset, jitter, adj, poll):
+        i = self.pos
+        r = self.rings
+        r[0][i] = _clamp(delay)
+        r[1][i] = _clamp(offset)
+        r[2][i] = _clamp(jitter)
+        r[3][i] = _clamp(adj)
+        r[4][i] = poll
+        self.pos = (i + 1) % self.n
+        if self.count < self.n:
+            self.count += 1
+
+    # history() -
+    #   Returns the valid entries of one ring (by name), oldest first.
+    def history(self, name):
+        ring = self.rings[RINGS.index(name)]
+        start = (self.pos - self.count) % self.n
+        return [ring[(start + i) % self.n] for i in range(0, self.count)]
+
+    # snapshot() -
+    #   Returns a dict with all counters and histories.
+    def snapshot(self):
+        snap = {}
+        for name in COUNTERS:
+            snap[name] = getattr(self, name)
+        for name in RINGS:
+            snap[name] = self.history(name)
+        return snap
+
+    def packed_size(self, ident = b''):
+        return _HEAD_LEN + len(ident) + len(RINGS) * self.n * 4
+
+    # pack_into() -
+    #   Writes the binary record into buf, which must be packed_size()
+    #   long. The rings are copied in their native byte order, which is
+    #   little endian on the supported ports.
+    def pack_into(self, buf, ident = b''):
+        struct.pack_into(_HEAD, buf, 0, _MAGIC, STATS_VERSION, self.n,
+                         self.count, self.pos, len(ident), self.polls,
+                         self.replies, self.timeouts, self.resets,
+                         self.steps, self.errors, self.stale)
+        ofs = _HEAD_LEN
+        buf[ofs:ofs + len(ident)] = ident
+        ofs += len(ident)
+        size = self.n * 4
+        for ring in self.rings:
+            buf[ofs:ofs + size] = ring
+            ofs += size
+        return buf
+
+# stats_unpack() -
+#   Decodes a binary record into a dict like snapshot() plus 'ident'.
+#   Raises ValueError if buf is not a stats record.
+def stats_unpack(buf):
+    if len(buf) < 12 or buf[:4] != _MAGIC:
+        raise ValueError("not a stats record")
+    if buf[4] != STATS_VERSION:
+        raise ValueError("stats version {} - expected {}".format(
+                         buf[4], STATS_VERSION))
+    if len(buf) < _HEAD_LEN:
+        raise ValueError("not a stats record")
+    head = struct.unpack_from(_HEAD, buf)
+    n, count, pos, m = head[2:6]
+    snap = {'ident': bytes(buf[_HEAD_LEN:_HEAD_LEN + m])}
+    for i in range(0, len(COUNTERS)):
+        snap[COUNTERS[i]] = head[6 + i]
+    ofs = _HEAD_LEN + m
+    start = (pos - count) % n
+    for name in RINGS:
+        ring = struct.unpack_from('<{}i'.format(n), buf, ofs)
+        snap[name] = [ring[(start + i) % n] for i in range(0, count)]
+        ofs += n * 4
+    return snap
+
+# exporter() -
+#   Sends the stats record of client every interval seconds, either as
+#   UDP datagram to dest (a (host, port) tuple) or by writing it to dest
+#   (anything with a write() method, like a UART). A host name in dest
+#   is looked up with the client's resolver, which does not block the
+#   loop; a failed lookup is retried at the next interval.
+async def exporter(client, dest, interval = 60, ident = b''):
+    st = client.stats
+    buf = bytearray(st.packed_size(ident))
+    out = None if isinstance(dest, tuple) else dest
+    while True:
+        await asyncio.sleep(interval)
+        if out is None:
+            try:
+                addrs = await client._resolver().resolve(dest[0])
+            except Exception as ex:
+                if client.debug:
+                    print("ntpclient: stats export:", ex)
+                continue
+            out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            out.connect((addrs[0], dest[1]))
+        st.pack_into(buf, ident)
+        try:
+            out.write(buf)
+        except OSError as ex:
+            if client.debug:
+                print("ntpclient: stats export:", ex)
@@ -0,0 +1,232 @@
+import gc
+import sys
+import ustruct as struct
+from machine import RTC, Pin
+import uasyncio as asyncio
+import utime
+
+import ntpclient
+from ntpclient.ntpclient_base import NTP_DELTA, ntp_to_us
+from ntpclient.ntpclient_clock import rtc_time_us
+
+# Heap budget in bytes for one request/reply round trip. The packet
+# path itself does not allocate any more, what remains is owned by
+# uasyncio (wait_for() task, stream wakeup) and the RTC/mktime calls.
+# Lower this whenever the measured value goes down, so that a change
+# that brings allocations back into the packet path gets noticed.
+POLL_ALLOC_MAX = 768
+
+# Heap budget in bytes for "import ntpclient" on the ESP32 with the
+# package uploaded as .py files. Frozen into the firmware the bytecode
+# stays in flash and far less is needed. Like POLL_ALLOC_MAX, lower it
+# whenever the measured value goes down.
+IMPORT_ALLOC_MAX = 24576
+
+# Neither budget has been measured on a board yet. Both are initial
+# estimates from when these benchmarks were added. Replace them with
+# the first values run_poll_alloc() and run_import() report, plus a
+# small margin. Until then "python3 -m ntpclient_sim --check" enforces
+# host side budgets measured in the simulator, see
+# ntpclient_sim.sim.POLL_ALLOC_HOST_MAX.
+
+async def bench_poll_alloc(client, count, max_bytes):
+    # Give the client's own startup poll time to complete, it will then
+    # sleep for at least MIN_POLL - 8 seconds before polling again.
+    await asyncio.sleep(5)
+
+    total = 0
+    worst = 0
+    for i in range(0, count):
+        await asyncio.sleep(1)
+        gc.collect()
+        before = gc.mem_alloc()
+        await client._send_request(client.peers[0])
+        await client._recv_reply(client.peers[0], 500, True)
+        used = gc.mem_alloc() - before
+        total += used
+        if used > worst:
+            worst = used
+
+    print("poll_alloc: {} polls, avg {} bytes, max {} bytes "
+          "(budget {})".format(count, total // count, worst, max_bytes))
+    if worst > max_bytes:
+        raise AssertionError("a round trip allocated {} bytes, "
+                             "budget is {}".format(worst, max_bytes))
+
+def run_poll_alloc(count = 10, max_bytes = POLL_ALLOC_MAX, **kwargs):
+    client = ntpclient.ntpclient(**kwargs)
+    asyncio.run(bench_poll_alloc(client, count, max_bytes))
+
+# run_import() -
+#   Measures the time and heap "import ntpclient" takes and lists the
+#   modules it loads. The package is dropped from sys.modules first and
+#   imported again, which loads it like the first time.
+def run_import(max_bytes = IMPORT_ALLOC_MAX):
+    for name in [m for m in sys.modules if m.startswith('ntpclient.')]:
+        del sys.modules[name]
+    del sys.modules['ntpclient']
+    gc.collect()
+    before = gc.mem_alloc()
+    start = utime.ticks_us()
+    import ntpclient
+    used_us = utime.ticks_diff(utime.ticks_us(), start)
+    gc.collect()
+    used = gc.mem_alloc() - before
+    print("import: {} us, {} bytes (budget {})".format(used_us, used,
+                                                        max_bytes))
+    print("import: modules", sorted(m for m in sys.modules
+                                    if m.startswith('ntpclient.')))
+    if used > max_bytes:
+        raise AssertionError("import ntpclient allocated {} bytes, "
+                             "budget is {}".format(used, max_bytes))
+
+# The (sec, usec) tuple helpers that ntpclient_base used before the
+# switch to integer microsecond timestamps, kept for comparison.
+def _tuple_add_us(ts, us):
+    usec = ts[1] + us
+    if usec < 0:
+        usec = usec - 1000000
+    sec = ts[0] + int(usec / 1000000)
+    return (sec, usec % 1000000)
+
+def _tuple_diff_us(ts1, ts2):
+    return (ts1[0] - ts2[0]) * 1000000 + (ts1[1] - ts2[1])
+
+def _tuple_sample(rbuf, tnow, roundtrip_us):
+    d1 = struct.unpack("!II", rbuf[32:40])
+    d2 = struct.unpack("!II", rbuf[40:48])
+    t1 = (d1[0] - NTP_DELTA, int(d1[1] / 4294.967))
+    t2 = (d2[0] - NTP_DELTA, int(d2[1] / 4294.967))
+    delay = roundtrip_us - _tuple_diff_us(t2, t1)
+    return _tuple_add_us(t2, delay // 2), _tuple_diff_us(tnow, t2)
+
+def _int_sample(rbuf, tnow, roundtrip_us):
+    t1 = ntp_to_us(rbuf, 32)
+    t2 = ntp_to_us(rbuf, 40)
+    delay = roundtrip_us - (t2 - t1)
+    return t2 + delay // 2, tnow - t2
+
+def _bench(func, rbuf, tnow, count):
+    gc.collect()
+    mem = gc.mem_alloc()
+    start = utime.ticks_us()
+    for i in range(0, count):
+        func(rbuf, tnow, 5000)
+    used_us = utime.ticks_diff(utime.ticks_us(), start)
+    return used_us * 1000 // count, (gc.mem_alloc() - mem) // count
+
+# run_time_base() -
+#   Compares the cost of turning one server reply into the timestamps
+#   _poll_task works with, tuple based versus integer based.
+def run_time_base(count = 1000):
+    # A reply received at 2024-01-01 00:00:00.25, sent 100us later
+    rbuf = bytearray(48)
+    struct.pack_into("!IIII", rbuf, 32, 3913056000, 1073741824,
+                     3913056000, 1074171322)
+    t_tuple = (757382400, 260000)
+    t_int = 757382400260000
+
+    ns, mem = _bench(_tuple_sample, rbuf, t_tuple, count)
+    print("time_base: tuple   {} ns/sample, {} bytes/sample".format(ns, mem))
+    ns, mem = _bench(_int_sample, rbuf, t_int, count)
+    print("time_base: integer {} ns/sample, {} bytes/sample".format(ns, mem))
+
+def _bench_call(name, func, count):
+    gc.collect()
+    mem = gc.mem_alloc()
+    start = utime.ticks_us()
+    for i in range(0, count):
+        func()
+    used_us = utime.ticks_diff(utime.ticks_us(), start)
+    print("{:<20} {} ns/call, {} bytes/call".format(
+          name, used_us * 1000 // count, (gc.mem_alloc() - mem) // count))
+
+# run_now() -
+#   Compares the cost per call of reading the time from the RTC with
+#   the client's ticks anchored time base. The client is not started,
+#   its time base is valid right after creation.
+def run_now(count = 1000, **kwargs):
+    client = ntpclient.ntpclient(**kwargs)
+    rtc = RTC()
+    out = [0, 0]
+    buf = bytearray(8)
+    _bench_call("rtc.datetime()", rtc.datetime, count)
+    _bench_call("rtc_time_us()", lambda: rtc_time_us(rtc), count)
+    _bench_call("now_us()", client.now_us, count)
+    _bench_call("now_us(out)", lambda: client.now_us(out), count)
+    _bench_call("now_ntp(buf)", lambda: client.now_ntp(buf), count)
+
+# run_stats() -
+#   Measures what recording one update into the client's statistics
+#   costs and what packing the export record costs.
+def run_stats(count = 1000, **kwargs):
+    client = ntpclient.ntpclient(**kwargs)
+    st = client.stats
+    buf = bytearray(st.packed_size(b'bench'))
+    _bench_call("stats.record()",
+                lambda: st.record(5000, -120, 300, -40, 64), count)
+    _bench_call("stats.pack_into()",
+                lambda: st.pack_into(buf, b'bench'), count)
+
+# run_serve() -
+#   Measures what answering one request costs the server, with the
+#   client's rate limits lifted so that every request gets a reply. The
+#   replies go to the discard port of addr. The client is not started,
+#   so they say that it is not synchronized, which does not change the
+#   work done.
+def run_serve(count = 1000, addr = ('127.0.0.1', 9), **kwargs):
+    client = ntpclient.ntpclient(**kwargs)
+    server = client.serve(port = 12323, rate_min_ms = 0, max_rate = 100000)
+    req = bytearray(48)
+    req[0] = 0x23
+    tpl = server._reply
+    def handle():
+        client.now_ntp(tpl, 32)
+        server._handle(req, addr)
+    _bench_call("serve request", handle, count)
+    server.close()
+
+# run_pps() -
+#   Measures what the PPS interrupt handler costs per edge. It must not
+#   allocate, or it could not run as a hard interrupt.
+def run_pps(pin = 34, count = 1000, **kwargs):
+    client = ntpclient.ntpclient(pps = Pin(pin, Pin.IN), **kwargs)
+    _bench_call("pps irq", lambda: client.pps._irq(None), count)
+    client.pps.close()
+
+# run_allan() -
+#   Measures what feeding one poll round's offset to the Allan deviation
+#   estimator costs, with the offsets 64 seconds apart.
+def run_allan(count = 1000):
+    from ntpclient.ntpclient_allan import allandev
+    allan = allandev()
+    ticks = [0]
+    def add():
+        ticks[0] = utime.ticks_add(ticks[0], 64000)
+        allan.add(100, 1280, ticks[0])
+    _bench_call("allan.add()", add, count)
+    print("allan: intercept", allan.xpt(), "s")
+
+# run_civil() -
+#   Compares what showing the wall clock once per second costs with
+#   utime.localtime() and formatting against ntpclient_civil, which
+#   mostly just advances the seconds and rebuilds the time string. The
+#   zone is Central European Time with daylight saving in 2024.
+def run_civil(count = 1000):
+    from ntpclient.ntpclient_civil import civil
+    wall = civil(zone = [(757382400, 60, 0), (765162000, 120, 60),
+                         (783306000, 60, 0)])
+    ts = [773107200]
+    def fmt():
+        ts[0] += 1
+        tm = utime.localtime(ts[0])
+        "{:04d}-{:02d}-{:02d}".format(tm[0], tm[1], tm[2])
+        "{:02d}:{:02d}:{:02d}".format(tm[3], tm[4], tm[5])
+    def upd():
+        ts[0] += 1
+        wall.update(ts[0] * 1000000)
+        wall.text_date()
+        wall.text_time()
+    _bench_call("localtime+format", fmt, count)
+    ts[0] = 773107200
+    _bench_call("civil.update()+text", upd, count)
@@ -0,0 +1,30 @@
+# ntpclient_sim
+#
+# Host side simulator for the ntpclient package. It provides CPython
+# versions of the MicroPython modules ntpclient uses (machine, utime,
+# usocket, uselect, uasyncio, ustruct, ubinascii and urandom) that run
+# against a virtual clock, so the unmodified client can be run for
+# simulated days in seconds.
+#
+#   python -m ntpclient_sim --days 1 --ppm 25 --wander 0.05
+#   python -m ntpclient_sim --bench
+#
+# ntpclient_sim.ntpserver is a stand-in NTP server with the same network
+# emulation for testing real boards.
+
+import importlib
+import sys
+
+_SHIMS = ('machine', 'utime', 'usocket', 'uselect', 'uasyncio', 'ustruct',
+          'ubinascii', 'urandom')
+
+# install() -
+#   Makes the shim modules importable under their MicroPython names and
+#   makes this process look like an ESP32 to ntpclient. This must be
+#   called before ntpclient is imported.
+def install():
+    for name in _SHIMS:
+        sys.modules[name] = importlib.import_module('ntpclient_sim.' + name)
+    sys.platform = 'esp32'
+
+from .sim import simulate, bench, check, import_cost, poll_alloc
@@ -0,0 +1,236 @@
+# python -m ntpclient_sim [options]
+
+import argparse
+import sys
+
+from . import simulate, bench, check, import_cost
+from .network import PROFILES, load_trace
+
+def _temp_step(s):
+    t, p = s.split(':')
+    return (float(t), float(p))
+
+def _outage(s):
+    t, d = s.split(':')
+    return (float(t), float(d))
+
+def _override(s):
+    name, value = s.split('=', 1)
+    return name, int(value)
+
+def main():
+    ap = argparse.ArgumentParser(prog = 'python -m ntpclient_sim',
+            description = 'Run ntpclient against a simulated clock')
+    ap.add_argument('--days', type = float, default = 1.0)
+    ap.add_argument('--seed', type = int, default = 1)
+    ap.add_argument('--ppm', type = float, default = 20.0,
+                    help = 'oscillator frequency error')
+    ap.add_argument('--wander', type = float, default = 0.0,
+                    help = 'frequency random walk in ppm/sqrt(hour)')
+    ap.add_argument('--temp-step', type = _temp_step, action = 'append',
+                    default = [], metavar = 'SEC:PPM',
+                    help = 'add PPM to the frequency error at SEC')
+    ap.add_argument('--rtc-offset', type = float, default = 0.3,
+                    help = 'initial RTC error in seconds')
+    ap.add_argument('--profile', default = 'lan', choices = sorted(PROFILES),
+                    help = 'network profile')
+    ap.add_argument('--trace', metavar = 'FILE',
+                    help = 'replay recorded transit times from FILE')
+    ap.add_argument('--delay-ms', type = float,
+                    help = 'override the profile\'s round trip delay')
+    ap.add_argument('--jitter-ms', type = float,
+                    help = 'override the profile\'s jitter')
+    ap.add_argument('--loss', type = float,
+                    help = 'override the profile\'s packet loss')
+    ap.add_argument('--server-offset-ms', type = float, default = 0.0)
+    ap.add_argument('--stratum', type = int, default = 1)
+    ap.add_argument('--servers', type = int, default = 1,
+                    help = 'number of good servers to poll')
+    ap.add_argument('--falseticker-ms', type = float, action = 'append',
+                    default = [], metavar = 'MS',
+                    help = 'add a server that is MS milliseconds off')
+    ap.add_argument('--iburst', action = 'store_true',
+                    help = 'start the client with iburst = True')
+    ap.add_argument('--sched-ms', type = float, default = 0.0,
+                    help = 'mean latency of other tasks delaying the '
+                           'client after a reply arrived')
+    ap.add_argument('--edge-ms', type = float,
+                    help = 'run a periodic scheduler job with this period '
+                           'and report its edge jitter')
+    ap.add_argument('--no-fast-rx', action = 'store_true',
+                    help = 'start the client with fast_rx = False')
+    ap.add_argument('--no-allan', action = 'store_true',
+                    help = 'start the client with allan = False, so the '
+                           'poll interval follows fixed thresholds')
+    ap.add_argument('--allan', action = 'store_true',
+                    help = 'report the Allan deviations the client '
+                           'measured')
+    ap.add_argument('--slew-err', type = int, metavar = 'US',
+                    help = 'start the client with slew_err = US')
+    ap.add_argument('--pool', type = int, default = 0, metavar = 'N',
+                    help = 'serve all servers under one name and give it '
+                           'to the client N times')
+    ap.add_argument('--dead', type = int, default = 0, metavar = 'N',
+                    help = 'the first N servers never answer')
+    ap.add_argument('--dns-ms', type = float,
+                    help = 'add a stub DNS server with this round trip')
+    ap.add_argument('--dns-ttl', type = int, default = 300,
+                    help = 'TTL of the stub DNS server\'s answers')
+    ap.add_argument('--blocking-dns', action = 'store_true',
+                    help = 'start the client with dns = False, so it '
+                           'uses the blocking socket.getaddrinfo()')
+    ap.add_argument('--outage', type = _outage, action = 'append',
+                    default = [], metavar = 'SEC:DURATION',
+                    help = 'drop all packets for DURATION seconds from SEC')
+    ap.add_argument('--broadcast', type = float, default = 0,
+                    metavar = 'SEC', help = 'have the servers send a '
+                    'broadcast every SEC seconds and start the client in '
+                    'broadcast mode')
+    ap.add_argument('--pps-jitter-us', type = float, metavar = 'US',
+                    help = 'feed the client a PPS input with edges that '
+                    'jitter this much')
+    ap.add_argument('--serve-rate', type = float, default = 0,
+                    metavar = 'N', help = 'start the client\'s NTP server '
+                    'and send it N requests per second from the LAN')
+    ap.add_argument('--serve-clients', type = int, default = 10,
+                    help = 'number of LAN devices sending the requests')
+    ap.add_argument('--discipline', choices = ('pllfll', 'average'),
+                    help = 'clock discipline engine to use')
+    ap.add_argument('--clock', choices = ('adjtime', 'sim'),
+                    default = 'adjtime', help = 'clock backend to use')
+    ap.add_argument('--leap', choices = ('insert', 'delete'),
+                    help = 'start before a leap second the servers '
+                           'announce')
+    ap.add_argument('--import-cost', action = 'store_true',
+                    help = 'report what "import ntpclient" costs')
+    ap.add_argument('--bench', action = 'store_true',
+                    help = 'run once per network profile and report '
+                           'the accuracy reached under each')
+    ap.add_argument('--check', action = 'store_true',
+                    help = 'run the regression checks, exit status 1 '
+                           'if one fails')
+    ap.add_argument('--sync-us', type = int, default = 1000,
+                    help = 'offset considered in sync')
+    ap.add_argument('--set', type = _override, action = 'append',
+                    default = [], metavar = 'MODULE.NAME=VALUE',
+                    help = 'override an ntpclient tuning constant, '
+                           'e.g. ntpclient_core._POLL_INC_AT=30')
+    args = ap.parse_args()
+
+    if args.import_cost:
+        res = import_cost()
+        print('import time:     {:.1f} ms'.format(res['import_ms']))
+        print('import heap:     {} bytes'.format(res['import_heap']))
+        print('import source:   {} bytes'.format(res['import_src']))
+        print('modules:         {}'.format(' '.join(res['import_modules'])))
+        return
+
+    if args.check:
+        failed = 0
+        for name, ok, detail in check():
+            print('{:<16} {:<5} {}'.format(name, 'ok' if ok else 'FAIL',
+                                           detail))
+            failed += not ok
+        sys.exit(1 if failed else 0)
+
+    link_args = {}
+    for name in ('delay_ms', 'jitter_ms', 'loss'):
+        if getattr(args, name) is not None:
+            link_args[name] = getattr(args, name)
+    client_args = {'iburst': args.iburst, 'fast_rx': not args.no_fast_rx,
+                   'allan': not args.no_allan}
+    if args.blocking_dns:
+        client_args['dns'] = False
+    if args.slew_err is not None:
+        client_args['slew_err'] = args.slew_err
+    sim_args = dict(days = args.days, seed = args.seed, ppm = args.ppm,
+                    wander = args.wander, temp_steps = args.temp_step,
+                    rtc_offset = args.rtc_offset, link_args = link_args,
+                    server_offset_ms = args.server_offset_ms,
+                    stratum = args.stratum, servers = args.servers,
+                    falsetickers_ms = args.falseticker_ms,
+                    sync_us = args.sync_us,
+                    overrides = dict(args.set),
+                    client_args = client_args,
+                    pool = args.pool, dead = args.dead,
+                    dns_ms = args.dns_ms, dns_ttl = args.dns_ttl,
+                    outages = args.outage,
+                    broadcast = args.broadcast,
+                    pps = args.pps_jitter_us,
+                    serve_rate = args.serve_rate,
+                    serve_clients = args.serve_clients,
+                    discipline = args.discipline, clock = args.clock,
+                    sched_ms = args.sched_ms, edge_ms = args.edge_ms,
+                    leap = args.leap)
+
+    if args.bench:
+        print('{:<12} {:>8} {:>10} {:>10} {:>10} {:>6} {:>7} {:>9}'.format(
+              'profile', 'sync s', 'mean us', 'rms us', 'max us',
+              'polls', 'replies', 'delay sd'))
+        for profile, res in bench(**sim_args):
+            sync = '-' if res['sync_s'] is None else int(res['sync_s'])
+            print('{:<12} {:>8} {:>10.0f} {:>10.0f} {:>10.0f} {:>6} {:>7} '
+                  '{:>9.0f}'.format(profile, sync, res['offset_mean_us'],
+                                    res['offset_rms_us'], res['offset_max_us'],
+                                    res['polls'], res['replies'],
+                                    res['delay_sd_us']))
+        return
+
+    res = simulate(profile = args.profile, trace = args.trace
+                   and load_trace(args.trace), **sim_args)
+
+    sync = 'never' if res['sync_s'] is None else '{:.0f} s'.format(res['sync_s'])
+    print('time to sync:    {}'.format(sync))
+    print('offset mean:     {:.1f} us'.format(res['offset_mean_us']))
+    print('offset rms:      {:.1f} us'.format(res['offset_rms_us']))
+    print('offset max:      {:.1f} us'.format(res['offset_max_us']))
+    print('polls:           {}'.format(res['polls']))
+    print('replies:         {}'.format(res['replies']))
+    print('final poll:      {} s'.format(res['poll']))
+    print('delay mean:      {:.1f} us'.format(res['delay_mean_us']))
+    print('delay sd:        {:.1f} us'.format(res['delay_sd_us']))
+    print('slew wakeups:    {:.1f} per hour'.format(res['wakeups_h']))
+    st = res['stats']
+    print('client stats:    {}'.format(' '.join('{}={}'.format(name,
+          st[name]) for name in ('timeouts', 'stale', 'resets', 'steps',
+                                 'errors'))))
+    if 'edges' in res:
+        print('edges:           {}'.format(res['edges']))
+        print('edge jitter:     {:.1f} us'.format(res['edge_jitter_us']))
+        print('edge max:        {} us'.format(res['edge_max_us']))
+        print('spin per edge:   {} us'.format(res['edge_spin_us']))
+    if res['allan_xpt'] is not None:
+        print('allan intercept: {} s'.format(res['allan_xpt']))
+    if args.allan and res['allan'] is not None:
+        for tau, adev, mdev, n in res['allan']:
+            print('  tau {:>5} s:   adev {:.4f} ppm, mdev {:.4f} ppm '
+                  '({} windows)'.format(tau, adev, mdev, n))
+    if args.leap:
+        print('leap seconds:    {}'.format(res['leaps']))
+        print('wall clock:      {}'.format(', '.join(res['leap_text'])))
+    if args.broadcast:
+        print('broadcasts:      {}'.format(res['bcasts']))
+    if args.pps_jitter_us is not None:
+        print('pps edges:       {} seen, {} used, {} dropped, {} overruns'
+              .format(res['pps_edges'], res['pps_used'],
+                      res['pps_dropped'], res['pps_overruns']))
+    if args.dns_ms is not None:
+        print('dns queries:     {}'.format(res['dns_queries']))
+    if args.outage:
+        print('holdover max:    {} us'.format(res['hold_max_us']))
+        print('holdover est:    {} us'.format(res['hold_est_us']))
+        print('sent in outage:  {}'.format(res['hold_sent']))
+        print('recovery:        {} s to poll {} s'.format(
+              res['recover_s'], res['recover_poll']))
+
+    if args.serve_rate:
+        print('served:          {} sent, {} replies, {} kiss-o\'-death, '
+              '{} dropped'.format(res['serve_sent'], res['serve_replies'],
+                                  res['serve_kods'], res['serve_drops']))
+        print('served unsync:   {}'.format(res['serve_unsync']))
+        print('served error:    mean {:.1f} us, rms {:.1f} us, '
+              'max {:.1f} us'.format(res['serve_err_mean_us'],
+                                     res['serve_err_rms_us'],
+                                     res['serve_err_max_us']))
+
+main()
@@ -0,0 +1,32 @@
+# clock.py
+#
+# Clock backend for running the ntpclient engine on CPython (see
+# ntpclient_clock). It works on the simulated system clock directly,
+# without the RTC datetime tuples and calendar conversions of the board
+# backends.
+
+from . import world as _world
+from . import utime as _utime
+
+# simclock -
+#   Slews like adjtime() on the ESP32, at 1/64 of the elapsed time.
+class simclock:
+    slews = True
+
+    def anchor(self):
+        clock = _world.current.clock
+        ts = clock.time_us()
+        return (_utime.ticks_us(), ts // 1000000, ts % 1000000)
+
+    def time_us(self):
+        return _world.current.clock.time_us()
+
+    def set_time_us(self, ts):
+        _world.current.clock.set_time_us(ts)
+
+    def slew(self, us):
+        if us != 0:
+            _world.current.clock.adjtime(us)
+
+    def remaining(self):
+        return _world.current.clock.adjtime(None)
@@ -0,0 +1,91 @@
+# collector.py
+#
+# Receives the stats records boards send with client.export_stats()
+# and prints them, or appends one CSV row per record:
+#
+#   python3 -m ntpclient_sim.collector --port 12300 --csv stats.csv
+#
+# and on the board:
+#
+#   client.export_stats(('192.168.1.10', 12300), ident = b'esp32-1')
+
+import argparse
+import asyncio
+import csv
+import time
+
+from . import install
+install()
+
+from ntpclient.ntpclient_stats import COUNTERS, RINGS, stats_unpack
+
+# row() -
+#   Flattens a decoded record into a CSV row: receive time, sender,
+#   ident, the counters and the newest entry of every ring.
+def row(snap, addr):
+    r = [int(time.time()), addr[0], snap['ident'].decode('utf-8', 'replace')]
+    r += [snap[name] for name in COUNTERS]
+    r += [snap[name][-1] if snap[name] else '' for name in RINGS]
+    return r
+
+def header():
+    return ['time', 'addr', 'ident'] + list(COUNTERS) + list(RINGS)
+
+class collector_protocol(asyncio.DatagramProtocol):
+    def __init__(self, writer = None, verbose = False):
+        self.writer = writer
+        self.verbose = verbose
+
+    def datagram_received(self, data, addr):
+        try:
+            snap = stats_unpack(data)
+        except ValueError as ex:
+            print("{}: {}".format(addr[0], ex))
+            return
+        if self.writer is not None:
+            self.writer.writerow(row(snap, addr))
+        if self.writer is None or self.verbose:
+            print("{} {}: {}".format(addr[0], snap['ident'].decode(
+                  'utf-8', 'replace'), ' '.join('{}={}'.format(name,
+                  snap[name]) for name in COUNTERS)))
+            for name in RINGS:
+                print("  {:<7} {}".format(name, snap[name]))
+
+async def collect(host, port, writer = None, verbose = False):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+            lambda: collector_protocol(writer, verbose),
+            local_addr = (host, port))
+    try:
+        await asyncio.Future()
+    finally:
+        transport.close()
+
+def main():
+    ap = argparse.ArgumentParser(prog = 'python -m ntpclient_sim.collector',
+            description = 'Receive stats records exported by ntpclient')
+    ap.add_argument('--bind', default = '0.0.0.0')
+    ap.add_argument('--port', type = int, default = 12300)
+    ap.add_argument('--csv', metavar = 'FILE',
+                    help = 'append one row per record to FILE')
+    ap.add_argument('--verbose', action = 'store_true',
+                    help = 'print records also when writing CSV')
+    args = ap.parse_args()
+
+    f = None
+    writer = None
+    if args.csv:
+        f = open(args.csv, 'a', newline = '', buffering = 1)
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(header())
+    try:
+        asyncio.run(collect(args.bind, args.port, writer, args.verbose))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if f is not None:
+            f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# loadgen.py
+#
+# Sends NTP client requests to a board running client.serve() and
+# reports how it kept up:
+#
+#   python3 -m ntpclient_sim.loadgen --host 192.168.1.20 --rate 50
+#
+# The board rate limits per IP address, so all requests from this host
+# share one client's limit, the --clients source ports only spread them
+# over several sockets. Run it from several hosts to load the board with
+# more clients. The offset is the board's time against this host's
+# clock.
+
+import argparse
+import asyncio
+import random
+import struct
+import time
+
+NTP_DELTA = 2208988800
+
+def _ntp_now():
+    t = time.time() + NTP_DELTA
+    sec = int(t)
+    return sec, int((t - sec) * 4294967296.0)
+
+def _ntp_to_s(buf, ofs):
+    sec, frac = struct.unpack_from('!II', buf, ofs)
+    return sec + frac / 4294967296.0
+
+class load_protocol(asyncio.DatagramProtocol):
+    def __init__(self, res):
+        self.res = res
+
+    def datagram_received(self, data, addr):
+        t3 = time.time() + NTP_DELTA
+        res = self.res
+        if len(data) < 48:
+            return
+        if data[1] == 0:
+            res['kods'] += 1
+            return
+        res['replies'] += 1
+        if data[0] >> 6 == 3:
+            res['unsync'] += 1
+            return
+        t0 = _ntp_to_s(data, 24)
+        t1 = _ntp_to_s(data, 32)
+        t2 = _ntp_to_s(data, 40)
+        res['rtt'].append((t3 - t0) - (t2 - t1))
+        res['offset'].append(((t1 - t0) + (t2 - t3)) / 2)
+
+async def load(host, port, rate, clients, duration):
+    loop = asyncio.get_running_loop()
+    res = {'sent': 0, 'replies': 0, 'kods': 0, 'unsync': 0,
+           'rtt': [], 'offset': []}
+    ends = []
+    for i in range(0, clients):
+        transport, protocol = await loop.create_datagram_endpoint(
+                lambda: load_protocol(res), remote_addr = (host, port))
+        ends.append(transport)
+    req = bytearray(48)
+    req[0] = 0x23
+    stop = loop.time() + duration
+    try:
+        while loop.time() < stop:
+            struct.pack_into('!II', req, 40, *_ntp_now())
+            random.choice(ends).sendto(req)
+            res['sent'] += 1
+            await asyncio.sleep(random.expovariate(rate))
+        # Give the last replies time to arrive
+        await asyncio.sleep(1)
+    finally:
+        for t in ends:
+            t.close()
+    return res
+
+def _us(values, func):
+    return '{:.0f} us'.format(func(values) * 1e6) if values else '-'
+
+def main():
+    ap = argparse.ArgumentParser(prog = 'python -m ntpclient_sim.loadgen',
+            description = 'Load test an ntpclient board serving time')
+    ap.add_argument('--host', required = True)
+    ap.add_argument('--port', type = int, default = 123)
+    ap.add_argument('--rate', type = float, default = 10,
+                    help = 'requests per second')
+    ap.add_argument('--clients', type = int, default = 1,
+                    help = 'number of source ports to send from')
+    ap.add_argument('--duration', type = float, default = 60,
+                    help = 'seconds to run')
+    args = ap.parse_args()
+
+    res = asyncio.run(load(args.host, args.port, args.rate, args.clients,
+                           args.duration))
+    rtt = sorted(res['rtt'])
+    off = res['offset']
+    print('sent:            {}'.format(res['sent']))
+    print('replies:         {} ({:.1f}/s)'.format(res['replies'],
+          res['replies'] / args.duration))
+    print('kiss-o\'-death:   {}'.format(res['kods']))
+    print('unanswered:      {}'.format(res['sent'] - res['replies']
+                                       - res['kods']))
+    print('unsync:          {}'.format(res['unsync']))
+    print('rtt median:      {}'.format(_us(rtt, lambda v: v[len(v) // 2])))
+    print('rtt max:         {}'.format(_us(rtt, max)))
+    print('offset mean:     {}'.format(_us(off, lambda v: sum(v) / len(v))))
+    print('offset min/max:  {} / {}'.format(_us(off, min), _us(off, max)))
+
+if __name__ == '__main__':
+    main()
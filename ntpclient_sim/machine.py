@@ -0,0 +1,74 @@
+# machine.py
+#
+# Simulated machine module with the parts ntpclient uses.
+
+from . import world as _world
+from . import utime as _utime
+
+# RTC -
+#   The ESP32 RTC. datetime() tuples are
+#   (year, month, day, weekday, hours, minutes, seconds, subseconds)
+#   with microsecond subseconds.
+class RTC:
+    def datetime(self, dt = None):
+        clock = _world.current.clock
+        if dt is not None:
+            self.init(dt)
+            return
+        ts = clock.time_us()
+        tm = _utime.localtime(ts // 1000000)
+        return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5],
+                ts % 1000000)
+
+    def init(self, dt):
+        secs = _utime.mktime((dt[0], dt[1], dt[2], dt[4], dt[5], dt[6],
+                              0, 0))
+        _world.current.clock.set_time_us(secs * 1000000 + dt[7])
+
+    def calibrate(self, value):
+        pass
+
+# Pin -
+#   Output pins only remember their value. Input pins get edges from
+#   the simulation through _edge(), which calls the interrupt handler
+#   right away like a hard interrupt on the board.
+class Pin:
+    IN = 1
+    OUT = 3
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    def __init__(self, id, mode = -1, *args, **kwargs):
+        self.id = id
+        self.mode = mode
+        self._value = 0
+        self._handler = None
+        self._trigger = 0
+
+    def value(self, v = None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler = None, trigger = IRQ_FALLING | IRQ_RISING,
+            hard = False):
+        self._handler = handler
+        self._trigger = trigger
+
+    # _edge() -
+    #   Sets the pin to value, running the handler if that is an edge
+    #   it triggers on.
+    def _edge(self, value):
+        value = 1 if value else 0
+        if value == self._value:
+            return
+        self._value = value
+        trig = self.IRQ_RISING if value else self.IRQ_FALLING
+        if self._handler is not None and self._trigger & trig:
+            self._handler(self)
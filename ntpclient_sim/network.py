@@ -0,0 +1,378 @@
+# network.py
+#
+# Simulated network with NTP servers. Datagrams travel over links that
+# model delay, jitter, path asymmetry, loss, duplicates and late replies.
+
+import struct
+
+from . import world as _world
+
+# (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+NTP_DELTA = 3155673600
+
+# us_to_ntp() -
+#   Converts microseconds since 2000-01-01 into 1900 based NTP
+#   (seconds, fraction).
+def us_to_ntp(ts):
+    sec, usec = divmod(ts, 1000000)
+    return (sec + NTP_DELTA) & 0xffffffff, (usec << 32) // 1000000
+
+# ntp_to_us() -
+#   Converts the NTP timestamp at offset ofs in buf into microseconds
+#   since 2000-01-01.
+def ntp_to_us(buf, ofs):
+    sec, frac = struct.unpack_from("!II", buf, ofs)
+    return (sec - NTP_DELTA) * 1000000 + ((frac * 1000000) >> 32)
+
+# link -
+#   Path between the client and one server.
+#
+#     delay_ms     base round trip delay
+#     asym         fraction of delay_ms spent on the way to the server
+#                  (0.5 is a symmetric path)
+#     jitter_ms    mean of the queueing delay added in each direction
+#     dist         distribution of that queueing delay: 'exp', 'uniform',
+#                  'normal' (half normal) or 'pareto' (heavy tailed)
+#     loss         probability that a packet is lost (in each direction)
+#     dup          probability that a reply is sent twice
+#     late         probability that a reply is held back for late_ms
+#     trace        list of recorded (up_ms, down_ms) transit times, None
+#                  meaning the packet was lost. If given, it is replayed
+#                  (cyclically) instead of drawing random delays.
+class link:
+    def __init__(self, delay_ms = 5.0, jitter_ms = 0.5, dist = 'exp',
+                 asym = 0.5, loss = 0.0, dup = 0.0, late = 0.0,
+                 late_ms = 1000.0, trace = None):
+        self.delay_us = delay_ms * 1000.0
+        self.jitter_us = jitter_ms * 1000.0
+        self.dist = dist
+        self.asym = asym
+        self.loss = loss
+        self.dup = dup
+        self.late = late
+        self.late_us = late_ms * 1000.0
+        self.trace = trace
+        self.trace_pos = 0
+        self.trace_down = None
+
+    def _jitter(self, rng):
+        j = self.jitter_us
+        if not j:
+            return 0.0
+        if self.dist == 'exp':
+            return rng.expovariate(1.0 / j)
+        if self.dist == 'uniform':
+            return rng.uniform(0.0, 2.0 * j)
+        if self.dist == 'normal':
+            return abs(rng.gauss(0.0, j * 1.2533))
+        if self.dist == 'pareto':
+            return (rng.paretovariate(2.5) - 1.0) * 1.5 * j
+        raise ValueError("unknown delay distribution '{}'".format(self.dist))
+
+    # upstream() -
+    #   Returns the transit time in microseconds of a request to the
+    #   server, or None if it gets lost.
+    def upstream(self, rng):
+        if self.trace:
+            up, self.trace_down = self.trace[self.trace_pos]
+            self.trace_pos = (self.trace_pos + 1) % len(self.trace)
+            return None if up is None else int(up * 1000)
+        if self.loss and rng.random() < self.loss:
+            return None
+        return int(self.delay_us * self.asym + self._jitter(rng))
+
+    # downstream() -
+    #   Returns a list of transit times in microseconds for the copies
+    #   of a reply that reach the client (none, one or duplicates).
+    def downstream(self, rng):
+        if self.trace:
+            down = self.trace_down
+            return [] if down is None else [int(down * 1000)]
+        if self.loss and rng.random() < self.loss:
+            return []
+        us = self.delay_us * (1.0 - self.asym) + self._jitter(rng)
+        if self.late and rng.random() < self.late:
+            us += self.late_us
+        res = [int(us)]
+        if self.dup and rng.random() < self.dup:
+            res.append(int(us + self._jitter(rng)))
+        return res
+
+# Network profiles for the simulator and the stand-in server
+PROFILES = {
+    'ideal':      dict(delay_ms = 1.0, jitter_ms = 0.0),
+    'lan':        dict(delay_ms = 1.0, jitter_ms = 0.1),
+    'wifi':       dict(delay_ms = 5.0, jitter_ms = 2.0, dist = 'pareto',
+                       loss = 0.01),
+    'asymmetric': dict(delay_ms = 20.0, jitter_ms = 0.5, asym = 0.8),
+    'congested':  dict(delay_ms = 30.0, jitter_ms = 15.0, dist = 'pareto',
+                       loss = 0.05, late = 0.02),
+    'lossy':      dict(delay_ms = 10.0, jitter_ms = 1.0, loss = 0.3,
+                       dup = 0.05, late = 0.05),
+}
+
+# load_trace() -
+#   Reads a recorded network trace. Every line holds the upstream and
+#   downstream transit time of one exchange in milliseconds, a '-'
+#   marks a lost packet. Empty lines and # comments are ignored.
+def load_trace(path):
+    trace = []
+    with open(path) as fd:
+        for line in fd:
+            line = line.split('#', 1)[0].split()
+            if not line:
+                continue
+            if len(line) != 2:
+                raise ValueError("{}: expected 'up_ms down_ms', got "
+                                 "'{}'".format(path, ' '.join(line)))
+            trace.append(tuple(None if v == '-' else float(v)
+                               for v in line))
+    return trace
+
+# make_link() -
+#   Creates a link from a profile name, with individual settings
+#   overridden by keyword arguments.
+def make_link(profile = 'lan', **kwargs):
+    if profile not in PROFILES:
+        raise ValueError("unknown network profile '{}'".format(profile))
+    args = dict(PROFILES[profile])
+    args.update(kwargs)
+    return link(**args)
+
+# server -
+#   An NTP server whose clock is off from true time by offset_ms. True
+#   time comes from the current simulation world unless clock, a
+#   function returning microseconds since 2000-01-01, is given.
+class server:
+    def __init__(self, offset_ms = 0.0, stratum = 1, refid = b'GPS\0',
+                 proc_us = 30, clock = None):
+        self.offset_us = int(offset_ms * 1000)
+        self.stratum = stratum
+        self.refid = refid
+        self.proc_us = proc_us
+        self.clock = clock
+        self.requests = 0
+        # A server that is not up drops every request
+        self.up = True
+
+    def time_us(self):
+        if self.clock is not None:
+            return self.clock() + self.offset_us
+        return _world.current.true_time_us() + self.offset_us
+
+    # li() -
+    #   Leap indicator bits of the first byte of a packet.
+    def li(self):
+        if self.clock is not None:
+            return 0
+        return _world.current.leap_li() << 6
+
+    # reply() -
+    #   Builds the reply to request packet req that arrived at server
+    #   time t1 and is sent at t2.
+    def reply(self, req, t1, t2):
+        vn = (req[0] >> 3) & 0x07
+        pkt = bytearray(48)
+        pkt[0] = self.li() | (vn << 3) | 4
+        pkt[1] = self.stratum
+        pkt[2] = req[2]
+        pkt[3] = 0xec                   # precision 2^-20
+        struct.pack_into("!II4s", pkt, 4, 0x00000010, 0x00000010, self.refid)
+        struct.pack_into("!II", pkt, 16, *us_to_ntp(t1 - 16000000))
+        pkt[24:32] = req[40:48]
+        struct.pack_into("!II", pkt, 32, *us_to_ntp(t1))
+        struct.pack_into("!II", pkt, 40, *us_to_ntp(t2))
+        return bytes(pkt)
+
+    # broadcast() -
+    #   Builds a broadcast (mode 5) sent at t2, every 2^poll seconds.
+    def broadcast(self, t2, poll):
+        pkt = bytearray(48)
+        pkt[0] = self.li() | (4 << 3) | 5
+        pkt[1] = self.stratum
+        pkt[2] = poll
+        pkt[3] = 0xec
+        struct.pack_into("!II4s", pkt, 4, 0x00000010, 0x00000010, self.refid)
+        struct.pack_into("!II", pkt, 16, *us_to_ntp(t2 - 16000000))
+        struct.pack_into("!II", pkt, 40, *us_to_ntp(t2))
+        return bytes(pkt)
+
+# dns_reply() -
+#   Builds the answer of a stub DNS server to query req: the A records
+#   of the name in addrs (None for an unknown name) with the given TTL.
+def dns_reply(req, addrs, ttl):
+    qend = 12
+    while req[qend] != 0:
+        qend += req[qend] + 1
+    qend += 5
+    flags = 0x8180 if addrs is not None else 0x8183
+    pkt = bytearray(req[:2]) + struct.pack('!HHHHH', flags, 1,
+                                           len(addrs or ()), 0, 0)
+    pkt += req[12:qend]
+    for addr in addrs or ():
+        pkt += struct.pack('!HHHIH', 0xc00c, 1, 1, ttl, 4)
+        pkt += bytes(int(p) for p in addr.split('.'))
+    return bytes(pkt)
+
+def _dns_name(req):
+    labels = []
+    ofs = 12
+    while req[ofs] != 0:
+        labels.append(req[ofs + 1:ofs + 1 + req[ofs]].decode())
+        ofs += req[ofs] + 1
+    return '.'.join(labels)
+
+# network -
+#   Maps host names to addresses and addresses to (server, link).
+class network:
+    def __init__(self):
+        self.hosts = {}
+        self.servers = {}
+        self.sent = 0
+        self.received = 0
+        self.dns = None
+        self.dns_queries = 0
+        # Broadcasts that reached a socket of the board
+        self.bcasts = 0
+        # While the network is not up every packet is dropped, down_sent
+        # counts them.
+        self.up = True
+        self.down_sent = 0
+        # Sockets of the board bound to a port (port: list of sockets,
+        # with SO_REUSEADDR there can be several) and hosts that talk
+        # to them: (address, port): (receive function, link)
+        self.local = {}
+        self.remotes = {}
+
+    def add_server(self, name, srv, lnk, addr = None):
+        if addr is None:
+            addr = '10.0.0.{}'.format(len(self.servers) + 1)
+        self.hosts.setdefault(name, []).append(addr)
+        self.servers[addr] = (srv, lnk)
+        return addr
+
+    # add_dns() -
+    #   Adds a stub DNS server at addr, reached over link lnk, that
+    #   answers A queries for the server names with the given TTL. Like
+    #   a pool's name servers it rotates the order of the addresses with
+    #   every answer.
+    def add_dns(self, addr, lnk, ttl = 300):
+        self.dns = (addr, lnk, ttl)
+
+    # start_broadcast() -
+    #   Has every server send a broadcast to port 123 every interval
+    #   seconds, starting at a random time within the first interval.
+    def start_broadcast(self, interval):
+        w = _world.current
+        poll = max(int(interval), 1).bit_length() - 1
+        for addr in self.servers:
+            w.after(int(w.rng.random() * interval * 1000000),
+                    self._broadcast, addr, int(interval * 1000000), poll)
+
+    def _broadcast(self, addr, interval_us, poll):
+        w = _world.current
+        w.after(interval_us, self._broadcast, addr, interval_us, poll)
+        srv, lnk = self.servers[addr]
+        if not srv.up or not self.up or 123 not in self.local:
+            return
+        pkt = srv.broadcast(srv.time_us(), poll)
+        for down in lnk.downstream(w.rng):
+            w.after_irq(down, self._bcast_recv, pkt, (addr, 123))
+
+    def _bcast_recv(self, pkt, src):
+        if 123 in self.local:
+            self.bcasts += 1
+            self._local(123)._deliver(pkt, False, src)
+
+    # _local() -
+    #   The socket a datagram to port goes to. Like the board's stack,
+    #   with several sockets bound to the port that is any one of them.
+    def _local(self, port):
+        socks = self.local[port]
+        if len(socks) == 1:
+            return socks[0]
+        return _world.current.rng.choice(socks)
+
+    def bind(self, sock, port):
+        self.local.setdefault(port, []).append(sock)
+
+    def unbind(self, sock):
+        for port in list(self.local):
+            if sock in self.local[port]:
+                self.local[port].remove(sock)
+                if not self.local[port]:
+                    del self.local[port]
+
+    # add_remote() -
+    #   Adds a host at addr (an (address, port) tuple) that sends to the
+    #   board with inject() and gets what the board sends to addr passed
+    #   to recv(data), over link lnk.
+    def add_remote(self, addr, recv, lnk):
+        self.remotes[addr] = (recv, lnk)
+
+    # inject() -
+    #   Sends data from the remote host src to the board's port.
+    def inject(self, src, port, data):
+        w = _world.current
+        if not self.up or port not in self.local:
+            return
+        up = self.remotes[src][1].upstream(w.rng)
+        if up is not None:
+            w.after_irq(up, self._local(port)._deliver, bytes(data), False,
+                        src)
+
+    def resolve(self, name):
+        if name in self.hosts:
+            return self.hosts[name]
+        if name in self.servers:
+            return [name]
+        raise OSError(-202)
+
+    # send() -
+    #   Sends datagram data from socket sock to addr. The reply, if
+    #   any, is delivered into the socket's receive queue.
+    def send(self, sock, data, addr):
+        w = _world.current
+        if not self.up:
+            self.down_sent += 1
+            return
+        if addr in self.remotes:
+            recv, lnk = self.remotes[addr]
+            for down in lnk.downstream(w.rng):
+                w.after_irq(down, recv, bytes(data))
+            return
+        if self.dns is not None and addr == (self.dns[0], 53):
+            up = self.dns[1].upstream(w.rng)
+            if up is not None:
+                w.after_irq(up, self._dns_recv, sock, bytes(data))
+            return
+        self.sent += 1
+        if addr[0] not in self.servers:
+            return
+        srv, lnk = self.servers[addr[0]]
+        up = lnk.upstream(w.rng)
+        if up is None:
+            return
+        w.after_irq(up, self._server_recv, sock, bytes(data), srv, lnk)
+
+    def _server_recv(self, sock, data, srv, lnk):
+        w = _world.current
+        srv.requests += 1
+        if not srv.up or len(data) < 48 or (data[0] & 0x07) != 3:
+            return
+        t1 = srv.time_us()
+        pkt = srv.reply(data, t1, t1 + srv.proc_us)
+        for down in lnk.downstream(w.rng):
+            w.after_irq(srv.proc_us + down, sock._deliver, pkt)
+
+    def _dns_recv(self, sock, req):
+        w = _world.current
+        n = self.dns_queries
+        self.dns_queries += 1
+        addrs = self.hosts.get(_dns_name(req))
+        if addrs is not None:
+            k = n % len(addrs)
+            addrs = addrs[k:] + addrs[:k]
+        pkt = dns_reply(req, addrs, self.dns[2])
+        for down in self.dns[1].downstream(w.rng):
+            w.after_irq(down, sock._deliver, pkt, False)
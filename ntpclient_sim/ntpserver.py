@@ -0,0 +1,134 @@
+# ntpserver.py
+#
+# Stand-in NTP server for testing real boards without the internet.
+# It answers on a UDP port using the host clock plus a configurable
+# offset and injects delay, jitter, asymmetry, loss, duplicates and
+# late replies according to one of the network profiles (or a recorded
+# trace). Point the board's ntpclient at the host running this:
+#
+#   sudo python3 -m ntpclient_sim.ntpserver --profile wifi --offset-ms 3
+#
+# With --broadcast it also sends a broadcast every that many seconds,
+# for boards in broadcast mode (to a multicast group with --to):
+#
+#   sudo python3 -m ntpclient_sim.ntpserver --broadcast 64 --to 224.0.1.1
+
+import argparse
+import asyncio
+import random
+import time
+
+from . import network as _network
+from . import world as _world
+
+# host_time_us() -
+#   Returns the host's time in microseconds since 2000-01-01.
+def host_time_us():
+    return time.time_ns() // 1000 - _world.UNIX_DELTA * 1000000
+
+class ntpserver_protocol(asyncio.DatagramProtocol):
+    def __init__(self, srv, lnk, rng, verbose = False):
+        self.srv = srv
+        self.lnk = lnk
+        self.rng = rng
+        self.verbose = verbose
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 48 or (data[0] & 0x07) != 3:
+            return
+        up = self.lnk.upstream(self.rng)
+        if up is None:
+            if self.verbose:
+                print("{}: request lost".format(addr[0]))
+            return
+        # The request has already arrived, so the upstream transit time
+        # is emulated by stamping it that much later.
+        asyncio.get_running_loop().call_later(up / 1000000, self._reply,
+                                              data, addr)
+
+    def _reply(self, data, addr):
+        t1 = self.srv.time_us()
+        pkt = self.srv.reply(data, t1, t1 + self.srv.proc_us)
+        downs = self.lnk.downstream(self.rng)
+        if self.verbose:
+            print("{}: t1={} replies at {} us".format(addr[0], t1, downs))
+        loop = asyncio.get_running_loop()
+        for down in downs:
+            loop.call_later((self.srv.proc_us + down) / 1000000,
+                            self.transport.sendto, pkt, addr)
+
+# broadcast() -
+#   Sends a broadcast of srv to dest every interval seconds over the
+#   transport of the server socket, with the downstream transit time of
+#   lnk emulated like for replies.
+async def broadcast(transport, dest, interval, srv, lnk, rng,
+                    verbose = False):
+    loop = asyncio.get_running_loop()
+    poll = max(int(interval), 1).bit_length() - 1
+    while True:
+        await asyncio.sleep(interval)
+        for down in lnk.downstream(rng):
+            loop.call_later(down / 1000000, _send_broadcast, transport,
+                            dest, srv, poll)
+        if verbose:
+            print("broadcast to {}".format(dest[0]))
+
+def _send_broadcast(transport, dest, srv, poll):
+    transport.sendto(srv.broadcast(srv.time_us(), poll), dest)
+
+async def serve(host, port, srv, lnk, seed = None, verbose = False,
+                bcast = 0, bcast_to = '255.255.255.255'):
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    transport, protocol = await loop.create_datagram_endpoint(
+            lambda: ntpserver_protocol(srv, lnk, rng, verbose),
+            local_addr = (host, port), allow_broadcast = bcast > 0)
+    try:
+        if bcast > 0:
+            await broadcast(transport, (bcast_to, port), bcast, srv, lnk,
+                            rng, verbose)
+        else:
+            await asyncio.Future()
+    finally:
+        transport.close()
+
+def main():
+    ap = argparse.ArgumentParser(prog = 'python -m ntpclient_sim.ntpserver',
+            description = 'Stand-in NTP server with network emulation')
+    ap.add_argument('--bind', default = '0.0.0.0')
+    ap.add_argument('--port', type = int, default = 123)
+    ap.add_argument('--profile', default = 'lan',
+                    choices = sorted(_network.PROFILES))
+    ap.add_argument('--trace', metavar = 'FILE',
+                    help = 'replay recorded transit times from FILE')
+    ap.add_argument('--offset-ms', type = float, default = 0.0,
+                    help = 'offset of the served time from the host clock')
+    ap.add_argument('--stratum', type = int, default = 1)
+    ap.add_argument('--refid', default = 'GPS')
+    ap.add_argument('--seed', type = int)
+    ap.add_argument('--broadcast', type = float, default = 0,
+                    metavar = 'SEC', help = 'send a broadcast every SEC '
+                    'seconds')
+    ap.add_argument('--to', default = '255.255.255.255', metavar = 'ADDR',
+                    help = 'broadcast or multicast address to send the '
+                    'broadcasts to')
+    ap.add_argument('--verbose', action = 'store_true')
+    args = ap.parse_args()
+
+    lnk = _network.make_link(args.profile, trace = args.trace
+                             and _network.load_trace(args.trace))
+    srv = _network.server(args.offset_ms, args.stratum,
+                          args.refid.encode()[:4].ljust(4, b'\0'),
+                          clock = host_time_us)
+    try:
+        asyncio.run(serve(args.bind, args.port, srv, lnk, args.seed,
+                          args.verbose, args.broadcast, args.to))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
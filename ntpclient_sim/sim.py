@@ -0,0 +1,543 @@
+# sim.py
+#
+# Runs ntpclient.ntpclient inside a simulated world and measures how
+# well it tracks true time.
+
+import contextlib
+import importlib
+import io
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from . import world as _world
+from . import network as _network
+
+# simulate() -
+#   Runs one simulation and returns a dict with the results:
+#
+#     sync_s       simulated seconds until the clock stayed within
+#                  sync_us of true time for at least hold_s seconds
+#                  (None if that never happened)
+#     offset_*     mean, RMS and maximum absolute offset from true time
+#                  in microseconds after sync (or over the second half
+#                  of the run if it never synced)
+#     polls        number of requests the client sent
+#     replies      number of replies that reached the client
+#     poll         poll interval at the end of the run
+#     stats        client.stats.snapshot() at the end of the run
+#     dns_queries  number of queries the stub DNS server answered
+#     bcasts       number of broadcasts that reached the client
+#     wakeups_h    times per hour the client's adjust task woke up
+#     allan        client.allan.levels() at the end of the run and the
+#     allan_xpt    Allan intercept it found (None without allan)
+#     pps_*        with pps, the edges the client's PPS source saw, used
+#                  and dropped and its ring overruns
+#     hold_*       with outages, the maximum offset from true time during
+#                  an outage, the maximum error the client estimated at
+#                  the end of one and the packets it sent during them
+#     recover_s    with outages, the longest time from the end of an
+#                  outage until the next successful poll round
+#     recover_poll with outages, the poll interval the client returned
+#                  to after the last one
+#     serve_*      with serve_rate, the requests the simulated LAN
+#                  devices sent, the replies and kiss-o'-death replies
+#                  they got, the replies that were not synchronized yet,
+#                  the error of the served time after sync (mean, RMS
+#                  and maximum, in microseconds) and the server's own
+#                  counters
+#     delay_*      mean and standard deviation of the round trip delays
+#                  the client measured, in microseconds
+#     edge_*       with edge_ms, the number of edges, their jitter and
+#                  maximum error in microseconds and the average time
+#                  the scheduler spun per edge
+#     leaps        leap seconds the client applied
+#     busy_polls   uselect poll() calls that found a socket ready right
+#                  away, which a receive loop that does not read what
+#                  it polls for runs up
+#     leap_text    with leap, the wall clock ntpclient_civil showed at
+#                  the edges of the seconds around the leap
+#
+#   servers good servers (off from true time by server_offset_ms) plus
+#   one server per entry in falsetickers_ms are simulated, each on its
+#   own link with the given profile. The client polls all of them.
+#
+#   overrides maps "module.NAME" (module inside the ntpclient package)
+#   to a value to patch in before the client is created, for example
+#   {'ntpclient_core._POLL_INC_AT': 30}.
+#
+#   sched_ms is the mean latency between a reply arriving and the
+#   waiting task running, modeling other tasks on the board.
+#
+#   edge_ms runs a periodic job on the client's scheduler with that
+#   period, like the PPS output of the test scripts.
+#
+#   discipline names the engine class in ntpclient_discipline the
+#   client uses ('pllfll' or 'average'), None leaves the default.
+#
+#   pool registers all servers under the single name pool.sim and gives
+#   the client that name pool times. The first dead servers never
+#   answer. dns_ms adds a stub DNS server with that round trip and
+#   dns_ttl which the client queries, instead of socket.getaddrinfo().
+#
+#   outages is a list of (start, duration) in seconds during which the
+#   network drops every packet.
+#
+#   broadcast has the servers send a broadcast every that many seconds
+#   and starts the client in broadcast mode.
+#
+#   pps drives a PPS input of the client with an edge at every true
+#   second, with that much normally distributed jitter in microseconds
+#   (None for no PPS input).
+#
+#   serve_rate starts the client's NTP server (with server_args) and
+#   has serve_clients devices on the LAN send it that many requests per
+#   second in total.
+#
+#   clock is the clock backend the client runs on: 'adjtime' is the
+#   ESP32 one (ntpclient_clock.adjclock) on the simulated RTC and
+#   adjtime(), 'sim' the CPython one (clock.simclock).
+#
+#   leap ('insert' or 'delete') starts the run at 2016-12-31 18:00 UTC
+#   with the servers announcing a leap second at the end of the day.
+#   The offsets are measured against UTC, which steps with it.
+def simulate(days = 1.0, ppm = 20.0, wander = 0.0, temp_steps = (),
+             rtc_offset = 0.3, profile = 'lan', trace = None, link_args = None,
+             server_offset_ms = 0.0, stratum = 1, servers = 1,
+             falsetickers_ms = (), seed = 1, sync_us = 1000,
+             hold_s = 600, sample_s = 10, overrides = None,
+             client_args = None, discipline = None, sched_ms = 0.0,
+             edge_ms = None, pool = 0, dead = 0, dns_ms = None,
+             dns_ttl = 300, outages = (), broadcast = 0, pps = None,
+             serve_rate = 0, serve_clients = 10, server_args = None,
+             clock = 'adjtime', leap = None, quiet = False):
+    from . import install
+    install()
+
+    wargs = {}
+    if leap is not None:
+        wargs['leap'] = 1 if leap == 'insert' else 2
+        wargs['epoch_us'] = (_world.LEAP_2017 - 6 * 3600) * 1000000
+    w = _world.world(seed = seed, rtc_offset = rtc_offset, ppm = ppm,
+                     wander = wander, temp_steps = temp_steps,
+                     sched_us = int(sched_ms * 1000), **wargs)
+    w.network = _network.network()
+    offsets = [server_offset_ms] * servers + list(falsetickers_ms)
+    hosts = []
+    for i in range(0, len(offsets)):
+        hosts.append('pool.sim' if pool else 'ntp{}.sim'.format(i + 1))
+        lnk = _network.make_link(profile, trace = trace, **(link_args or {}))
+        srv = _network.server(offsets[i], stratum)
+        srv.up = i >= dead
+        w.network.add_server(hosts[-1], srv, lnk)
+    if pool:
+        hosts = hosts[:1] * pool
+    if dns_ms is not None:
+        w.network.add_dns('10.0.53.1', _network.link(delay_ms = dns_ms,
+                          jitter_ms = dns_ms / 10), dns_ttl)
+    _world.current = w
+
+    for name, value in (overrides or {}).items():
+        mod, attr = name.rsplit('.', 1)
+        setattr(importlib.import_module('ntpclient.' + mod), attr, value)
+
+    from ntpclient import ntpclient
+    args = {'host': hosts if len(hosts) > 1 else hosts[0]}
+    if clock == 'sim':
+        from .clock import simclock
+        args['clock'] = simclock()
+    if dns_ms is not None:
+        args['dns'] = '10.0.53.1'
+    if broadcast:
+        args['broadcast'] = True
+    pin = None
+    if pps is not None:
+        from machine import Pin
+        pin = Pin(34, Pin.IN)
+        args['pps'] = pin
+    args.update(client_args or {})
+    if discipline is not None:
+        engines = importlib.import_module('ntpclient.ntpclient_discipline')
+        args['discipline'] = getattr(engines, discipline)()
+    client = ntpclient(**args)
+    if broadcast:
+        w.network.start_broadcast(broadcast)
+    if pin is not None:
+        pps_edges(w, pin, pps, seed)
+
+    # Record the delay of every round trip the client measures
+    delays = []
+    reply = client._reply
+    def _reply(peer, req, recv_ticks):
+        res = reply(peer, req, recv_ticks)
+        delays.append(res[0])
+        return res
+    client._reply = _reply
+
+    # Take the network down and up again, noting the client's error
+    # estimate right before the end and when it leaves holdover.
+    holds = []
+    def net_up(up):
+        if up:
+            holds.append([w.t, client.est_error(), None])
+        w.network.up = up
+    for start, duration in outages:
+        w.at(int(start * 1000000), net_up, False)
+        w.at(int((start + duration) * 1000000), net_up, True)
+    resume = client._resume
+    def _resume():
+        if holds and holds[-1][2] is None:
+            holds[-1][2] = w.t
+        resume()
+    client._resume = _resume
+
+    gen = None
+    if serve_rate:
+        client.serve(**(server_args or {}))
+        gen = loadgen(w, serve_rate, serve_clients, seed)
+
+    edge_job = None
+    if edge_ms:
+        edge_job = client.every(int(edge_ms * 1000), 0, lambda ts: None)
+
+    # Show the wall clock every second like the test scripts, noting
+    # what it reads around the leap.
+    leap_text = []
+    if leap is not None:
+        from ntpclient.ntpclient_civil import civil
+        wall = civil(client)
+        def show(ts):
+            wall.update(ts)
+            if abs(ts // 1000000 - _world.LEAP_2017) <= 2:
+                leap_text.append(wall.text_date() + ' ' + wall.text_time())
+        client.every(1000000, 0, show)
+
+    samples = []
+    def sample():
+        samples.append((w.t, w.clock.offset_us() - w.leap_step_us()))
+        w.after(sample_s * 1000000, sample)
+    sample()
+
+    if quiet:
+        with contextlib.redirect_stdout(io.StringIO()):
+            w.run(int(days * 86400 * 1000000))
+    else:
+        w.run(int(days * 86400 * 1000000))
+
+    res = _results(samples, delays, sync_us, hold_s * 1000000, w, client)
+    if outages:
+        res.update(_hold_results(samples, outages, holds, w, client))
+    if gen is not None:
+        res.update(gen.results(client.server, res['sync_s']))
+    if pin is not None:
+        res.update({'pps_edges': client.pps.edges,
+                    'pps_used': client.pps.used,
+                    'pps_dropped': client.pps.dropped,
+                    'pps_overruns': client.pps.overruns})
+    if edge_job is not None:
+        n, mean, jitter, err_max = edge_job.stats()
+        res.update({'edges': n, 'edge_jitter_us': jitter,
+                    'edge_max_us': err_max,
+                    'edge_spin_us': client.sched.stats()[3]})
+    if leap is not None:
+        res['leap_text'] = leap_text
+    return res
+
+def _results(samples, delays, sync_us, hold_us, w, client):
+    sync_t = None
+    start = None
+    for t, off in samples:
+        if abs(off) <= sync_us:
+            if start is None:
+                start = t
+            if t - start >= hold_us:
+                sync_t = start
+                break
+        else:
+            start = None
+
+    if sync_t is not None:
+        steady = [off for t, off in samples if t >= sync_t]
+    else:
+        steady = [off for t, off in samples if t >= w.t // 2]
+
+    n = len(steady)
+    dn = max(len(delays), 1)
+    dmean = sum(delays) / dn
+    return {
+        'sync_s': None if sync_t is None else sync_t / 1000000,
+        'offset_mean_us': sum(steady) / n,
+        'offset_rms_us': (sum(o * o for o in steady) / n) ** 0.5,
+        'offset_max_us': max(abs(o) for o in steady),
+        'polls': w.network.sent,
+        'replies': w.network.received,
+        'poll': client.poll,
+        'delay_mean_us': dmean,
+        'delay_sd_us': (sum((d - dmean) ** 2 for d in delays) / dn) ** 0.5,
+        'stats': client.stats.snapshot(),
+        'dns_queries': w.network.dns_queries,
+        'bcasts': w.network.bcasts,
+        'wakeups_h': client.adj_wakeups * 3600000000 / w.t,
+        'allan': client.allan and client.allan.levels(),
+        'allan_xpt': client.allan and client.allan.xpt(),
+        'leaps': client.leaps,
+        'busy_polls': w.busy_polls,
+    }
+
+def _hold_results(samples, outages, holds, w, client):
+    hold_max = 0
+    for start, duration in outages:
+        start = int(start * 1000000)
+        end = start + int(duration * 1000000)
+        for t, off in samples:
+            if start <= t < end:
+                hold_max = max(hold_max, abs(off))
+    recover = [(h[2] - h[0]) / 1000000 for h in holds if h[2] is not None]
+    return {
+        'hold_max_us': hold_max,
+        'hold_est_us': max(h[1] or 0 for h in holds) if holds else None,
+        'hold_sent': w.network.down_sent,
+        'recover_s': max(recover) if len(recover) == len(holds) else None,
+        'recover_poll': client.poll,
+    }
+
+# pps_edges() -
+#   Drives pin like the PPS output of a GPS receiver: a rising edge at
+#   every true second, off by a normally distributed jitter of jitter_us,
+#   and a falling edge 100 ms later. The edges are interrupts, they also
+#   happen while the loop is blocked.
+def pps_edges(w, pin, jitter_us, seed):
+    rng = random.Random(seed + 0x30000)
+    def rise():
+        pin._edge(1)
+        w.after_irq(100000, pin._edge, 0)
+        now = w.epoch_us + w.t
+        nxt = (now // 1000000 + 1) * 1000000
+        w.after_irq(nxt - now + int(rng.gauss(0.0, jitter_us)), rise)
+    now = w.epoch_us + w.t
+    w.after_irq(1000000 - now % 1000000, rise)
+
+# loadgen -
+#   Devices on the LAN polling the board's NTP server, rate requests
+#   per second in total, each from its own address over a LAN link. The
+#   error of the served time is measured against true time.
+class loadgen:
+    def __init__(self, w, rate, clients, seed, port = 123):
+        self.w = w
+        self.rate = rate
+        self.port = port
+        self.rng = random.Random(seed + 0x20000)
+        self.addrs = [('10.1.{}.{}'.format(i // 250, i % 250 + 1), 123)
+                      for i in range(0, clients)]
+        for addr in self.addrs:
+            w.network.add_remote(addr, self.recv,
+                                 _network.link(delay_ms = 1.0,
+                                               jitter_ms = 0.1))
+        self.sent = 0
+        self.replies = 0
+        self.kods = 0
+        self.unsync = 0
+        self.errs = []
+        w.after(0, self.send)
+
+    def send(self):
+        w = self.w
+        req = bytearray(48)
+        req[0] = 0x23
+        sec, frac = _network.us_to_ntp(w.true_time_us())
+        req[40:48] = sec.to_bytes(4, 'big') + frac.to_bytes(4, 'big')
+        w.network.inject(self.rng.choice(self.addrs), self.port, req)
+        self.sent += 1
+        w.after(int(self.rng.expovariate(self.rate) * 1000000) + 1,
+                self.send)
+
+    def recv(self, data):
+        w = self.w
+        t3 = w.true_time_us()
+        if data[1] == 0:
+            self.kods += 1
+            return
+        self.replies += 1
+        if data[0] >> 6 == 3:
+            self.unsync += 1
+            return
+        t0 = _network.ntp_to_us(data, 24)
+        t1 = _network.ntp_to_us(data, 32)
+        t2 = _network.ntp_to_us(data, 40)
+        self.errs.append((w.t, ((t1 - t0) + (t2 - t3)) / 2))
+
+    # results() -
+    #   The error statistics only cover replies after sync_s (if the
+    #   board synced at all), like the board's own offset statistics.
+    def results(self, srv, sync_s):
+        start = int((sync_s or 0) * 1000000)
+        errs = [e for t, e in self.errs if t >= start]
+        n = max(len(errs), 1)
+        return {
+            'serve_sent': self.sent,
+            'serve_replies': self.replies,
+            'serve_kods': self.kods,
+            'serve_unsync': self.unsync,
+            'serve_err_mean_us': sum(errs) / n,
+            'serve_err_rms_us': (sum(e * e for e in errs) / n) ** 0.5,
+            'serve_err_max_us': max([abs(e) for e in errs] or [0]),
+            'serve_drops': srv.drops,
+            'serve_bad': srv.bad,
+        }
+
+# import_cost() -
+#   Imports ntpclient afresh and returns what that cost on the host:
+#
+#     import_ms         wall clock time of the import in milliseconds
+#     import_heap       bytes still allocated afterwards (Python heap)
+#     import_src        bytes of source of the ntpclient modules loaded,
+#                       a proxy for the bytecode the board has to load
+#                       (or keep in flash when frozen)
+#     import_modules    names of the ntpclient modules loaded
+#
+#   The numbers are not the board's, but they move together with them
+#   when imports are added or made lazy.
+def import_cost():
+    from . import install
+    install()
+    # A first import loads what the shims need and compiles the
+    # bytecode, which the board would not count.
+    importlib.import_module('ntpclient')
+    for name in [m for m in sys.modules if m.split('.')[0] == 'ntpclient']:
+        del sys.modules[name]
+    tracemalloc.start()
+    start = time.perf_counter()
+    importlib.import_module('ntpclient')
+    used_ms = (time.perf_counter() - start) * 1000
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    mods = sorted(m for m in sys.modules if m.split('.')[0] == 'ntpclient')
+    return {
+        'import_ms': used_ms,
+        'import_heap': heap,
+        'import_src': sum(os.path.getsize(sys.modules[m].__file__)
+                          for m in mods),
+        'import_modules': mods,
+    }
+
+# Host side heap budgets in bytes for check(), the counterparts of
+# POLL_ALLOC_MAX and IMPORT_ALLOC_MAX in ntpclient_bench. CPython
+# objects are bigger than MicroPython's, so the numbers differ from the
+# board's, but an allocation added to the receive path or a module
+# added to the import shows up in both. Measured with CPython 3.11:
+# 264 bytes per receive (the reply tuple and the integers of the
+# timestamps, a 48 byte copy of the packet adds 81) and 128135 bytes
+# for the import.
+POLL_ALLOC_HOST_MAX = 300
+IMPORT_HEAP_HOST_MAX = 135000
+
+# check() -
+#   Runs the regression checks, short simulations of cases that once
+#   went wrong and the host side heap budgets, and returns a list of
+#   (name, ok, detail) tuples.
+def check():
+    out = []
+    used = max(poll_alloc())
+    out.append(('poll alloc', used <= POLL_ALLOC_HOST_MAX,
+                '{} bytes per receive (budget {})'.format(
+                used, POLL_ALLOC_HOST_MAX)))
+    used = import_cost()['import_heap']
+    out.append(('import heap', used <= IMPORT_HEAP_HOST_MAX,
+                '{} bytes (budget {})'.format(used, IMPORT_HEAP_HOST_MAX)))
+    # Late and duplicate replies of one server must not keep the low
+    # latency receive of another one spinning.
+    res = simulate(days = 0.1, servers = 2, profile = 'wifi',
+                   link_args = {'loss': 0.3}, quiet = True)
+    out.append(('lossy peers',
+                res['sync_s'] is not None
+                and res['busy_polls'] <= res['polls'],
+                '{} polls, {} busy polls, sync {} s'.format(
+                res['polls'], res['busy_polls'], res['sync_s'])))
+    # With broadcast mode and the server both on port 123, every
+    # request must still reach the server.
+    res = simulate(days = 0.05, broadcast = 64, serve_rate = 2,
+                   quiet = True)
+    answered = res['serve_replies'] + res['serve_kods'] + res['serve_drops']
+    out.append(('broadcast serve',
+                answered >= res['serve_sent'] * 0.99 and res['bcasts'] > 0,
+                '{} of {} requests answered, {} broadcasts'.format(
+                answered, res['serve_sent'], res['bcasts'])))
+    # A cold boot with the RTC at 2000 steps the clock by decades, the
+    # PPS offsets must still fit their array.
+    res = simulate(days = 0.05, rtc_offset = -700000000, pps = 2,
+                   quiet = True)
+    out.append(('pps after step',
+                res['pps_used'] > res['pps_edges'] // 2
+                and res['pps_overruns'] == 0,
+                '{} of {} edges used, {} overruns'.format(
+                res['pps_used'], res['pps_edges'], res['pps_overruns'])))
+    # A clock beyond 2036 writes timestamps of the next NTP era, in the
+    # requests and in the server's replies, and must still get synced.
+    res = simulate(days = 0.05, rtc_offset = 420000000, serve_rate = 2,
+                   quiet = True)
+    out.append(('clock past 2036',
+                res['sync_s'] is not None
+                and res['serve_replies'] >= res['serve_sent'] * 0.99,
+                'sync {} s, {} of {} requests served'.format(
+                res['sync_s'], res['serve_replies'], res['serve_sent'])))
+    return out
+
+# poll_alloc() -
+#   Runs count request/reply round trips like run_poll_alloc() of
+#   ntpclient_bench does on the board, against a simulated LAN server.
+#   Returns a list with the Python heap in bytes the client's receive
+#   path (matching and evaluating the reply) took at its peak in each,
+#   as tracemalloc sees it on the host. The rest of the round trip is
+#   the shims' uasyncio and sockets, which are not the board's.
+def poll_alloc(count = 10):
+    from . import install
+    install()
+    w = _world.world()
+    w.network = _network.network()
+    w.network.add_server('ntp1.sim', _network.server(),
+                         _network.make_link('lan'))
+    _world.current = w
+    import uasyncio as asyncio
+    from ntpclient import ntpclient
+    client = ntpclient(host = 'ntp1.sim', allan = False)
+    used = []
+    before = [None]
+    match = client._match
+    def _match(peer, n):
+        if before[0] is not None:
+            tracemalloc.reset_peak()
+            before[0] = tracemalloc.get_traced_memory()[0]
+        return match(peer, n)
+    client._match = _match
+    reply = client._reply
+    def _reply(peer, req, recv_ticks):
+        res = reply(peer, req, recv_ticks)
+        if before[0] is not None:
+            used.append(tracemalloc.get_traced_memory()[1] - before[0])
+        return res
+    client._reply = _reply
+    async def measure():
+        # Past the client's own startup poll, like on the board
+        await asyncio.sleep(5)
+        peer = client.peers[0]
+        before[0] = 0
+        for i in range(0, count):
+            await asyncio.sleep(1)
+            await client._send_request(peer)
+            await client._recv_reply(peer, 500, True)
+    tracemalloc.start()
+    asyncio.create_task(measure())
+    w.run((count + 10) * 1000000)
+    tracemalloc.stop()
+    return used
+
+# bench() -
+#   Runs the same simulation once per network profile and returns a
+#   list of (profile, results) tuples.
+def bench(profiles = None, **kwargs):
+    if profiles is None:
+        profiles = sorted(_network.PROFILES)
+    return [(p, simulate(profile = p, quiet = True, **kwargs))
+            for p in profiles]
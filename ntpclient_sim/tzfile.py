@@ -0,0 +1,84 @@
+# tzfile.py
+#
+# Builds the civil time table file ntpclient_civil loads on the board
+# from the host's zoneinfo database, with the transitions of a time zone
+# over a range of years and the built-in leap second list:
+#
+#   python3 -m ntpclient_sim.tzfile Europe/Berlin --years 2024:2040 -o berlin.tz
+#
+# and on the board:
+#
+#   civil = ntpclient_civil.civil(client, path = 'berlin.tz')
+
+import argparse
+import datetime
+import zoneinfo
+
+from . import install
+install()
+
+from ntpclient.ntpclient_civil import LEAPS, civil_pack, civil_unpack
+
+_EPOCH = datetime.datetime(2000, 1, 1, tzinfo = datetime.timezone.utc)
+_DAY = 86400
+
+def _offsets(tz, utc):
+    t = _EPOCH + datetime.timedelta(seconds = utc)
+    off = tz.utcoffset(t.astimezone(tz))
+    dst = tz.dst(t.astimezone(tz)) or datetime.timedelta(0)
+    return (int(off.total_seconds()) // 60, int(dst.total_seconds()) // 60)
+
+# zone_table() -
+#   Returns the (utc, offset, dst) transitions of the zone name from the
+#   start of year first to the start of year last, see ntpclient_civil.
+#   The first entry is the state at the start. Offsets are checked
+#   daily and a change is bisected down to the second.
+def zone_table(name, first, last):
+    tz = zoneinfo.ZoneInfo(name)
+    start = int((datetime.datetime(first, 1, 1, tzinfo = datetime.timezone.utc)
+                 - _EPOCH).total_seconds())
+    end = int((datetime.datetime(last, 1, 1, tzinfo = datetime.timezone.utc)
+               - _EPOCH).total_seconds())
+    cur = _offsets(tz, start)
+    table = [(start,) + cur]
+    t = start
+    while t < end:
+        nxt = _offsets(tz, t + _DAY)
+        if nxt != cur:
+            lo = t
+            hi = t + _DAY
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if _offsets(tz, mid) == cur:
+                    lo = mid
+                else:
+                    hi = mid
+            table.append((hi,) + nxt)
+            cur = nxt
+        t += _DAY
+    return table
+
+def _years(s):
+    first, last = s.split(':')
+    return int(first), int(last)
+
+def main():
+    ap = argparse.ArgumentParser(prog = 'python -m ntpclient_sim.tzfile',
+            description = 'Build a civil time table file for ntpclient')
+    ap.add_argument('zone', help = 'zoneinfo name, like Europe/Berlin')
+    ap.add_argument('--years', type = _years, default = (2024, 2040),
+                    metavar = 'FIRST:LAST',
+                    help = 'transitions from the start of FIRST to the '
+                           'start of LAST')
+    ap.add_argument('-o', '--output', required = True, metavar = 'FILE')
+    args = ap.parse_args()
+
+    buf = civil_pack(zone_table(args.zone, *args.years), LEAPS)
+    with open(args.output, 'wb') as f:
+        f.write(buf)
+    zone, leaps = civil_unpack(buf)
+    print("{}: {} transitions, {} leap seconds, {} bytes".format(
+          args.output, len(zone), len(leaps), len(buf)))
+
+if __name__ == '__main__':
+    main()
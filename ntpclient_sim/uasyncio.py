@@ -0,0 +1,237 @@
+# uasyncio.py
+#
+# Simulated uasyncio module. Tasks are plain coroutines stepped from
+# the timer queue of the current simulation world. Sleeping schedules
+# a timer instead of waiting, so simulated time runs as fast as the
+# host CPU allows.
+
+from . import world as _world
+
+class CancelledError(BaseException):
+    pass
+
+class TimeoutError(Exception):
+    pass
+
+# _sleep / _wait -
+#   The two things a task can wait for. A coroutine awaiting one of
+#   them yields it to Task._step(), which arranges for the wakeup.
+class _sleep:
+    def __init__(self, us):
+        self.us = us
+
+    def schedule(self, task, token):
+        w = _world.current
+        w.after(self.us + w.sched_latency(), task._step, token, None, None)
+
+    def __await__(self):
+        yield self
+
+class _wait:
+    def __init__(self, obj, timeout_us = None):
+        self.obj = obj
+        self.timeout_us = timeout_us
+
+    def schedule(self, task, token):
+        self.obj._waiters.append((task, token))
+        if self.timeout_us is not None:
+            _world.current.after(self.timeout_us, task._step, token,
+                                 None, TimeoutError())
+
+    def __await__(self):
+        yield self
+        return self.obj._result()
+
+def _wake_all(waiters):
+    w = _world.current
+    for task, token in waiters:
+        w.after(0, task._step, token, None, None)
+    del waiters[:]
+
+class Task:
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.value = None
+        self.exc = None
+        self.token = 0
+        self.cancelled = False
+        self._waiters = []
+        _world.current.after(0, self._step, 0, None, None)
+
+    # _step() -
+    #   Resumes the coroutine. Wakeups carry the token that was current
+    #   when they were scheduled, so whichever of several possible
+    #   wakeups (timeout, data, cancel) comes first wins.
+    def _step(self, token, value, exc):
+        if token != self.token or self.done:
+            return
+        self.token += 1
+        if self.cancelled:
+            self.cancelled = False
+            exc = CancelledError()
+        try:
+            if exc is not None:
+                req = self.coro.throw(exc)
+            else:
+                req = self.coro.send(value)
+        except StopIteration as ex:
+            self._finish(ex.value, None)
+        except BaseException as ex:
+            self._finish(None, ex)
+        else:
+            req.schedule(self, self.token)
+
+    def _finish(self, value, exc):
+        self.done = True
+        self.value = value
+        self.exc = exc
+        if exc is not None and not isinstance(exc, CancelledError) \
+           and not self._waiters:
+            print("Task exception wasn't retrieved:", repr(exc))
+        _wake_all(self._waiters)
+
+    def _result(self):
+        if self.exc is not None:
+            raise self.exc
+        return self.value
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelled = True
+        _world.current.after(0, self._step, self.token, None, None)
+        return True
+
+    def __await__(self):
+        if not self.done:
+            yield _wait(self)
+        return self._result()
+
+class Event:
+    def __init__(self):
+        self.state = False
+        self._waiters = []
+
+    def set(self):
+        self.state = True
+        _wake_all(self._waiters)
+
+    def clear(self):
+        self.state = False
+
+    def is_set(self):
+        return self.state
+
+    def _result(self):
+        return True
+
+    async def wait(self):
+        if not self.state:
+            await _wait(self)
+        return True
+
+# ThreadSafeFlag -
+#   Like Event, but waiting clears it again. On the board this is what
+#   interrupt handlers may set.
+class ThreadSafeFlag(Event):
+    async def wait(self):
+        if not self.state:
+            await _wait(self)
+        self.state = False
+        return True
+
+def create_task(coro):
+    return Task(coro)
+
+def sleep(t):
+    return _sleep(int(t * 1000000))
+
+def sleep_ms(t):
+    return _sleep(int(t * 1000))
+
+async def wait_for(aw, timeout):
+    task = aw if isinstance(aw, Task) else create_task(aw)
+    if timeout is None:
+        return await task
+    if not task.done:
+        try:
+            await _wait(task, int(timeout * 1000000))
+        except BaseException:
+            task.cancel()
+            raise
+    return task._result()
+
+def wait_for_ms(aw, timeout):
+    return wait_for(aw, timeout / 1000)
+
+async def gather(*aws, return_exceptions = False):
+    tasks = [aw if isinstance(aw, Task) else create_task(aw) for aw in aws]
+    res = []
+    for task in tasks:
+        try:
+            res.append(await task)
+        except Exception as ex:
+            if not return_exceptions:
+                raise
+            res.append(ex)
+    return res
+
+# core -
+#   The part of uasyncio's internals code uses to wait for a socket to
+#   become readable without reading from it, like uasyncio's streams.
+class _io_queue:
+    def queue_read(self, s):
+        return _wait(s)
+
+class core:
+    _io_queue = _io_queue()
+
+# run() -
+#   Runs the simulation until the main task finishes.
+def run(coro):
+    task = create_task(coro)
+    w = _world.current
+    while not task.done and w.timers:
+        w.run(w.timers[0][0])
+    return task._result()
+
+def run_until_complete(coro = None):
+    if coro is not None:
+        return run(coro)
+    _world.current.run()
+
+# Stream -
+#   Datagram stream on top of a simulated socket. Like on the board,
+#   each read returns (at most) one whole datagram.
+class Stream:
+    def __init__(self, sock, extra = None):
+        self.s = sock
+        self.out_buf = b''
+
+    async def readinto(self, buf):
+        while not self.s._rxq:
+            await _wait(self.s)
+        data = self.s._pop()[0]
+        n = min(len(data), len(buf))
+        buf[:n] = data[:n]
+        return n
+
+    async def read(self, n):
+        while not self.s._rxq:
+            await _wait(self.s)
+        return self.s._pop()[0][:n]
+
+    def write(self, buf):
+        self.out_buf += bytes(buf)
+
+    async def drain(self):
+        if self.out_buf:
+            self.s.send(self.out_buf)
+            self.out_buf = b''
+
+    def close(self):
+        self.s.close()
+
+StreamReader = Stream
+StreamWriter = Stream
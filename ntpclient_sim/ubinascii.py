@@ -0,0 +1,5 @@
+# ubinascii.py
+#
+# Simulated ubinascii module, CPython's binascii does the same job.
+
+from binascii import *
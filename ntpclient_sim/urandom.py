@@ -0,0 +1,12 @@
+# urandom.py
+#
+# Simulated urandom module, drawing from the simulation world's client
+# random generator so runs stay reproducible.
+
+from . import world as _world
+
+def getrandbits(n):
+    return _world.current.client_rng.getrandbits(n)
+
+def randint(a, b):
+    return _world.current.client_rng.randint(a, b)
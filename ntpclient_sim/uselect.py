@@ -0,0 +1,49 @@
+# uselect.py
+#
+# Simulated uselect module. poll() blocks the simulated uasyncio loop
+# like it does on the board, only network traffic goes on meanwhile.
+
+from . import world as _world
+
+POLLIN = 1
+POLLOUT = 4
+POLLERR = 8
+POLLHUP = 16
+
+# What a poll() call that finds a socket ready right away costs, so
+# that a loop polling a socket it never reads still lets time pass.
+POLL_US = 20
+
+class poll:
+    def __init__(self):
+        self.objs = []
+
+    def register(self, obj, eventmask = POLLIN | POLLOUT):
+        if obj not in self.objs:
+            self.objs.append(obj)
+
+    def unregister(self, obj):
+        if obj in self.objs:
+            self.objs.remove(obj)
+
+    def modify(self, obj, eventmask):
+        pass
+
+    def _ready(self):
+        return [(obj, POLLIN) for obj in self.objs if obj._rxq]
+
+    def poll(self, timeout = -1):
+        if timeout is None or timeout < 0:
+            timeout = 1 << 40
+        w = _world.current
+        start = w.t
+        if self._ready():
+            w.busy_polls += 1
+            w.block(min(POLL_US, timeout * 1000))
+        else:
+            w.block_until(timeout * 1000, self._ready)
+        w.poll_us += w.t - start
+        return self._ready()
+
+    def ipoll(self, timeout = -1, flags = 0):
+        return iter(self.poll(timeout))
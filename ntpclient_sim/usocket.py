@@ -0,0 +1,115 @@
+# usocket.py
+#
+# Simulated usocket module. Sockets talk to the servers of the current
+# simulation world's network.
+
+from . import world as _world
+from .uasyncio import _wake_all
+
+AF_INET = 2
+SOCK_STREAM = 1
+SOCK_DGRAM = 2
+IPPROTO_UDP = 17
+IPPROTO_IP = 0
+SOL_SOCKET = 1
+SO_REUSEADDR = 4
+IP_ADD_MEMBERSHIP = 3
+
+# getaddrinfo() -
+#   Like on the board this blocks the caller (and so the whole loop)
+#   until the lookup is done. With a stub DNS server in the network
+#   that takes one round trip to it.
+def getaddrinfo(host, port, af = 0, type = 0, proto = 0, flags = 0):
+    w = _world.current
+    net = w.network
+    if net.dns is not None:
+        net.dns_queries += 1
+        if not net.up:
+            net.down_sent += 1
+        up = net.dns[1].upstream(w.rng)
+        downs = net.dns[1].downstream(w.rng)
+        if not net.up or up is None or not downs:
+            w.block(5000000)
+            raise OSError(-3)
+        w.block(up + downs[0])
+    return [(AF_INET, SOCK_DGRAM, IPPROTO_UDP, '', (addr, port))
+            for addr in net.resolve(host)]
+
+class socket:
+    def __init__(self, af = AF_INET, type = SOCK_STREAM, proto = 0):
+        self.af = af
+        self.type = type
+        self.peer = None
+        self.closed = False
+        self._rxq = []
+        self._srcq = []
+        self._waiters = []
+
+    def connect(self, addr):
+        self.peer = addr
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, level, opt, value):
+        pass
+
+    def bind(self, addr):
+        _world.current.network.bind(self, addr[1])
+
+    def send(self, data):
+        if self.closed:
+            raise OSError(9)
+        _world.current.network.send(self, data, self.peer)
+        return len(data)
+
+    write = send
+
+    def sendto(self, data, addr):
+        if self.closed:
+            raise OSError(9)
+        _world.current.network.send(self, data, addr)
+        return len(data)
+
+    def readinto(self, buf):
+        if not self._rxq:
+            return None
+        data = self._pop()[0]
+        n = min(len(data), len(buf))
+        buf[:n] = data[:n]
+        return n
+
+    def recvfrom(self, n):
+        if not self._rxq:
+            raise OSError(11)
+        data, src = self._pop()
+        return data[:n], src
+
+    def close(self):
+        self.closed = True
+        self._rxq = []
+        self._srcq = []
+        _world.current.network.unbind(self)
+
+    def _pop(self):
+        return self._rxq.pop(0), self._srcq.pop(0)
+
+    # _deliver() -
+    #   Called by the network when a datagram arrives for this socket.
+    #   Only NTP replies are counted. src is the sender's address.
+    def _deliver(self, data, count = True, src = None):
+        if self.closed:
+            return
+        w = _world.current
+        if count:
+            w.network.received += 1
+        self._rxq.append(data)
+        self._srcq.append(src)
+        lat = w.sched_latency()
+        if lat:
+            w.after(lat, _wake_all, self._waiters)
+        else:
+            _wake_all(self._waiters)
+
+    def _result(self):
+        return None
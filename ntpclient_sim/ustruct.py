@@ -0,0 +1,5 @@
+# ustruct.py
+#
+# Simulated ustruct module, CPython's struct does the same job.
+
+from struct import *
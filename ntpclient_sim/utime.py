@@ -0,0 +1,67 @@
+# utime.py
+#
+# Simulated utime module. Time comes from the clock of the current
+# simulation world, with the 2000-01-01 epoch of the ESP32 port.
+
+import calendar
+import time as _time
+
+from . import world as _world
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD >> 1
+
+def ticks_us():
+    return _world.current.clock.ticks_us() & _TICKS_MAX
+
+def ticks_ms():
+    return (_world.current.clock.ticks_us() // 1000) & _TICKS_MAX
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALFPERIOD) & _TICKS_MAX) \
+           - _TICKS_HALFPERIOD
+
+def time():
+    return _world.current.clock.time_us() // 1000000
+
+def time_ns():
+    return _world.current.clock.time_us() * 1000
+
+def localtime(secs = None):
+    if secs is None:
+        secs = time()
+    tm = _time.gmtime(int(secs) + _world.UNIX_DELTA)
+    return (tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min,
+            tm.tm_sec, tm.tm_wday, tm.tm_yday)
+
+gmtime = localtime
+
+def mktime(tm):
+    return calendar.timegm((tm[0], tm[1], 1, 0, 0, 0)) - _world.UNIX_DELTA \
+           + (tm[2] - 1) * 86400 + tm[3] * 3600 + tm[4] * 60 + tm[5]
+
+# The blocking sleeps let simulated time pass without running any
+# other task, just like they block the uasyncio loop on the board.
+def sleep(secs):
+    _world.current.block(secs * 1000000)
+
+def sleep_ms(ms):
+    _world.current.block(ms * 1000)
+
+def sleep_us(us):
+    _world.current.block(us)
+
+# adjtime() -
+#   The function added to the ESP32 port by esp32_adjtime.diff. Takes
+#   a (sec, usec) tuple, returns the previously outstanding adjustment.
+def adjtime(delta = None):
+    if delta is not None:
+        delta = delta[0] * 1000000 + delta[1]
+    remaining = _world.current.clock.adjtime(delta)
+    if remaining < 0:
+        return (-(-remaining // 1000000), -(-remaining % 1000000))
+    return (remaining // 1000000, remaining % 1000000)
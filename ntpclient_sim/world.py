@@ -0,0 +1,249 @@
+# world.py
+#
+# Virtual time base of the simulator. All simulated time is kept as
+# integer microseconds of "true" time since the start of the run. Code
+# running inside the simulation never waits for wall clock time, the
+# world simply jumps from one timer to the next, so a simulated day
+# finishes in seconds.
+
+import heapq
+import random
+
+# (date(2000, 1, 1) - date(1970, 1, 1)).days * 24*60*60
+UNIX_DELTA = 946684800
+
+# Default start of the simulation, 2024-01-01 00:00:00 in microseconds
+# since 2000-01-01.
+DEFAULT_EPOCH_US = 757382400 * 1000000
+
+# The last leap second so far, inserted before 2017-01-01 00:00:00
+# (seconds since 2000-01-01).
+LEAP_2017 = 536544000
+
+# The world currently being simulated. The shim modules (utime, machine,
+# usocket and uasyncio) look this up on every call.
+current = None
+
+# oscillator -
+#   Model of the board's crystal. The frequency error is in ppm and
+#   changes by a random walk (wander, in ppm per sqrt(hour)) and by
+#   sudden temperature steps, given as a list of (sim_seconds, ppm)
+#   tuples that are added to the frequency at that time.
+class oscillator:
+    # The wander random walk is applied in steps of this many seconds
+    WANDER_STEP = 60
+
+    def __init__(self, rng, ppm = 0.0, wander = 0.0, temp_steps = ()):
+        self.rng = rng
+        self.ppm = float(ppm)
+        self.wander = float(wander)
+        self.temp_steps = sorted((int(t * 1000000), float(p))
+                                 for t, p in temp_steps)
+        self.next_wander = self.WANDER_STEP * 1000000
+
+    # next_change() -
+    #   Returns the true time at which the frequency changes next.
+    def next_change(self):
+        t = self.next_wander if self.wander else None
+        if self.temp_steps and (t is None or self.temp_steps[0][0] < t):
+            t = self.temp_steps[0][0]
+        return t
+
+    # change() -
+    #   Applies all frequency changes due at true time t.
+    def change(self, t):
+        while self.temp_steps and self.temp_steps[0][0] <= t:
+            self.ppm += self.temp_steps.pop(0)[1]
+        if self.wander and self.next_wander <= t:
+            self.ppm += self.rng.gauss(0.0, self.wander *
+                                       (self.WANDER_STEP / 3600.0) ** 0.5)
+            self.next_wander += self.WANDER_STEP * 1000000
+
+# clock -
+#   The board's system clock. It counts oscillator microseconds (which
+#   is also what ticks_us() returns) and adds the boot time offset plus
+#   whatever adjtime() has slewed so far. Like the ESP-IDF, adjtime()
+#   slews by 1/64 of the elapsed time and a new adjtime() call replaces
+#   the remaining adjustment instead of adding to it.
+class clock:
+    SLEW_SHIFT = 6
+
+    def __init__(self, osc, epoch_us = DEFAULT_EPOCH_US, offset_us = 0):
+        self.osc = osc
+        self.epoch_us = epoch_us
+        self.t = 0                      # true time of the last update
+        self.osc_us = 0.0               # oscillator microseconds
+        self.base_us = float(epoch_us + offset_us)
+        self.slew_us = 0.0              # remaining adjtime() offset
+
+    # advance() -
+    #   Integrates the oscillator and the running slew up to true time t.
+    def advance(self, t):
+        while self.t < t:
+            seg_end = t
+            change = self.osc.next_change()
+            if change is not None and change < seg_end:
+                seg_end = change
+            if seg_end > self.t:
+                d_osc = (seg_end - self.t) * (1.0 + self.osc.ppm * 1e-6)
+                self.osc_us += d_osc
+                if self.slew_us != 0.0:
+                    corr = min(abs(self.slew_us), d_osc / (1 << self.SLEW_SHIFT))
+                    if self.slew_us < 0.0:
+                        corr = -corr
+                    self.base_us += corr
+                    self.slew_us -= corr
+                self.t = seg_end
+            if change is not None and change <= self.t:
+                self.osc.change(self.t)
+
+    def ticks_us(self):
+        return int(self.osc_us)
+
+    # time_us() -
+    #   Returns the system time in microseconds since 2000-01-01.
+    def time_us(self):
+        return int(self.base_us + self.osc_us)
+
+    def set_time_us(self, ts):
+        self.base_us = float(ts) - self.osc_us
+        self.slew_us = 0.0
+
+    # adjtime() -
+    #   Starts slewing by delta microseconds (or just queries if delta
+    #   is None). Returns the adjustment that was still outstanding.
+    def adjtime(self, delta):
+        remaining = int(self.slew_us)
+        if delta is not None:
+            self.slew_us = float(delta)
+        return remaining
+
+    # offset_us() -
+    #   Returns how far the system clock is off from true time.
+    def offset_us(self):
+        return self.base_us + self.osc_us - (self.epoch_us + self.t)
+
+# world -
+#   Timer queue and virtual time of one simulation run. With leap 1 (or
+#   2) a leap second is inserted (deleted) before leap_at, seconds since
+#   2000-01-01 of the start of a month. UTC then steps like the clock of
+#   a server does, see ntpclient_core._leap_task().
+class world:
+    def __init__(self, seed = 1, epoch_us = DEFAULT_EPOCH_US, rtc_offset = 0.0,
+                 ppm = 0.0, wander = 0.0, temp_steps = (), sched_us = 0,
+                 leap = 0, leap_at = LEAP_2017):
+        self.rng = random.Random(seed)
+        # Random numbers the client itself draws (urandom) come from a
+        # generator of their own, so they do not change the oscillator
+        # and network of a run.
+        self.client_rng = random.Random(seed + 0x10000)
+        self.t = 0
+        self.seq = 0
+        self.timers = []
+        self.osc = oscillator(self.rng, ppm, wander, temp_steps)
+        self.clock = clock(self.osc, epoch_us, int(rtc_offset * 1000000))
+        self.epoch_us = epoch_us
+        self.network = None
+        # Mean latency in microseconds between an I/O event and the task
+        # waiting for it running, caused by other tasks on the board
+        self.sched_us = sched_us
+        # Microseconds the loop was blocked in uselect poll() calls, and
+        # the calls that found a socket ready right away
+        self.poll_us = 0
+        self.busy_polls = 0
+        self.leap = leap
+        self.leap_at_us = leap_at * 1000000
+
+    # true_time_us() -
+    #   Returns the true time (UTC) in microseconds since 2000-01-01.
+    def true_time_us(self):
+        return self.epoch_us + self.t + self.leap_step_us()
+
+    # leap_step_us() -
+    #   Returns how far UTC has been stepped for the leap second so far.
+    def leap_step_us(self):
+        if self.leap == 1:
+            if self.epoch_us + self.t >= self.leap_at_us + 1000000:
+                return -1000000
+        elif self.leap == 2:
+            if self.epoch_us + self.t >= self.leap_at_us - 1000000:
+                return 1000000
+        return 0
+
+    # leap_li() -
+    #   Returns the leap indicator the servers send: the leap until it
+    #   happened, 0 after.
+    def leap_li(self):
+        if self.leap and self.leap_step_us() == 0:
+            return self.leap
+        return 0
+
+    # at() / after() -
+    #   Calls func(*args) at true time t or us microseconds from now.
+    def at(self, t, func, *args):
+        self.seq += 1
+        heapq.heappush(self.timers, (t, self.seq, func, args, False))
+
+    def after(self, us, func, *args):
+        self.at(self.t + int(us), func, *args)
+
+    # after_irq() -
+    #   Like after(), for events outside of the uasyncio loop (network
+    #   traffic), which also happen while the loop is blocked.
+    def after_irq(self, us, func, *args):
+        self.seq += 1
+        heapq.heappush(self.timers, (self.t + int(us), self.seq, func, args,
+                                     True))
+
+    # sched_latency() -
+    #   Random delay in microseconds before a task woken by I/O runs.
+    def sched_latency(self):
+        if not self.sched_us:
+            return 0
+        return int(self.rng.expovariate(1.0 / self.sched_us))
+
+    # block() -
+    #   Lets time pass without running any timers, like a busy wait or
+    #   blocking call on the board does.
+    def block(self, us):
+        self.t += int(us)
+        self.clock.advance(self.t)
+
+    # block_until() -
+    #   Blocks for at most us microseconds, running only irq events,
+    #   until cond() is true. Returns the final value of cond().
+    def block_until(self, us, cond):
+        end = self.t + int(us)
+        deferred = []
+        timers = self.timers
+        while not cond() and timers and timers[0][0] <= end:
+            tm = heapq.heappop(timers)
+            if not tm[4]:
+                deferred.append(tm)
+                continue
+            if tm[0] > self.t:
+                self.t = tm[0]
+                self.clock.advance(self.t)
+            tm[2](*tm[3])
+        for tm in deferred:
+            heapq.heappush(timers, tm)
+        if cond():
+            return True
+        self.block(end - self.t)
+        return False
+
+    # run() -
+    #   Runs timers until true time reaches until_us (or forever if None).
+    def run(self, until_us = None):
+        timers = self.timers
+        while timers:
+            if until_us is not None and timers[0][0] > until_us:
+                break
+            t, seq, func, args, irq = heapq.heappop(timers)
+            if t > self.t:
+                self.t = t
+                self.clock.advance(t)
+            func(*args)
+        if until_us is not None and until_us > self.t:
+            self.t = until_us
+            self.clock.advance(until_us)
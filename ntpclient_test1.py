@@ -1,50 +1,33 @@
-import sys
-from machine import RTC, Pin
+from machine import Pin
 import uasyncio as asyncio
 import utime
 
 import ntpclient
 
-async def test1_square(pin):
-    rtc = RTC()
-    while True:
-        if sys.platform == 'esp32':
-            # We want maximum precision, so we let await get us within 2ms,
-            # then use a blocking utime.sleep_us() to strike. Every now and
-            # the something will interfere ... meh.
-            delay = (1000000 - rtc.datetime()[7]) // 1000
-            if delay > 4:
-                await asyncio.sleep_ms(delay - 2)
-            delay = (1000000 - rtc.datetime()[7])
-            if delay > 0:
-                utime.sleep_us(delay)
-        elif sys.platform == 'esp8266':
-            # ESP8266 only has milliseconds, so no point in the above.
-            delay = (1000 - rtc.datetime()[7])
-            if delay > 0:
-                await asyncio.sleep_ms(delay)
-        else:
-            raise RuntimeError("unsupported platform '{}'".format(sys.platform))
+async def _show_time(job, ts):
+    # Printing is slow, so it runs as its own task after the edge.
+    now = utime.localtime(ts // 1000000)
+    print("{0:04d}-{1:02d}-{2:02d} {3:02d}:{4:02d}:{5:02d}".format(*now))
+    if now[5] == 0:
+        print("edges: {} mean: {:.0f}us jitter: {:.0f}us max: {}us".format(
+              *job.stats()))
 
-        # Turn the pin on and print the current time on REPL
+def test1_square(client, pin):
+    # Turn the pin on at every full second and off 100ms later. The
+    # client's scheduler sleeps until shortly before each edge and then
+    # spins for the rest, learning how long before it has to wake up.
+    def pin_on(ts):
         pin.value(1)
-        now = utime.localtime()
-        print("{0:04d}-{1:02d}-{2:02d} {3:02d}:{4:02d}:{5:02d}".format(*now))
+        return _show_time(on, ts)
 
-        # Wait for 100ms
-        if sys.platform == 'esp32':
-            delay = (100000 - rtc.datetime()[7]) // 1000
-        elif sys.platform == 'esp8266':
-            delay = (100 - rtc.datetime()[7])
-        if delay > 0:
-            await asyncio.sleep_ms(delay)
-
-        # Turn the pin off
+    def pin_off(ts):
         pin.value(0)
 
+    on = client.every(1000000, 0, pin_on)
+    client.every(1000000, 100000, pin_off)
+
 def run(pps = None, **kwargs):
     pps_pin = Pin(pps, mode = Pin.OUT)
     client = ntpclient.ntpclient(**kwargs)
-    asyncio.create_task(test1_square(pps_pin))
+    test1_square(client, pps_pin)
     asyncio.run_until_complete()
-
@@ -1,58 +1,42 @@
-import sys
-from machine import I2C, Pin, RTC
+from machine import I2C, Pin
 import uasyncio as asyncio
-import utime
 import ssd1306
 
 import ntpclient
+from ntpclient.ntpclient_civil import civil
 
-async def test2_square(pin, scl, sda):
+async def _show_time(oled, date, time):
+    # The display update takes several milliseconds over I2C, so it
+    # runs as its own task after the edge.
+    oled.fill(0)
+    oled.text(date, 0, 0)
+    oled.text(time, 16, 8)
+    oled.show()
+
+def test2_square(client, pin, scl, sda, tz = None):
     i2c = I2C(-1, scl=scl, sda=sda)
     oled = ssd1306.SSD1306_I2C(128, 64, i2c)
-    rtc = RTC()
-
-    while True:
-        if sys.platform == 'esp32':
-            # We want maximum precision, so we let await get us within 2ms,
-            # then use a blocking utime.sleep_us() to strike. Every now and
-            # the something will interfere ... meh.
-            delay = (1000000 - rtc.datetime()[7]) // 1000
-            if delay > 4:
-                await asyncio.sleep_ms(delay - 2)
-            delay = (1000000 - rtc.datetime()[7])
-            if delay > 0:
-                utime.sleep_us(delay)
-        elif sys.platform == 'esp8266':
-            # ESP8266 only has milliseconds, so no point in the above.
-            delay = (1000 - rtc.datetime()[7])
-            if delay > 0:
-                await asyncio.sleep_ms(delay)
-        else:
-            raise RuntimeError("unsupported platform '{}'".format(sys.platform))
+    # Local time from a table file built by ntpclient_sim.tzfile, UTC
+    # without one.
+    wall = civil(client, path = tz)
 
-        # Turn the pin on and print the current time on REPL
+    # Turn the pin on at every full second and off 100ms later, the
+    # display refresh shares the scheduler with the pin edges.
+    def pin_on(ts):
         pin.value(1)
-        oled.fill(0)
-        now = utime.localtime()
-        oled.text("{0:04d}-{1:02d}-{2:02d}".format(*now), 0, 0)
-        oled.text("  {3:02d}:{4:02d}:{5:02d}".format(*now), 0, 8)
-        oled.show()
+        wall.update(ts)
+        return _show_time(oled, wall.text_date(), wall.text_time())
 
-        # Wait for 100ms
-        if sys.platform == 'esp32':
-            delay = (100000 - rtc.datetime()[7]) // 1000
-        elif sys.platform == 'esp8266':
-            delay = (100 - rtc.datetime()[7])
-        if delay > 0:
-            await asyncio.sleep_ms(delay)
-
-        # Turn the pin off
+    def pin_off(ts):
         pin.value(0)
 
-def run(pps = None, scl = None, sda = None, **kwarg):
+    client.every(1000000, 0, pin_on)
+    client.every(1000000, 100000, pin_off)
+
+def run(pps = None, scl = None, sda = None, tz = None, **kwarg):
     pps_pin = Pin(pps, mode=Pin.OUT)
     scl_pin = Pin(scl)
     sda_pin = Pin(sda)
     client = ntpclient.ntpclient(**kwarg)
-    asyncio.create_task(test2_square(pps_pin, scl_pin, sda_pin))
+    test2_square(client, pps_pin, scl_pin, sda_pin, tz)
     asyncio.run_until_complete()